@@ -1,5 +1,7 @@
 #include "ms5837.h"
 
+#include <stddef.h>
+
 
 #ifndef BAR30_H
 #define BAR30_H
@@ -17,6 +19,9 @@ typedef struct {
 int bar30_init(bar30_t *bar30_instance, uint16_t i2c_bus, bool verbose);
 int bar30_stop(bar30_t *bar30_instance);
 int bar30_read(bar30_t *bar30_instance);
+int bar30_read_osr(bar30_t *bar30_instance, MS5837_ADC_OSR osr);
+int bar30_read_samples(bar30_t *bar30_instance, MS5837_ADC_OSR osr, uint32_t count, uint32_t interval_us,
+                       double *timestamps, float *pressure_mbar, float *temperature_c);
 int bar30_pressure_mbar(bar30_t *bar30_instance, float *pressure_mbar);
 int bar30_temperature_celcius(bar30_t *bar30_instance, float *temperature_c);
 int bar30_depth_meters(bar30_t *bar30_instance, float *depth_meters);
@@ -28,5 +33,9 @@ int bar30_get_water_type(bar30_t *bar30_instance, BAR30_WATER_TYPE *water_type);
 
 void bar30_print_calibration_data(bar30_t *bar30_instance);
 
+// For bindings (e.g. Python ctypes) which allocate the instance without the struct definition
+size_t bar30_instance_size(void);
+ms5837_t *bar30_sensor(bar30_t *bar30_instance);
+
 
 #endif // end BAR30_H
\ No newline at end of file
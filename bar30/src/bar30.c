@@ -103,23 +103,33 @@ int bar30_stop(bar30_t *bar30_instance)
 
 
 int bar30_read(bar30_t *bar30_instance)
+{
+    return bar30_read_osr(bar30_instance, OSR_512);
+}
+
+int bar30_read_osr(bar30_t *bar30_instance, MS5837_ADC_OSR osr)
 {
 
     if (bar30_instance == NULL) {
         printf("Error: bar30_instance is NULL\n");
         return 1; // Error reading sensor
     }
+
+    if (osr > OSR_8192) {
+        printf("Error: Invalid oversampling option\n");
+        return 4;
+    }
     //bar30_t bar30 = *bar30_instance; // Use the provided instance
-    uint16_t wait_us = ms5837_start_conversion(&bar30_instance->sensor, SENSOR_PRESSURE, OSR_512);
-    usleep(wait_us); // Wait for twice the conversion time
+    uint16_t wait_us = ms5837_start_conversion(&bar30_instance->sensor, SENSOR_PRESSURE, osr);
+    usleep(wait_us); // Wait for the conversion time
     int result = ms5837_read_conversion(&bar30_instance->sensor);
     if (result == 0)
     {
         return 2; 
     }
 
-    wait_us = ms5837_start_conversion(&bar30_instance->sensor, SENSOR_TEMPERATURE, OSR_512);
-    usleep(wait_us); // Wait for twice the conversion time
+    wait_us = ms5837_start_conversion(&bar30_instance->sensor, SENSOR_TEMPERATURE, osr);
+    usleep(wait_us); // Wait for the conversion time
     result = ms5837_read_conversion(&bar30_instance->sensor);
     if (result == 0)
     {
@@ -133,6 +143,52 @@ int bar30_read(bar30_t *bar30_instance)
     return 0; 
 }
 
+static double realtime_seconds(void)
+{
+    struct timespec now;
+    clock_gettime(CLOCK_REALTIME, &now);
+    return now.tv_sec + now.tv_nsec / 1e9;
+}
+
+// Read [count] samples, starting one every [interval_us] microseconds (or back to back if 0).
+// Samples are paced against the monotonic clock with absolute sleeps, so the interval does not drift
+// with the time taken by each read. Each timestamp is the middle of its read (seconds since the epoch).
+// Returns the number of samples read, which is less than count if a read failed.
+int bar30_read_samples(bar30_t *bar30_instance, MS5837_ADC_OSR osr, uint32_t count, uint32_t interval_us,
+                       double *timestamps, float *pressure_mbar, float *temperature_c)
+{
+    if (bar30_instance == NULL || timestamps == NULL || pressure_mbar == NULL || temperature_c == NULL) {
+        printf("Error: bar30_instance or sample buffers are NULL\n");
+        return 0;
+    }
+
+    struct timespec next;
+    clock_gettime(CLOCK_MONOTONIC, &next);
+
+    for (uint32_t i = 0; i < count; i++)
+    {
+        if (i > 0 && interval_us > 0)
+        {
+            next.tv_nsec += (long)interval_us * 1000L;
+            while (next.tv_nsec >= 1000000000L) {
+                next.tv_nsec -= 1000000000L;
+                next.tv_sec += 1;
+            }
+            clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, &next, NULL);
+        }
+
+        double start = realtime_seconds();
+        if (bar30_read_osr(bar30_instance, osr) != 0) {
+            return i;
+        }
+        timestamps[i] = (start + realtime_seconds()) / 2;
+        pressure_mbar[i] = ms5837_pressure_mbar(&bar30_instance->sensor);
+        temperature_c[i] = ms5837_temperature_celcius(&bar30_instance->sensor);
+    }
+
+    return count;
+}
+
 int bar30_pressure_mbar(bar30_t *bar30_instance, float *pressure_mbar)
 {
 
@@ -285,6 +341,20 @@ void bar30_i2c_write(int16_t pigpiod_instance_handle, uint16_t i2c_bus, uint8_t
 }
 
 
+size_t bar30_instance_size(void)
+{
+    return sizeof(bar30_t);
+}
+
+ms5837_t *bar30_sensor(bar30_t *bar30_instance)
+{
+    if (bar30_instance == NULL) {
+        return NULL;
+    }
+    return &bar30_instance->sensor;
+}
+
+
 void bar30_print_calibration_data(bar30_t *bar30_instance)
 {
     if (bar30_instance == NULL) {
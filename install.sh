@@ -145,12 +145,11 @@ fi
 
     echo "Creating .env file at $ENV_FILE..."
 
-    echo "Edit this file to change the data directory or IDS Peak installation directory, and to adjust location of named pipes."
+    echo "Edit this file to change the data directory or IDS Peak installation directory, and to adjust location of the control socket."
 
     echo "IDS_PEAK_DIR=\"$IDS_PEAK_DIR\"" >> "$ENV_FILE"
     echo "DATA_DIRECTORY=\"$DATA_DIR\"" > "$ENV_FILE"
-    echo "PIPE_IN_FILE=\"/tmp/${TOOL_NAME}_IN\"" >> "$ENV_FILE"
-    echo "PIPE_OUT_FILE=\"/tmp/${TOOL_NAME}_OUT\"" >> "$ENV_FILE"
+    echo "CONTROL_SOCKET_FILE=\"/tmp/${TOOL_NAME}_CONTROL\"" >> "$ENV_FILE"
     echo "PYTHON_EXECUTABLE=\"${PYTHON_EXE}\"" >> "$ENV_FILE"
     chown -R $SUDO_USER: "$ENV_FILE"
 
@@ -212,6 +211,9 @@ install -D -o "$SUDO_USER" -m 774 -g "$GROUP_NAME" "$SCRIPTS_DIR/run.sh" "$TOOL_
 install -D -o "$SUDO_USER" -m 774 -g "$GROUP_NAME" "$SCRIPTS_DIR/sesh.sh" "$SESSION_HANDLER_TARGET"
 install -D -o "$SUDO_USER" -m 774 -g "$GROUP_NAME" "$SCRIPTS_DIR/zip.sh" "$SESSION_ZIP_TARGET"
 
+# Tab completion of the options and camera node names
+install -D -m 644 "$SCRIPTS_DIR/completion.sh" "/etc/bash_completion.d/${TOOL_LOWER}"
+
 
 echo "Setting up systemd service for ${TOOL_NAME}..."
 
@@ -224,6 +226,7 @@ LOGGING_SERVICE_FILE="${BASE_SERVICE_DIR}/logging@.service"
 TERMINAL_SERVICE_FILE="${BASE_SERVICE_DIR}/serialTerm@.service"
 AUTOSTART_SERVICE_FILE="${BASE_SERVICE_DIR}/autostart@.service"
 SERVER_SERVICE_FILE="${BASE_SERVICE_DIR}/dataserver@.service"
+DAEMON_SERVICE_FILE="${BASE_SERVICE_DIR}/daemon@.service"
 
 LOGGER_SCRIPT="${SCRIPTS_DIR}/log.sh"
 
@@ -242,6 +245,9 @@ AUTOSTART_SERVICE_CONFIG_DIR="${AUTOSTART_SERVICE_FILE_TARGET}.d"
 SERVER_SERVICE_FILE_TARGET="${SYSTEMD_SERVICE_DIR}/dataserver@${TOOL_LOWER}.service"
 SERVER_SERVICE_CONFIG_DIR="${SERVER_SERVICE_FILE_TARGET}.d"
 
+DAEMON_SERVICE_FILE_TARGET="${SYSTEMD_SERVICE_DIR}/daemon@${TOOL_LOWER}.service"
+DAEMON_SERVICE_CONFIG_DIR="${DAEMON_SERVICE_FILE_TARGET}.d"
+
 ## Service for logging to dh4 and running the serial terminal
 
 install -g "$GROUP_NAME" -m 644 "$LOGGING_SERVICE_FILE" "$LOGGING_SERVICE_FILE_TARGET"
@@ -269,6 +275,23 @@ echo "Group=$GROUP_NAME" >> "$AUTOSTART_SERVICE_CONFIG_DIR/variables.conf"
 
 systemctl enable "autostart@${TOOL_LOWER}.service"
 
+# Daemon service - keeps the cameras and pressure sensor connected between routines. While it runs, routines started
+# with -r (including autostart) are queued with it instead of starting a new process, but other tools can't use the camera.
+
+install -g "$GROUP_NAME" -m 644 "$DAEMON_SERVICE_FILE" "$DAEMON_SERVICE_FILE_TARGET"
+
+mkdir -p "$DAEMON_SERVICE_CONFIG_DIR"
+echo "[Service]" > "$DAEMON_SERVICE_CONFIG_DIR/variables.conf"
+echo "Group=$GROUP_NAME" >> "$DAEMON_SERVICE_CONFIG_DIR/variables.conf"
+echo "WorkingDirectory=$BASE_DIR" >> "$DAEMON_SERVICE_CONFIG_DIR/variables.conf"
+
+read -e -p "Start the ${TOOL_NAME} daemon on boot, keeping the cameras connected between routines? [y/N] " ENABLE_DAEMON
+if [ "$ENABLE_DAEMON" == "y" ] || [ "$ENABLE_DAEMON" == "Y" ]; then
+    systemctl enable "daemon@${TOOL_LOWER}.service"
+else
+    echo "Daemon not enabled. Enable it later with 'sudo systemctl enable --now daemon@${TOOL_LOWER}.service'"
+fi
+
 # Service for running the dataserver - disabled in AEGIR for now
 
 
@@ -1,29 +1,116 @@
+from __future__ import annotations
 import argparse
 import logging.handlers
 from pathlib import Path
 import json
 import os, sys
-from dotenv import load_dotenv
 import traceback
 from datetime import datetime, timedelta
 from time import time, sleep
 import logging
-import ms5837
-
-import focus
-import routine
-import session
-import device_interface
-from device_interface import convert_time
 import queue
-from cam_image import get_fast_saturation_fraction
+import threading
+from typing import TYPE_CHECKING
+import config
+import control
+
+#The camera, image and sensor modules (harvesters, numpy, PIL) are imported by the functions which use them, so
+#commands which don't capture (--help, --check) start quickly. Imported here only for type checking.
+if TYPE_CHECKING:
+    import ms5837
+    import auto_exposure
+    import routine
+    import device_interface
+
+logger = logging.getLogger()
+
+class RoutineError(Exception):
+    """A routine could not be started, or was abandoned. Run from the command line the script exits with error code 1,
+    the daemon moves on to its next job."""
+
+
+def open_cameras(camera_serials:str=None) -> list[device_interface.Camera]:
+    """Open the cameras to capture with.
+
+    Args:
+        camera_serials (str, optional): Comma separated serial numbers of the cameras, or "all". Defaults to the first camera found.
+
+    Returns:
+        list[device_interface.Camera]: The cameras. Raises RoutineError if any could not be opened.
+    """
+    import device_interface
+    if camera_serials is None or camera_serials.strip() == "":
+        devices = [device_interface.open()]
+    elif camera_serials.strip().lower() == "all":
+        devices = device_interface.open_all()
+    else:
+        devices = device_interface.open_all([serial.strip() for serial in camera_serials.split(",") if serial.strip() != ""])
+    if len(devices) == 0 or None in devices:
+        logger.critical("Could not connect to Device")
+        # log_error(message="Could not connect to Device")
+        raise RoutineError("Could not connect to Device")
+    return devices
+
 
-env_location = Path(__file__).parent.parent / ".env"
-load_dotenv(env_location)
+def open_pressure_sensor() -> ms5837.MS5837:
+    """Open the pressure sensor. Raises RoutineError if it could not be opened."""
+    import ms5837
+    import ms5837_native
+    try:
+        #The backend (bar30 C library or Python driver) is chosen by PRESSURE_SENSOR_BACKEND (see ms5837_native.py)
+        sensor = ms5837_native.open_sensor()
+    except Exception as e:
+        # print_and_log("Could not connect to Pressure Sensor")
+        logger.critical(e, exc_info=True)
+        sensor = None
+    if sensor is None:
+        logger.critical("Could not connect to Pressure Sensor")
+        # log_error(message="Could not connect to Pressure Sensor")
+        raise RoutineError("Could not connect to Pressure Sensor")
+    sensor.setFluidDensity(ms5837.DENSITY_SALTWATER)
+    return sensor
+
+
+def check_routine(routine_name:str) -> bool:
+    """Check a routine without connecting to the cameras or pressure sensor. Prints the problems found in its
+    parameters and a summary of the routine.
+
+    Args:
+        routine_name (str): Routine file path, or file or routine name in the routine directory
+
+    Returns:
+        bool: Whether the routine was found and has no problems
+    """
+    import routine
+    if Path(routine_name).is_file():
+        file_path = Path(routine_name)
+        entry = routine.RoutineIndex.index_file(file_path)
+    else:
+        try:
+            routine_directory = config.data_directory() / "routines"
+        except RuntimeError as e:
+            print(e)
+            return False
+        file_path, entry = routine.RoutineIndex(routine_directory).refresh().find(routine_name)
+        if file_path is None:
+            print(f"Routine {routine_name} does not exist")
+            return False
+
+    print(f"Routine file: {file_path}")
+    if len(entry["problems"]) > 0:
+        print(f"{len(entry['problems'])} problem(s):")
+        for problem in entry["problems"]:
+            print(f"\t{problem}")
+    if entry["params"] is None or entry["name"] is None:
+        return False
+    try:
+        valid_params, _ = routine.resolve_params(entry["params"])
+        print(routine.Routine(**valid_params))
+    except Exception as e:
+        print(f"Could not build routine: {e}")
+        return False
+    return len(entry["problems"]) == 0
 
-DATA_DIR = Path(os.environ.get("DATA_DIRECTORY"))
-PIPE_IN_FILE = Path(os.environ.get("PIPE_IN_FILE"))
-PIPE_OUT_FILE = Path(os.environ.get("PIPE_OUT_FILE"))
 
 def main(log_queue:queue.Queue=None):
     """Loads a session and routine from arguments passed when calling the script.
@@ -35,10 +122,13 @@ def main(log_queue:queue.Queue=None):
     The script opens or creates a session with the name in the --session arg.
     If it can find a routine with the name in the --routine arg it will run that, 
     otherwise it will exit with error code 1.
+
+    With --daemon the script instead keeps the cameras and pressure sensor open and runs routines submitted on the
+    control socket until it is shut down (see daemon.py).
+
+    With --check the routine is only checked (see check_routine) - exits with error code 1 if it has problems.
     
     """    
-
-    logger = logging.getLogger()
     
     #Argparse is a library used for parsing arguments passed to the script when it is called from the command line
     parser = argparse.ArgumentParser(description='Get session and routine arguments')
@@ -47,7 +137,13 @@ def main(log_queue:queue.Queue=None):
     parser.add_argument('--routine', required=False, help='Set routine name')
     parser.add_argument('--session',required=False, help='Set session name')
     parser.add_argument('--focus',action='store_true', required=False, help='Run focus check script')
+    parser.add_argument('--focus-metric', choices=['sobel', 'laplacian'], default='sobel', required=False, help='Sharpness metric of the focus check: sobel (steady) or laplacian (more sensitive to fine detail)')
+    parser.add_argument('--focus-rate', type=float, default=10, required=False, help='Sharpness measurements per second of the focus check')
     parser.add_argument('--autostart', action='store_true', required=False, help='Starting in autostart mode')
+    parser.add_argument('--cameras', required=False, help='Comma separated serial numbers of the cameras to use, or "all". Uses the first camera found if not set')
+    parser.add_argument('--resume', action='store_true', required=False, help='Continue the routine from where it stopped if the session has already run it')
+    parser.add_argument('--daemon', action='store_true', required=False, help='Keep the cameras and pressure sensor open and run routines submitted on the control socket')
+    parser.add_argument('--check', action='store_true', required=False, help='Check the routine for problems and print a summary of it, without running it')
         
 
     # Parse command line arguments
@@ -58,23 +154,88 @@ def main(log_queue:queue.Queue=None):
     session_name:str = args.session
     focus_check:bool = args.focus
     auto_start:bool = args.autostart
+    camera_serials:str = args.cameras
+    resume:bool = args.resume
+    run_daemon:bool = args.daemon
+    check:bool = args.check
+
+    #Loaded after the arguments are parsed, so --help doesn't wait for it
+    config.load()
+
+    if check:
+        if routine_name is None:
+            logger.critical("Routine Name not specified")
+            sys.exit(1)
+        sys.exit(0 if check_routine(routine_name) else 1)
+
     if focus_check:
-        focus.run_focus_script()
+        import focus
+        focus_serial = camera_serials.split(",")[0].strip() if camera_serials and camera_serials != "all" else None
+        focus.run_focus_script(serial_number=focus_serial, metric=args.focus_metric, rate_hz=args.focus_rate)
         sys.exit(0)
 
+    if run_daemon:
+        logger.info("Daemon mode")
+        import daemon
+        daemon.Daemon(run_routine, routine_dir=config.data_directory() / "routines", camera_serials=camera_serials, log_queue=log_queue).run()
+        return
 
     if auto_start:
         logger.info("Autostart mode")
-
-    current_session: session.Session = None
-    current_routine: routine.Routine = None
-
-
     
     if routine_name is None:
         logger.error(f'Routine Name not specified. Exiting.')
         sys.exit(0)
 
+    #Attempt to open connection to the device(s) and the pressure sensor, then run the routine - exit with error code 1 if any fail
+    try:
+        devices = open_cameras(camera_serials)
+        sensor = open_pressure_sensor()
+        run_routine(devices, sensor, routine_name, session_name=session_name, resume=resume, auto_start=auto_start, log_queue=log_queue)
+    except RoutineError:
+        logger.critical("Exiting...")
+        sys.exit(1)
+
+
+def run_routine(devices:list[device_interface.Camera],
+                sensor:ms5837.MS5837,
+                routine_name:str,
+                session_name:str=None,
+                resume:bool=False,
+                auto_start:bool=False,
+                log_queue:queue.Queue=None,
+                routine_control:control.RoutineControl=None,
+                on_start:callable=None):
+    """Run a routine to completion with open cameras and pressure sensor, saving the images to a session.
+
+    Args:
+        devices (list[device_interface.Camera]): Cameras to capture with
+        sensor (ms5837.MS5837): Initialised pressure sensor
+        routine_name (str): Routine file path, or file or routine name in the routine directory
+        session_name (str, optional): Session to open or create. Defaults to the starting timestamp.
+        resume (bool, optional): Continue the routine from where it stopped if the session has already run it. Defaults to False.
+        auto_start (bool, optional): Started by autostart - always resumes. Defaults to False.
+        log_queue (queue.Queue, optional): Log queue written to the session's output log. Defaults to None.
+        routine_control (control.RoutineControl, optional): Control of the routine over the control socket, when the
+            socket is served by the caller (the daemon). Defaults to None, which serves the socket while the routine runs.
+        on_start (callable, optional): Called with the routine once it is loaded, e.g. so it can be stopped from another thread. Defaults to None.
+
+    Raises:
+        RoutineError: If the routine or session could not be loaded, or the routine was abandoned after repeated errors.
+    """
+    import auto_exposure
+    import hdr
+    import pressure_sampler
+    import routine
+    import session
+    import device_interface
+    from device_interface import convert_time
+    from cam_image import get_fast_histogram
+    from concurrent.futures import ThreadPoolExecutor
+
+    current_session: session.Session = None
+    current_routine: routine.Routine = None
+
     if session_name == "":
         session_name = None
 
@@ -83,93 +244,130 @@ def main(log_queue:queue.Queue=None):
         logger.info(f'Session Name not set. Using starting timestamp.')
     else:
         logger.info(f'Session Name: {session_name}')
-    
+    logger.info(f"Using {len(devices)} camera(s): {', '.join([str(device.serial_number) for device in devices])}")
 
-    #Attempt to open connection to the device - exit with error code 1 if not
-    
-    device = device_interface.open()
-    if not device:
-        logger.critical("Could not connect to Device")
-        # log_error(message="Could not connect to Device")
-        sys.exit(1)
+    #The pressure sensor is read continuously by a sampler thread (started once the routine is loaded, at the routine's
+    #sensor sample rate and oversampling). Captures look up the values at the middle of their exposure, so the capture
+    #path makes no I2C reads, and the sensor values are added and the image queued on a finishing thread, so the
+    #capture thread can move straight on to the next frame. The finishing thread has one worker so images reach the
+    #session in the order they were captured.
+    sampler:pressure_sampler.PressureSampler = None
+    finishing_thread = ThreadPoolExecutor(max_workers=1, thread_name_prefix="finishing")
 
-    #Attempt to open connection to the pressure sensor - exit with error code 1 if not
-    
-    try:
-        sensor = ms5837.MS5837_30BA()
-        if not sensor.init():
-            logger.critical("Could not connect to Pressure Sensor")
-            logger.critical("Exiting")
-            # log_error(message="Could not connect to Pressure Sensor")
-            sys.exit(1)
-        
-        sensor.setFluidDensity(ms5837.DENSITY_SALTWATER)
-    except Exception as e:
-        # print_and_log("Could not connect to Pressure Sensor")
-        logger.critical(e, exc_info=True)
-        logger.critical("Could not connect to Pressure Sensor")
-        sys.exit(1)
-    
+    def read_environment() -> tuple[float, float, float]:
+        """
+        Newest depth, pressure and temperature from the pressure sensor sampler.
 
-    #Define functions to get the depth, pressure and temperature from the pressure sensor
-    def get_depth(retry:bool=False) -> float:
+        Returns:
+            tuple[float, float, float]: Depth (m), pressure (mbar) and temperature (°C), or 0.0 for each if the sensor is not responding
+        """
         try:
-            sensor.read()
-            depth : float = sensor.depth()
+            return sampler.latest()
         except Exception as e:
-            if retry:
-                sleep(0.1)
-                depth = get_depth()
-            else:
-                logger.exception(e)
-                logger.error("Pressure Sensor Not Responding - setting depth to 0.0")
-                # print_and_log("Pressure Sensor Not Responding - setting depth to 0.0")
-                depth : float = 0.0
-        return depth
-    
-    def get_pressure(retry:bool=False) -> float:
+            logger.exception(e)
+            logger.error("Pressure Sensor Not Responding - setting depth, pressure and temp to 0.0")
+            return 0.0, 0.0, 0.0
+
+    def environment_at(image) -> tuple[float, float, float]:
+        """
+        Depth, pressure and temperature interpolated to the middle of an image's exposure.
+        The image timestamp is the camera's exposure start timestamp, mapped to the host clock.
+        If the exposure ended after the newest sample, this waits for the next sample (see PressureSampler.at).
+        """
         try:
-            sensor.read()
-            pressure : float = sensor.pressure()
+            with current_routine.phase_timer.phase("read_sensor_wait"):
+                return sampler.at(image.timestamp.timestamp() + image.integration_time_secs / 2)
         except Exception as e:
-            if retry:
-                sleep(0.1)
-                pressure = get_pressure()
-            else:
-                logger.exception(e)
-                logger.error("Pressure Sensor Not Responding - setting pressure to 0.0")
-                # print_and_log("Pressure Sensor Not Responding - setting pressure to 0.0")
-                pressure : float = 0.0
-        return pressure
-      
-      
-    def get_temp(retry:bool=False) -> float:
+            logger.exception(e)
+            logger.error("Pressure Sensor Not Responding - setting depth, pressure and temp to 0.0")
+            return 0.0, 0.0, 0.0
+
+    def finish_image(image, auto:bool, progress:int):
+        """Add the sensor values to an image and add it to the session queue, with the routine's progress once the
+        capture which took it is complete. Runs on the finishing thread."""
         try:
-            sensor.read()
-            temp : float = sensor.temperature()
+            timer = current_routine.phase_timer
+            depth, pressure, temperature = environment_at(image)
+            image.set_depth(depth)
+            image.set_pressure(pressure)
+            image.set_environment_temperature(temperature)
+            image.set_auto(auto)
+            image.set_storage_format(current_routine.storage_format)
+            if not keep_image(image, auto):
+                return
+            # Add the image to the session queue to be processed by the session thread
+            with timer.phase("enqueue"):
+                current_session.add_image_to_queue(image, routine_progress=(current_routine.name, progress))
+            logger.info(f"\tAdded to Queue - Queue size: {current_session.queue_length}")
         except Exception as e:
-            if retry:
-                sleep(0.1)
-                temp = get_temp()
-            else:
-                logger.exception(e)
-                logger.error("Pressure Sensor Not Responding - setting temp to 0.0")
-                # print_and_log("Pressure Sensor Not Responding - setting temp to 0.0")
-                temp : float = 0.0
-        return temp
-    
+            logger.error("Error finishing image")
+            logger.exception(e)
+
+    def keep_image(image, auto:bool) -> bool:
+        """
+        Report the scene statistics of an image to the routine's adaptive cadence and return whether to store it.
+        The statistics are cached on the image, so they are not calculated again when the session logs it.
+        """
+        if current_routine.cadence is None:
+            return True
+        with current_routine.phase_timer.phase("scene_change"):
+            #Auto-adjust frames are compared with each other whatever integration time was accepted
+            key = (image.camera_id, "auto" if auto else image.integration_time_us, image.gain)
+            exposure = image.integration_time_secs * auto_exposure.gain_to_linear(image.gain)
+            luminance = image.relative_luminance / exposure if exposure > 0 else image.relative_luminance
+            return current_routine.observe_scene(key, luminance, image.inner_saturation_fraction)
+
+    #Settings already set on each camera for the next capture, so they are not set again (see stage_settings)
+    staged_settings:dict[int, tuple[float, float]] = {}
+
+    def stage_settings(device:device_interface.Camera, next_settings:dict):
+        """
+        Set the integration time and gain of the next capture while the current image is being finished,
+        so frames with the new settings are already streaming when the next capture starts.
+        Auto-adjust captures are not staged as their integration time is not known yet.
+        """
+        if next_settings is None or next_settings["integration_time"] == 0 or current_routine.hdr_mode:
+            return
+        with current_routine.phase_timer.phase("stage_next_settings"):
+            device.gain(next_settings["gain"])
+            device.integration_time(time=next_settings["integration_time"], time_unit=device_interface.SECONDS)
+        staged_settings[id(device)] = (next_settings["integration_time"], next_settings["gain"])
+
+    #Auto exposure controller for each camera - keeps the history of accepted exposures between captures
+    exposure_controllers = [auto_exposure.ExposureController(target_fraction=0.01, min_fraction=0.005, max_fraction=0.02, saturation_threshold=250) for device in devices]
+    #Each camera captures on its own thread so several cameras capture concurrently
+    camera_threads = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"camera_{device.serial_number}") for device in devices]
+
+    def run_on_cameras(function, *args, **kwargs):
+        """
+        Run a capture function on every camera concurrently and wait for all of them to finish.
+        The function is called with the camera and its exposure controller as its first two arguments.
+        """
+        if len(devices) == 1:
+            return [function(devices[0], exposure_controllers[0], *args, **kwargs)]
+        futures = [camera_thread.submit(function, device, controller, *args, **kwargs) 
+                   for camera_thread, device, controller in zip(camera_threads, devices, exposure_controllers)]
+        return [future.result() for future in futures]
+
     #Function to capture an image from the camera
     #This function is passed to the routine object and is called when the routine wants to capture an image
     #It takes an integration time in seconds, a gain value and a boolean for auto integration
     #If the integration time is 0 or None, the function will use auto integration
-    def capture_image(integration_time_secs: float = None, gain: float = None, auto: bool = False, capture_n=None):
+    #With several cameras, every camera captures an image with its own auto exposure
+    def capture_image(integration_time_secs: float = None, gain: float = None, auto: bool = False, capture_n=None, next_settings:dict=None):
+        run_on_cameras(capture_camera_image, integration_time_secs=integration_time_secs, gain=gain, auto=auto, capture_n=capture_n, next_settings=next_settings)
+
+    def capture_camera_image(device:device_interface.Camera, exposure_controller:auto_exposure.ExposureController, integration_time_secs: float = None, gain: float = None, auto: bool = False, capture_n=None, next_settings:dict=None):
         """
-        Capture an image using the specified integration time, gain, and auto-integration settings.
+        Capture an image with one camera using the specified integration time, gain, and auto-integration settings.
 
         Args:
+            device (device_interface.Camera): Camera to capture with.
+            exposure_controller (auto_exposure.ExposureController): Auto exposure controller of the camera.
             integration_time_secs (float, optional): Integration time in seconds. If set to 0 or None, auto-adjust integration time mode will be used. Defaults to None.
             gain (float, optional): Device gain value. If provided, the device gain will be changed to this value. Defaults to None.
             auto (bool, optional): Flag indicating whether to use auto-integration mode. If True, auto-integration mode will be used regardless of the integration time value. Defaults to False.
+            next_settings (dict, optional): Settings of the routine's next capture, staged on the camera once this image has been captured. Defaults to None.
 
         Raises:
             Exception: If an error occurs while capturing the image.
@@ -187,18 +385,30 @@ def main(log_queue:queue.Queue=None):
                 image_string += "- Auto Exposure"
             # print_and_log(image_string)
 
-            logger.info(f"Capturing Image {current_session.image_count + current_session.queue_length} (#{current_routine.image_count} of routine)")
+            logger.info(f"Capturing Image {current_session.image_count + current_session.queue_length} (#{current_routine.image_count} of routine){f' - Camera {device.camera_id}' if device.camera_id is not None else ''}")
             logger.info(f"\tAuto integration time mode: {auto or integration_time_secs == 0 or integration_time_secs is None}")
             logger.info(f"\tIntegration Time: {integration_time_secs:8.5f}s")
             logger.info(f"\tGain: {gain}")
 
-            if gain is not None:
+            capture_start = time()
+            timer = current_routine.phase_timer
+            staged = staged_settings.pop(id(device), None) == (integration_time_secs, gain)
+
+            if gain is not None and not staged:
                 device.gain(gain)  # Change device gain if it is passed
 
             # Switch to auto-adjust integration time mode if integration time is 0 or None
             # Otherwise, set the integration time to the passed value.
-            if integration_time_secs == 0 or integration_time_secs is None or auto:
+            if staged:
+                integration_time = integration_time_secs
+                logger.info(f"\tIntegration time and gain already staged")
+            elif integration_time_secs == 0 or integration_time_secs is None or auto:
                 auto = True
+                # Seed the first attempt from the last accepted exposure and the trend against depth or time
+                exposure_controller.set_limits(*device.integration_time_range(time_unit=device_interface.SECONDS))
+                seed_time_s = exposure_controller.seed(gain=device.gain(), depth=read_environment()[0], default=device.integration_time_seconds)
+                logger.info(f"\tAuto exposure seed: {seed_time_s} s")
+                integration_time = device.integration_time(time=seed_time_s, time_unit=device_interface.SECONDS)
             else:
                 integration_time = device.integration_time(time=integration_time_secs, time_unit=device_interface.SECONDS)
                 logger.info(f"\tSet integration time to {integration_time}")
@@ -208,7 +418,14 @@ def main(log_queue:queue.Queue=None):
             image = None
 
             auto_attempt_no = 0
-            auto_attempt_limit = 10
+            auto_attempt_limit = exposure_controller.max_attempts
+            auto_result = None
+            # Metering frames may use a reduced capture profile. Each profile switch restarts acquisition, so the first
+            # attempt uses the routine's capture profile - the seeded integration time is usually accepted and the frame
+            # becomes the session image without a switch. Later attempts use the metering profile, and the session image
+            # is then captured with the capture profile once the integration time has been accepted.
+            metering_profile = current_routine.metering_profile if auto else None
+            metering_complete = False
 
             # The device may have old images in the buffer with different integration times, 
             #so we need to set the desired integration time to the new value and it will flush the buffer until an image is captured with the new integration time.
@@ -233,54 +450,92 @@ def main(log_queue:queue.Queue=None):
                     continue
                 # print_and_log("Capture Complete")
                 logger.info("\tCapture Complete")
-                # Add the pressure, depth, and temperature to the image object and set whether it was an auto integration capture.
-                image.set_depth(get_depth(retry=True))
-                image.set_pressure(get_pressure(retry=True))
-                image.set_environment_temperature(get_temp(retry=True))
-                image.set_auto(auto)
-                # Add the image to the session queue to be processed by the session thread
-                current_session.add_image_to_queue(image)
-                logger.info(f"\tAdded to Queue - Queue size: {current_session.queue_length}")
-                # print_and_log(f"Added to Queue - Queue size: {current_session.queue_length}")
-                # If in auto mode, check if the image has the correct saturation level and use the ids_interface.calculate_new_integration() function to calculate a new integration time if it does not.
-                if auto:
+                # If in auto mode, the frame is a metering frame. Check if it has the correct saturation level using only the
+                # fast statistics of the raw frame. Rejected frames are discarded (only a compact record is kept) and
+                # the accepted frame becomes the session image, so no extra capture is needed.
+                if auto and not metering_complete:
                     # print_and_log("Auto")
                     auto_attempt_no += 1
 
-                    sat_frac = get_fast_saturation_fraction(image, 250)
-                    sat_min, sat_max = 0.005, 0.02
-                    capture_successful = sat_frac > 0.005 and sat_frac < 0.02
+                    # Predict the integration time which reaches the target saturation fraction from the histogram of the active area
+                    with timer.phase("metering_statistics"):
+                        histogram = get_fast_histogram(image, decimation=current_routine.metering_decimation)
+                        auto_result, sat_frac, new_integration_time_s = exposure_controller.evaluate(histogram, image.integration_time_secs)
+                    capture_successful = auto_result != auto_exposure.RETRY
+                    sat_min, sat_max = exposure_controller.min_fraction, exposure_controller.max_fraction
 
                     # print_and_log("capture_successful: ", capture_successful)
 
 
                     if not capture_successful:
                         logger.warning(f"\tAuto capture unsuccessful ({auto_attempt_no}/{auto_attempt_limit} attempts)")
-                        new_integration_time_s = device_interface.calculate_new_integration_time(
-                            current_integration_time=image.integration_time_secs,
-                            saturation_fraction=sat_frac)
                         logger.warning(f"\tAttempted integration time: {image.integration_time_secs} s")
                         logger.warning(f"\tIncorrect saturation fraction of {round(sat_frac, 3)}")
                         logger.warning(f"\tTarget is between {sat_min} and {sat_max}")
+                        current_session.add_metering_record({"time": image.time_string('%Y-%m-%d %H:%M:%S.%f')[:-3],
+                                                             "routine_image": current_routine.image_count,
+                                                             "gain_dB": gain,
+                                                             **exposure_controller.attempts[-1]})
                         
                         # print_and_log(
                         #     f"Attempt {auto_attempt_no}: Incorrect saturation fraction of {round(sat_frac, 3)} - at {image.integration_time_us / 1e6}s - trying at {new_integration_time_s}s")
+                        if metering_profile is not None and device.capture_profile != metering_profile:
+                            device.set_capture_profile(metering_profile)
                         device.integration_time(time=new_integration_time_s, time_unit=device_interface.SECONDS)
                         logger.info(f"Reattempting at {new_integration_time_s} s")
                         integration_time = new_integration_time_s
                         target_integration_time_us = integration_time * 1e6
+                        continue
+                    
+                    # print_and_log(f"Attempt {auto_attempt_no}: Correct saturation at {image.integration_time_us / 1e6}s")
+                    if auto_result == auto_exposure.LIMIT_REACHED:
+                        logger.warning(f"\tKeeping auto capture at {round(image.integration_time_secs, 5)} with saturation fraction of {round(sat_frac, 3)} - not used to seed later captures")
                     else:
-                        # print_and_log(f"Attempt {auto_attempt_no}: Correct saturation at {image.integration_time_us / 1e6}s")
                         logger.info(f"\tAuto capture successful at {round(image.integration_time_secs, 5)}. ({auto_attempt_no} attempts)")
-                        capture_successful = True
-                else:
-                    capture_successful = True
+                    if metering_profile is not None and device.capture_profile != current_routine.capture_profile:
+                        # Capture the session image at full profile with the accepted integration time
+                        metering_complete = True
+                        device.set_capture_profile(current_routine.capture_profile)
+                        target_integration_time_us = image.integration_time_us
+                        logger.info(f"\tCapturing image with {current_routine.capture_profile} capture profile")
+                        continue
+                
+                accepted_integration_time_s = image.integration_time_secs
+                if auto and current_routine.hdr_mode:
+                    # Bracket the accepted exposure and fuse the bracket into one HDR image
+                    stops = [stop for stop in current_routine.hdr_stops if stop != 0]
+                    with timer.phase("hdr_bracket_capture"):
+                        bracket_images = device.capture_bracket([(accepted_integration_time_s * 2**stop, device.gain()) for stop in stops],
+                                                                time_unit=device_interface.SECONDS)
+                    with timer.phase("hdr_fuse"):
+                        image = hdr.fuse([image, *bracket_images])
+                
+                if auto:
+                    image.set_auto_attempts(auto_attempt_no)
+                
+                capture_successful = True
+                # Add the pressure, depth, and temperature to the image and queue it on the finishing thread
+                finishing_thread.submit(finish_image, image, auto, current_routine.capture_progress)
+                if auto_result == auto_exposure.ACCEPTED:
+                    # Recorded with the gain the frame was captured at, not the gain staged for the next capture
+                    exposure_controller.accept(accepted_integration_time_s, gain=image.gain, depth=read_environment()[0])
+                    logger.info(f"\tMean auto exposure attempts per capture: {exposure_controller.mean_attempts:.2f}")
+                # The frame is queued, so the camera can move on to the next capture's settings
+                try:
+                    stage_settings(device, next_settings)
+                except Exception as e:
+                    logger.warning(f"\tCould not stage the next capture's settings - they will be set when it starts: {e}")
+
+            #Recorded against the integration time so the fixed overhead of a capture can be separated (see simulate.py)
+            timer.record("auto_capture_total" if auto else "capture_total", time() - capture_start, x=accepted_integration_time_s)
 
             logger.info(f"Captured Image #{current_routine.image_count}")
             logger.info(f"Timestamp: {image.time_string('%Y-%m-%d %H:%M:%S')}")
             logger.info(f"Integration Time: {image.integration_time_us / 1e6}s ")
 
         except Exception as e:
+            if current_routine.metering_profile is not None and device.capture_profile != current_routine.capture_profile:
+                device.set_capture_profile(current_routine.capture_profile)
             logger.error(f"Error Capturing Image {current_routine.image_count}")
             logger.exception(e)
             # print_and_log(f"Error Capturing Image {current_routine.image_count}")
@@ -288,56 +543,101 @@ def main(log_queue:queue.Queue=None):
             # log_error(e)
         
 
+    #Function to capture a bracket of images from the camera
+    #This function is passed to the routine object and is called instead of capture_image when the routine is in bracket mode
+    #Fixed integration time settings are captured together (using the camera sequencer where available), auto-adjust
+    #settings are captured individually afterwards
+    #Returns the number of images stored by each camera, as the routine counts images per capture rather than per camera
+    def capture_bracket(bracket:list[dict], capture_n=None) -> int:
+        return max(run_on_cameras(capture_camera_bracket, bracket))
+
+    def capture_camera_bracket(device:device_interface.Camera, exposure_controller:auto_exposure.ExposureController, bracket:list[dict]) -> int:
+        """
+        Capture a bracket of images with one camera and add them to the session queue.
+
+        Args:
+            device (device_interface.Camera): Camera to capture with.
+            exposure_controller (auto_exposure.ExposureController): Auto exposure controller of the camera.
+            bracket (list[dict]): Settings of each image, with "integration_time" in seconds and "gain" in dB.
+
+        Returns:
+            int: Number of images stored - one for a fused HDR bracket.
+        """
+        stored_count = 0
+        try:
+            nonlocal current_session
+            nonlocal current_routine
+
+            timer = current_routine.phase_timer
+            fixed = [settings for settings in bracket if settings["integration_time"] != 0]
+            auto = [settings for settings in bracket if settings["integration_time"] == 0]
+            logger.info(f"Capturing bracket of {len(fixed)} images (#{current_routine.image_count} of routine)")
+
+            if len(fixed) > 0:
+                capture_start = time()
+                with timer.phase("bracket_capture"):
+                    images = device.capture_bracket([(settings["integration_time"], settings["gain"]) for settings in fixed],
+                                                    time_unit=device_interface.SECONDS)
+                
+                for settings, image in zip(fixed, images):
+                    if image is None:
+                        logger.warning(f"\tNo image captured at {settings['integration_time']}s, gain {settings['gain']}")
+                captured_count = len([image for image in images if image is not None])
+                if current_routine.hdr_mode and captured_count > 1:
+                    # Store one fused HDR image rather than every exposure of the bracket
+                    with timer.phase("hdr_fuse"):
+                        images = [hdr.fuse(images)]
+                
+                # Each image gets the sensor values at the middle of its own exposure, on the finishing thread
+                for image in images:
+                    if image is not None:
+                        finishing_thread.submit(finish_image, image, False, current_routine.capture_progress)
+                        stored_count += 1
+                timer.record("bracket_total", time() - capture_start, x=sum(settings["integration_time"] for settings in fixed))
+                logger.info(f"\tCaptured {captured_count}/{len(fixed)} bracket images in {time() - capture_start:.3f}s - Queue size: {current_session.queue_length}")
+
+            for settings in auto:
+                capture_camera_image(device, exposure_controller, integration_time_secs=0, gain=settings["gain"], auto=True)
+                stored_count += 1
+        except Exception as e:
+            logger.error(f"Error Capturing Bracket {current_routine.image_count}")
+            logger.exception(e)
+        return stored_count
+
    
     #Set the location of the routine files
-    routine_dir=DATA_DIR / "routines"
+    try:
+        data_dir = config.data_directory()
+    except RuntimeError as e:
+        logger.critical(e)
+        raise RoutineError(str(e)) from e
+    routine_dir=data_dir / "routines"
     
     current_routine: routine.Routine = None
     
-    #For each text or yml file in the routine directory check if it can be parsed as a Routine 
-    #If it can and the name matches the passed in routine argument, set that as the routine to be used. 
+    #Find the routine by file path, file name or routine name. The routine directory is indexed by name (cached by
+    #file modification time), so only the selected routine is built.
     #When creating the routine, pass it the get_device_image function as its capture function.
     #Otherwise a dummy function is used which does not connect to the camera
-    
-    
     try:
-        current_routine = routine.from_file(routine_name, capture_function=capture_image)
-    except:
-        for filename in os.listdir(routine_dir):
-            if filename == routine_name:
-                try:
-                    current_routine = routine.from_file(Path(routine_dir) / filename, capture_function=capture_image)
-                    break
-                except Exception as e:
-                    pass
-                
-            if filename.rsplit(".",1)[1].lower() in ["txt", "yaml", "yml"]:
-                try:
-                    this_routine = routine.from_file(Path(routine_dir) / filename, capture_function=capture_image)
-                    if this_routine.name.replace(" ", "_") == routine_name.replace(" ", "_"):
-                        current_routine = this_routine
-                        break
-                except Exception as e:
-                    logger.warning(f"Routine file: {routine_dir}/{filename}")
-                    logger.exception(e)
-
-                    #print_and_log(f"Routine file: {routine_dir}/{filename}")
-                    #log_error(e)
-                    continue
+        current_routine = routine.RoutineIndex(routine_dir).load(routine_name, capture_function=capture_image, bracket_function=capture_bracket)
+    except Exception as e:
+        logger.error(f"Error loading routine {routine_name}")
+        logger.exception(e)
 
     #If no matching routine can be found, log an error and exit
     if current_routine is None:
        
-        logger.critical(f"Routine {routine_name} does not exist.\nMake sure routine name has no spaces\n Exiting.")
+        logger.critical(f"Routine {routine_name} does not exist.\nMake sure routine name has no spaces")
         #log_error(Exception(f"Routine {routine_name} not found"))
         #flush_stored_strings()
-        sys.exit(1)
+        raise RoutineError(f"Routine {routine_name} does not exist")
     
 
 
 
     #Set location of the session list file (It's in json format)
-    session_list_file= DATA_DIR / "sessions" / "session_list.json"
+    session_list_file= data_dir / "sessions" / "session_list.json"
     
     #Set empty variables to fill with session info
     session_path: Path = None
@@ -356,7 +656,7 @@ def main(log_queue:queue.Queue=None):
                     session_path = Path(session_dict[session_name]['directory_path']) / session_name.replace(" ", "_")
                     if session_path is not None and session_path.exists():
                         logger.info("Session Exists")
-                        current_session = session.from_file(session_path)
+                        current_session = session.from_file(session_path, log_queue=log_queue)
                         current_session.log_info()
                 else:
                     #If the session is not in the list, make a new session with that name. Session info such as coordinates/location
@@ -376,153 +676,196 @@ def main(log_queue:queue.Queue=None):
     
         #If a new session was created, add it to the session list file.
         if new_session:
-            current_session = session.Session(name=session_name, directory=DATA_DIR / "sessions", log_queue=log_queue)
+            current_session = session.Session(name=session_name, directory=data_dir / "sessions", log_queue=log_queue)
             
             logger.info(f"New Session Created in {current_session.parent_directory}")
             
     except Exception as e:
         logger.critical(f"Could not open session {session_name}")
         logger.critical(e, exc_info=True)
-        logger.critical("Exiting...")
         # log_error(e)
         # flush_stored_strings()
-        sys.exit(1)
+        raise RoutineError(f"Could not open session {session_name}") from e
   
   
   
 
             
+    #Continue the routine's plan after the last capture whose images were saved, e.g. after a power cut in autostart
+    #mode. Progress is cleared when a routine runs to its end, so a finished run (e.g. of a fixed autostart session name
+    #on every boot) starts again from the beginning rather than at the end of its plan.
+    resume_index = current_session.routine_progress.get(current_routine.name)
+    if (resume or auto_start) and resume_index is not None and resume_index < len(current_routine.plan):
+        current_routine.resume(resume_index)
+
     logger.info(f"Running routine {current_routine.name}...")
     logger.info(str(current_routine))
+    if on_start is not None:
+        on_start(current_routine)
+
+    #Start sampling the pressure sensor and record the stream to the session. In depth trigger mode each sample is
+    #also passed to the routine, which starts each iteration from the depth stream.
+    sample_rate = current_routine.sensor_sample_rate
+    if current_routine.trigger_mode == routine.DEPTH_TRIGGER:
+        sample_rate = max(sample_rate, 1 / routine.DEPTH_SAMPLE_INTERVAL_SECS)
+    sampler = pressure_sampler.PressureSampler(sensor, rate_hz=sample_rate, oversampling=current_routine.sensor_oversampling)
+    sampler.record_to(current_session.directory)
+    if current_routine.trigger_mode == routine.DEPTH_TRIGGER:
+        sampler.add_listener(current_routine.update_depth)
+    sampler.start()
+    complete = False
+    control_server:control.ControlServer = None
+    try:
     
-    #Run routine loop (see routine.py for more info on how this works)
-    #The routine uses a "tick" system. 
-    #
-    # A while loop is started, and on each "tick" the object checks the time since the routine 
-    # started and when the next capture should be to automatically capture photos
-    # using the settings defined in the routine file.
-    # It adds the capture settings to a queue which is processed by a separate thread.
-    # Each capture is added to the session queue with a timestamp and other data, including the pressure, temperature, etc. 
-    # Another thread defined in the sessions.py file processes the queue and saves the images to the session directory.
-    # The routine will continue to tick until the routine is complete or a stop signal is received.
-    # The stop signal can be sent from the console interface using runcam -x.
-    # The routine will then finish the current capture and stop.
-    # The session thread will finish processing the queue and save the images.
-
-    #The program uses Named Pipes to communicate with the console interface. This allows the interface to send a stop signal to the script, 
-    #and for the script to send messages back to the interface allowing the user to view the progress of the current capture routine using "runcam -q"
-    # or "runcam -l" to view the live output log.
+        #Run routine loop (see routine.py for more info on how this works)
+        #The routine uses a "tick" system. 
+        #
+        # A while loop is started, and on each "tick" the object checks the time since the routine 
+        # started and when the next capture should be to automatically capture photos
+        # using the settings defined in the routine file.
+        # It adds the capture settings to a queue which is processed by a separate thread.
+        # Each capture is added to the session queue with a timestamp and other data, including the pressure, temperature, etc. 
+        # Another thread defined in the sessions.py file processes the queue and saves the images to the session directory.
+        # The routine will continue to tick until the routine is complete or a stop signal is received.
+        # The stop signal can be sent from the console interface using runcam -x.
+        # The routine will then finish the current capture and stop.
+        # The session thread will finish processing the queue and save the images.
+
+        #The console interface talks to the script over a Unix socket (see control.py). The interface can request the
+        #status of the routine ("aegir -q"), stop, pause or resume it ("aegir -x"), or subscribe to status updates and
+        #the live output log ("aegir -l"). Updates are pushed to subscribers as they happen, so nothing is written
+        #while no one is listening. When the routine is run by the daemon, the daemon serves the socket.
+        if routine_control is None:
+            routine_control = control.RoutineControl()
+
+            def handle_request(request:dict) -> dict:
+                if request["command"] == "ping":
+                    return {"ok": True, "daemon": False}
+                return routine_control.handle(request)
+
+            try:
+                control_server = control.ControlServer(handle_request, routine_control=routine_control).start()
+            except RuntimeError as e:
+                logger.critical(e)
+                raise RoutineError(str(e)) from e
+            log_publisher = control.LogPublisher(routine_control)
+            log_publisher.setFormatter(logging.Formatter(fmt='%(asctime)s - %(levelname)8s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S"))
+            logger.addHandler(log_publisher)
+
+        def routine_status() -> dict:
+            """Status of the routine for the control socket (see control.format_status)."""
+            status = {"routine": current_routine.name,
+                      "session": current_session.name_no_spaces,
+                      "runtime_secs": current_routine.run_time,
+                      "image_count": current_routine.image_count,
+                      "stored_count": current_routine.stored_count,
+                      "plan_length": len(current_routine.plan),
+                      "queue_size": current_session.queue_length,
+                      "paused": current_routine.paused.is_set(),
+                      "stopping": current_routine.stop_signal.is_set(),
+                      "phases": current_routine.phase_timer.summary()}
+            if current_routine.trigger_mode == routine.DEPTH_TRIGGER and current_routine.depth is not None:
+                status.update({"depth": current_routine.depth, "descent_rate": current_routine.descent_rate,
+                               "trigger_count": current_routine.trigger_count, "awaiting_trigger": current_routine.awaiting_trigger})
+            if current_routine.cadence is not None:
+                status.update({"interval_secs": current_routine.cadence.interval_secs, "scene_changes": current_routine.cadence.change_count,
+                               "skipped_unchanged": current_routine.cadence.skipped_count})
+            return status
+
+        def stop_routine() -> str:
+            logger.info("Received STOP Message")
+            current_routine.stop()
+            routine_control.publish(control.STOPPING_EVENT)
+            if current_routine.capturing_images.is_set():
+                logger.info("Waiting for image capture to finish...")
+                return "Stopping - waiting for image capture to finish"
+            logger.info("Stopping")
+            return "Stopping"
+
+        def pause_routine() -> str:
+            logger.info("Received PAUSE Message")
+            current_routine.pause()
+            routine_control.publish(control.PAUSED_EVENT)
+            return "Paused"
+
+        def resume_routine() -> str:
+            logger.info("Received RESUME Message")
+            current_routine.unpause()
+            routine_control.publish(control.RESUMED_EVENT)
+            return "Resumed"
+
+        routine_control.attach(routine_status, {"stop": stop_routine, "pause": pause_routine, "resume": resume_routine}, wake_function=current_routine.notify)
     
+        #Collect the timings of each capture phase, and of saving images, for this routine
+        current_session.timer = current_routine.phase_timer
+        for device in devices:
+            device.timer = current_routine.phase_timer
 
-    if not os.path.exists(PIPE_IN_FILE):
-        os.mkfifo(PIPE_IN_FILE)
+            #Set the camera to continuous acquisition mode and turn off auto integration and gain
+            try:
+                device.set_capture_profile(current_routine.capture_profile)
+            except ValueError as e:
+                logger.critical(f"Routine capture profile '{current_routine.capture_profile}' is invalid")
+                raise RoutineError(f"Routine capture profile '{current_routine.capture_profile}' is invalid")
+            device.set_bit_depth(current_routine.bit_depth, packed=current_routine.packed_pixels)
+            device.gain(1)
+            device.change_sensor_mode(device_interface.DEFAULT)
+            if current_routine.optimise_plan:
+                _, _, default_max_s = device.integration_time_range(time_unit=device_interface.SECONDS)
+                if default_max_s is not None and abs(default_max_s - current_routine.long_exposure_threshold_secs) > 0.01*default_max_s:
+                    logger.warning(f"Routine long_exposure_threshold of {current_routine.long_exposure_threshold_secs}s does not match the camera's DEFAULT sensor mode maximum of {default_max_s}s - the plan may not minimise mode switches")
+            device.integration_time(time=current_routine.plan[min(current_routine.position, len(current_routine.plan)-1)][0], time_unit=device_interface.SECONDS)
         
-    if not os.path.exists(PIPE_OUT_FILE):
-        os.mkfifo(PIPE_OUT_FILE)
-    
-    #Set the camera to continuous acquisition mode and turn off auto integration and gain
-    device.gain(1)
-    device.change_sensor_mode(device_interface.DEFAULT)
-    device.integration_time(time=current_routine.int_times_seconds[0], time_unit=device_interface.SECONDS)
-    
-    device.start_acquisition(mode=device_interface.CONTINUOUS)
-    
-    device.set_to_manual()
+            device.start_acquisition(mode=device_interface.CONTINUOUS)
+        
+            device.set_to_manual()
     
-    sleep(0.5)
-
-    complete = False
+        sleep(0.5)
 
-    #Set up variables for checking the time and the number of consecutive errors
-    consecutive_error_count = 0
+        #Set up variables for checking the time and the number of consecutive errors
+        consecutive_error_count = 0
 
 
-    in_pipe_fd = os.open(PIPE_IN_FILE, os.O_RDONLY | os.O_NONBLOCK)
-      
+        # set the time variables to the current time. The loop and run any code in intervals of long_check_length and short_check_length
+        check_time_long = time()
+        long_check_length = 300
+        check_time_short = time()
+        short_check_length = 1
     
-    def write_to_pipe(message:str):
-        """
-        Writes a message to a named pipe for communication with the console interface.
-
-        Args:
-            message (str): The message to be written to the named pipe.
+        #Start the session thread to process the queue
+        current_session.start_processing_queue()
 
-        Raises:
-            OSError: If there is an error opening or closing the named pipe.
-            Exception: If there is an error passing the message to the named pipe.
+        #Image count of the last status update sent to subscribers, so an update is also sent after each capture
+        published_image_count = None
 
-        Returns:
-            None
-        """
-        try:
-            out_pipe_fd = os.open(PIPE_OUT_FILE, os.O_WRONLY | os.O_NONBLOCK)
-            with os.fdopen(out_pipe_fd, "w") as out_pipe:
-                out_pipe.write(message)
-            os.close(out_pipe_fd)  
-            logger.info("Successfully passed message " + message)
-        except OSError:
-            pass
-        except Exception as e:
-            logger.error("Error passing message to named pipe")
-            logger.exception(e)
-    
-    # set the time variables to the current time. The loop and run any code in intervals of long_check_length and short_check_length
-    check_time_long = time()
-    long_check_length = 300
-    check_time_short = time()
-    short_check_length = 1
-    
-    #Start the session thread to process the queue
-    current_session.start_processing_queue()
-
-    #Main loop
-    with os.fdopen(in_pipe_fd) as in_pipe: #Open the named pipe for reading
-        in_pipe.read()
+        #Main loop - sleeps until a capture is due, the capture thread finishes, a command arrives, or a status update
+        #is due while anyone is subscribed
         while not complete: #Loop until the routine is complete or a stop signal is received
             try:
+                if routine_control.subscriber_count > 0:
+                    status_due = max(0, short_check_length - (time() - check_time_short))
+                else:
+                    status_due = max(0, long_check_length - (time() - check_time_long))
+                current_routine.wait_for_event(timeout=status_due)
 
-                # Check for stop message
-                message = in_pipe.read()
-                if message:
-                    
-                    if message == "STOP":
-                        logger.info("Received STOP Message")
-                        current_routine.stop_signal.set()
-                        current_routine.end_capture_thread()
-                        if current_routine.capturing_images.is_set():
-                            logger.info("Waiting for image capture to finish...")
-                        else: 
-                            logger.info("Stopping")
-                        for i in range(10):
-                            write_to_pipe("STOPPING")
-                            sleep(0.2)
-                    else:
-                        logger.info(f"Received Message: {message}")
-                        
-                        
-
-                
                 if not current_routine.stop_signal.is_set():   
                     if time() - check_time_long > long_check_length:
-                        logger.info(f"Runtime: {str(timedelta(seconds=int(current_routine.run_time)))} Device Temp: {device.temperature}°C  Depth: {get_depth():.2f}m Pressure Sensor Temp: {get_temp():.2f}°C")
+                        depth, _, temperature = read_environment()
+                        logger.info(f"Runtime: {str(timedelta(seconds=int(current_routine.run_time)))} Device Temp: {', '.join([f'{device.temperature}°C' for device in devices])}  Depth: {depth:.2f}m Pressure Sensor Temp: {temperature:.2f}°C")
                         check_time_long = time()
 
     
-                if time() - check_time_short > short_check_length:
+                if routine_control.subscriber_count > 0 and (time() - check_time_short > short_check_length or current_routine.image_count != published_image_count):
                     check_time_short = time()
+                    published_image_count = current_routine.image_count
                     try:
-                        message = f"Routine: {current_routine.name}\nSession: {current_session.name_no_spaces}\nRuntime: {str(timedelta(seconds=int(current_routine.run_time)))}\nImages Captured: {current_routine.image_count}\nImage Save Queue Size: {current_session.queue_length}\n"
-                        if current_routine.stop_signal.is_set():
-                            message  += "\nSTOPPING\n"
-                        write_to_pipe(message)
+                        routine_control.publish(control.STATUS_EVENT, status=routine_status())
                     except Exception as e:
-                        pass
+                        logger.warning("Could not publish routine status")
+                        logger.exception(e)
 
                 #current_session.run_and_log(current_routine.tick)
                 current_routine.tick()
-                
-                
-                
                 complete = current_routine.complete.is_set()
                 consecutive_error_count = 0
                 
@@ -536,14 +879,61 @@ def main(log_queue:queue.Queue=None):
                 
                 logger.warning(f"Error count: {consecutive_error_count}")
                 if consecutive_error_count > 5:
-                    logger.critical("AEGIR: Too many consecutive tick errors. Exiting")
+                    logger.critical("AEGIR: Too many consecutive tick errors")
                     
-                    sys.exit(1)
-    logger.info(f"Completion Reason: {current_routine.stop_reason}")
-    device.stop_acquisition()
-    current_routine.complete.wait()
-    current_session.stop_processing_queue()
-    logger.info(f"Complete at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+                    raise RoutineError("Too many consecutive tick errors")
+        logger.info(f"Completion Reason: {current_routine.stop_reason}")
+        current_routine.complete.wait()
+    finally:
+        #Each step is run even if an earlier one fails (e.g. on an unresponsive camera), so the session's log
+        #listener, the control socket and the routine are always released
+        def write_timings():
+            current_routine.phase_timer.write(current_session.timings_file_path,
+                                              details={"start_time": datetime.fromtimestamp(current_routine.start_time).strftime('%Y-%m-%d %H:%M:%S'),
+                                                       "image_count": current_routine.image_count,
+                                                       "stored_count": current_routine.stored_count})
+            logger.info(f"Complete at {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
+
+        def clear_progress():
+            #The routine ran to its end, so the next run of it in this session starts from the beginning
+            if current_session.routine_progress.pop(current_routine.name, None) is not None:
+                current_session.write_to_log()
+
+        def stop_control_server():
+            logger.removeHandler(log_publisher)
+            control_server.stop()
+
+        cleanup_steps = []
+        if not complete:
+            #Abandoned after an error - finish the current capture before the cameras are released
+            cleanup_steps += [("stop routine", lambda: current_routine.stop("Abandoned after an error")),
+                              ("end capture thread", current_routine.end_capture_thread)]
+        cleanup_steps += [("shut down camera thread", lambda camera_thread=camera_thread: camera_thread.shutdown(wait=True)) for camera_thread in camera_threads]
+        cleanup_steps += [("shut down finishing thread", lambda: finishing_thread.shutdown(wait=True)),
+                          ("stop pressure sampler", sampler.stop)]
+        cleanup_steps += [(f"stop acquisition of camera {device.camera_id or ''}".strip(), device.stop_acquisition) for device in devices]
+        cleanup_steps += [("stop processing queue", lambda: current_session.stop_processing_queue() if current_session.processing_queue.is_set() else None)]
+        if complete:
+            cleanup_steps += [("write timings", write_timings)]
+            if current_routine.finished:
+                cleanup_steps += [("clear routine progress", clear_progress)]
+        cleanup_steps += [("publish completion", lambda: routine_control.publish(control.COMPLETE_EVENT, reason=current_routine.stop_reason)),
+                          ("detach routine control", routine_control.detach)]
+        if control_server is not None:
+            cleanup_steps += [("stop control server", stop_control_server)]
+        cleanup_steps += [("close routine", current_routine.close),
+                          ("close session log", current_session.close_log)]
+        _run_cleanup_steps(cleanup_steps)
+
+
+def _run_cleanup_steps(steps:list[tuple[str, callable]]):
+    #Run every step, logging the failures rather than raising them
+    for description, step in steps:
+        try:
+            step()
+        except Exception as e:
+            logger.error(f"Could not {description} while finishing the routine")
+            logger.exception(e)
 
 
 #Wrapper code for running this script.
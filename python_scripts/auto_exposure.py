@@ -0,0 +1,246 @@
+import math
+import logging
+import numpy as np
+from time import time
+
+logger = logging.getLogger()
+
+#Results of evaluating a metering frame
+ACCEPTED = "accepted"
+""" The saturation fraction is within the target band """
+RETRY = "retry"
+""" The saturation fraction is outside the target band - try again at the predicted integration time """
+LIMIT_REACHED = "limit_reached"
+""" The saturation fraction is outside the target band but the attempt limit has been reached - the frame is kept, but not recorded as an accepted exposure """
+
+
+class ExposureController:
+    """Predictive auto-exposure controller.
+
+    Rather than nudging the integration time by a bounded factor on each attempt, the controller
+    uses the histogram of the active area to model how the saturation fraction would change with
+    integration time. Pixel values scale (close to) linearly with integration time, so the value
+    of the pixel at the target saturation percentile tells us how far the integration time needs
+    to move for that pixel to reach the saturation threshold. In most cases this lands within the
+    target band in one or two attempts.
+
+    Accepted exposures are kept in a short history so the first guess of the next capture can be
+    seeded from the last accepted exposure, extrapolated along the depth trend or the trend over time.
+    Frames kept only because the attempt limit was reached are not added to the history.
+    """
+
+    def __init__(self,
+                 target_fraction:float=0.01,
+                 min_fraction:float=0.005,
+                 max_fraction:float=0.02,
+                 saturation_threshold:int=250,
+                 black_level:float=0.0,
+                 max_attempts:int=10,
+                 min_factor:float=0.01,
+                 max_factor:float=100,
+                 mode_switch_hysteresis:float=0.25,
+                 history_length:int=20) -> None:
+        """
+        Args:
+            target_fraction (float, optional): Fraction of active-area pixels that should be saturated. Defaults to 0.01.
+            min_fraction (float, optional): Lower bound of the accepted saturation fraction band. Defaults to 0.005.
+            max_fraction (float, optional): Upper bound of the accepted saturation fraction band. Defaults to 0.02.
+            saturation_threshold (int, optional): Pixel value above which a pixel counts as saturated, for 8-bit images.
+                Scaled to the bit depth of the histogram for higher bit depth images. Defaults to 250.
+            black_level (float, optional): Pixel value of an unexposed pixel, for 8-bit images. Defaults to 0.
+            max_attempts (int, optional): Attempts before the last frame is kept regardless (see LIMIT_REACHED). Defaults to 10.
+            min_factor (float, optional): Smallest factor the integration time can be multiplied by in one step. Defaults to 0.01.
+            max_factor (float, optional): Largest factor the integration time can be multiplied by in one step. Defaults to 100.
+            mode_switch_hysteresis (float, optional): Fraction above the default sensor mode maximum within which the
+                integration time is clamped to that maximum rather than switching to the long exposure mode. Defaults to 0.25.
+            history_length (int, optional): Number of accepted exposures kept for seeding. Defaults to 20.
+        """
+        self.target_fraction = target_fraction
+        self.min_fraction = min_fraction
+        self.max_fraction = max_fraction
+        self.saturation_threshold = saturation_threshold
+        self.black_level = black_level
+        self.max_attempts = max_attempts
+        self.min_factor = min_factor
+        self.max_factor = max_factor
+        self.mode_switch_hysteresis = mode_switch_hysteresis
+        self.history_length = history_length
+
+        self.min_time_secs:float = None
+        self.max_time_secs:float = None
+        self.mode_boundary_secs:float = None
+
+        #Accepted exposures as (timestamp, depth, gain normalised integration time)
+        self.history:list[tuple] = []
+        #Record of each attempt of the current capture
+        self.attempts:list[dict] = []
+        #Number of attempts taken for each completed capture
+        self.attempt_counts:list[int] = []
+
+    def set_limits(self, min_time_secs:float=None, max_time_secs:float=None, mode_boundary_secs:float=None):
+        """Set the integration time limits of the camera.
+
+        Args:
+            min_time_secs (float, optional): Shortest integration time over all sensor modes.
+            max_time_secs (float, optional): Longest integration time over all sensor modes.
+            mode_boundary_secs (float, optional): Longest integration time available without switching to the long exposure sensor mode.
+        """
+        self.min_time_secs = min_time_secs
+        self.max_time_secs = max_time_secs
+        self.mode_boundary_secs = mode_boundary_secs
+
+    def seed(self, gain:float=1, depth:float=None, default:float=None) -> float:
+        """Get a first guess integration time for a new capture.
+
+        Uses the last accepted exposure. If the recent history covers a range of depths, the log of the
+        integration time is fitted linearly against depth (light attenuates exponentially with depth) and
+        extrapolated to the current depth. Otherwise the recent trend over time is followed, which tracks
+        slow changes in ambient light such as dusk.
+
+        Args:
+            gain (float, optional): Gain in dB the capture will use. Defaults to 1.
+            depth (float, optional): Current depth in metres. Defaults to None.
+            default (float, optional): Value returned if there is no history. Defaults to None.
+
+        Returns:
+            float: Suggested integration time in seconds.
+        """
+        self.attempts = []
+        if len(self.history) == 0:
+            return default
+
+        timestamps = np.array([entry[0] for entry in self.history])
+        depths = np.array([entry[1] if entry[1] is not None else np.nan for entry in self.history])
+        log_times = np.log(np.array([entry[2] for entry in self.history]))
+
+        log_prediction = log_times[-1]
+
+        recent = slice(-min(len(self.history), 5), None)
+        recent_depths = depths[recent]
+        if depth is not None and not np.isnan(recent_depths).any() and np.ptp(recent_depths) > 0.5:
+            slope, intercept = np.polyfit(recent_depths, log_times[recent], 1)
+            log_prediction = slope*depth + intercept
+        elif len(self.history) >= 2 and timestamps[-1] > timestamps[-2]:
+            rate = (log_times[-1] - log_times[-2]) / (timestamps[-1] - timestamps[-2])
+            log_prediction = log_times[-1] + rate*(time() - timestamps[-1])
+
+        #Don't let an extrapolation stray too far from the last accepted exposure
+        log_prediction = min(log_times[-1] + math.log(4), max(log_times[-1] - math.log(4), log_prediction))
+
+        return self._clamp(math.exp(log_prediction) / gain_to_linear(gain))
+
+    def evaluate(self, histogram:np.ndarray, integration_time_secs:float) -> tuple[str, float, float]:
+        """Check a metering histogram and predict the integration time that reaches the target saturation fraction.
+
+        Args:
+            histogram (np.ndarray): Pixel value histogram of the active area, with one bin per pixel value
+                (256 bins for 8-bit images, 4096 for 12-bit, etc).
+            integration_time_secs (float): Integration time the histogram was captured with.
+
+        Returns:
+            tuple[str, float, float]: The result (ACCEPTED, RETRY or LIMIT_REACHED), the saturation fraction, and the
+            integration time in seconds to use for the next attempt (the same time unless the result is RETRY).
+        """
+        histogram = np.asarray(histogram, dtype=np.float64)
+        total = histogram.sum()
+        #Fraction of pixels with a value greater than or equal to each level
+        tail = np.cumsum(histogram[::-1])[::-1] / max(total, 1)
+        #Scale the 8-bit thresholds to the bit depth of the histogram
+        level_scale = max(1, tail.size // 256)
+        threshold = int(round((self.saturation_threshold + 1) * level_scale)) - 1
+        black_level = self.black_level * level_scale
+        saturation_fraction = float(tail[threshold + 1]) if threshold + 1 < tail.size else 0.0
+
+        accepted = self.min_fraction < saturation_fraction < self.max_fraction
+        if accepted:
+            result = ACCEPTED
+            new_time = integration_time_secs
+        elif len(self.attempts) + 1 >= self.max_attempts:
+            logger.warning(f"\tAuto exposure attempt limit of {self.max_attempts} reached - keeping last attempt")
+            result = LIMIT_REACHED
+            new_time = integration_time_secs
+        else:
+            result = RETRY
+            new_time = self._clamp(integration_time_secs * self._predict_factor(tail, saturation_fraction, threshold, black_level))
+
+        self.attempts.append({"attempt": len(self.attempts) + 1,
+                              "integration_time_secs": integration_time_secs,
+                              "saturation_fraction": saturation_fraction,
+                              "next_integration_time_secs": new_time,
+                              "accepted": accepted})
+        if result != RETRY:
+            self.attempt_counts.append(len(self.attempts))
+        return result, saturation_fraction, new_time
+
+    def accept(self, integration_time_secs:float, gain:float=1, depth:float=None):
+        """Record the accepted exposure of a capture, to seed later captures. Only call for an ACCEPTED result.
+
+        Args:
+            integration_time_secs (float): Accepted integration time in seconds.
+            gain (float, optional): Gain in dB. Defaults to 1.
+            depth (float, optional): Depth in metres. Defaults to None.
+        """
+        self.history.append((time(), depth, integration_time_secs * gain_to_linear(gain)))
+        self.history = self.history[-self.history_length:]
+
+    @property
+    def mean_attempts(self) -> float:
+        """Mean number of attempts per auto exposure capture."""
+        if len(self.attempt_counts) == 0:
+            return 0.0
+        return float(np.mean(self.attempt_counts))
+
+    def _predict_factor(self, tail:np.ndarray, saturation_fraction:float, threshold:int, black_level:float) -> float:
+        """Predict the factor the integration time should be multiplied by to reach the target saturation fraction.
+        """
+        signal_threshold = threshold - black_level
+
+        if saturation_fraction <= self.target_fraction:
+            #The pixel at the target percentile is unsaturated. Find its value and scale so it reaches the threshold.
+            level = int(np.argmax(tail <= self.target_fraction))
+            signal = level - black_level
+            if signal <= 1:
+                return self.max_factor
+            factor = signal_threshold / signal
+        else:
+            #The target percentile is hidden above the threshold. Extrapolate the top of the histogram as a power law,
+            #using the threshold (reached by saturation_fraction of the pixels) and the level reached by a larger fraction.
+            if saturation_fraction >= 0.5:
+                return self.min_factor
+            wider_fraction = min(0.5, 4*saturation_fraction)
+            wider_level = int(np.argmax(tail <= wider_fraction))
+            wider_signal = max(wider_level - black_level, 1)
+            exponent = math.log(signal_threshold / wider_signal) / math.log(wider_fraction / saturation_fraction)
+            target_signal = signal_threshold * (saturation_fraction / self.target_fraction)**exponent
+            factor = signal_threshold / target_signal
+
+        return min(self.max_factor, max(self.min_factor, factor))
+
+    def _clamp(self, integration_time_secs:float) -> float:
+        """Clamp an integration time to the camera limits.
+
+        Times just above the longest integration time of the default sensor mode are clamped to that time,
+        as switching to the long exposure mode costs far more than the small difference in exposure.
+        """
+        if self.mode_boundary_secs is not None:
+            if self.mode_boundary_secs < integration_time_secs <= self.mode_boundary_secs * (1 + self.mode_switch_hysteresis):
+                integration_time_secs = self.mode_boundary_secs
+        if self.min_time_secs is not None:
+            integration_time_secs = max(self.min_time_secs, integration_time_secs)
+        if self.max_time_secs is not None:
+            integration_time_secs = min(self.max_time_secs, integration_time_secs)
+        return integration_time_secs
+
+
+def gain_to_linear(gain:float) -> float:
+    """Convert a gain in dB to a linear amplitude factor.
+
+    Args:
+        gain (float): Gain in dB.
+
+    Returns:
+        float: Linear gain factor.
+    """
+    if gain is None:
+        return 1.0
+    return 10**(gain/20)
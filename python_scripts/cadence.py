@@ -0,0 +1,120 @@
+import logging
+import threading
+from time import time
+
+logger = logging.getLogger()
+
+
+class AdaptiveCadence:
+    """Stretches the interval between captures while the scene is unchanged and snaps it back when it changes.
+
+    Each captured frame is reduced to two cheap statistics which are already calculated for the session log: the
+    luminance of the active area normalised by the exposure (so frames of different integration times and gains can be
+    compared) and the fraction of saturated pixels in the active area. A frame is compared with a reference frame
+    taken with the same settings: the last frame which changed, refreshed every [store_interval_secs] so slow drifts
+    (e.g. dawn) are followed without being counted as changes. If any frame of an iteration has changed by more than the tolerances, the next
+    interval is the minimum, otherwise the interval grows by [growth] each iteration up to the maximum.
+
+    Frames within tolerance of the reference can optionally be skipped rather than stored. The refreshed references
+    are still stored, so a long unchanged period is recorded by one frame of each setting every [store_interval_secs].
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self,
+                 min_interval_secs:float,
+                 max_interval_secs:float,
+                 growth:float=2.0,
+                 luminance_tolerance:float=0.1,
+                 saturation_tolerance:float=0.005,
+                 skip_unchanged:bool=False,
+                 store_interval_secs:float=None) -> None:
+        """
+        Args:
+            min_interval_secs (float): Interval while the scene is changing
+            max_interval_secs (float): Longest interval while the scene is unchanged
+            growth (float, optional): Factor the interval is multiplied by for each unchanged iteration. Defaults to 2.
+            luminance_tolerance (float, optional): Relative change in exposure normalised luminance counted as a change. Defaults to 0.1.
+            saturation_tolerance (float, optional): Change in the saturated fraction of the active area counted as a change. Defaults to 0.005.
+            skip_unchanged (bool, optional): Skip storing frames within tolerance of the reference. Defaults to False.
+            store_interval_secs (float, optional): Time after which the reference of a setting is refreshed (and stored
+                when skipping unchanged frames). Defaults to max_interval_secs.
+        """
+        self.min_interval_secs = max(0.0, min_interval_secs)
+        self.max_interval_secs = max(self.min_interval_secs, max_interval_secs)
+        self.growth = max(1.0, growth)
+        self.luminance_tolerance = luminance_tolerance
+        self.saturation_tolerance = saturation_tolerance
+        self.skip_unchanged = skip_unchanged
+        self.store_interval_secs = self.max_interval_secs if not store_interval_secs else store_interval_secs
+
+        self.interval_secs:float = self.min_interval_secs
+        #Whether any frame has changed since the interval was last updated (starts True so the first interval is the minimum)
+        self.changed = True
+        #Statistics of the reference frame of each setting as (luminance, saturation fraction, time stored)
+        self._reference:dict = {}
+        self._lock = threading.Lock()
+        self.stored_count = 0
+        self.skipped_count = 0
+        self.change_count = 0
+
+    def __str__(self) -> str:
+        string = f"{self.min_interval_secs}s to {self.max_interval_secs}s (x{self.growth} per unchanged iteration"
+        string += f", luminance tolerance {self.luminance_tolerance*100:g}%, saturation tolerance {self.saturation_tolerance:g})"
+        if self.skip_unchanged:
+            string += f", skipping unchanged frames (one stored every {self.store_interval_secs}s)"
+        return string
+
+    def is_change(self, reference:tuple, luminance:float, saturation_fraction:float) -> bool:
+        """Whether a frame's statistics differ from a reference frame's by more than the tolerances."""
+        reference_luminance, reference_saturation = reference[:2]
+        scale = max(abs(luminance), abs(reference_luminance))
+        if scale > 0 and abs(luminance - reference_luminance) / scale > self.luminance_tolerance:
+            return True
+        return abs(saturation_fraction - reference_saturation) > self.saturation_tolerance
+
+    def observe(self, key, luminance:float, saturation_fraction:float, timestamp:float=None) -> tuple[bool, bool]:
+        """Compare a frame with the reference frame of the same settings.
+
+        Args:
+            key: Settings of the frame (e.g. camera, integration time and gain). Frames are only compared with frames of the same key.
+            luminance (float): Luminance of the active area divided by the integration time and linear gain
+            saturation_fraction (float): Fraction of saturated pixels in the active area
+            timestamp (float, optional): Time of the frame (as time.time()). Defaults to now.
+
+        Returns:
+            tuple[bool, bool]: Whether the frame is a change, and whether it should be stored
+        """
+        timestamp = time() if timestamp is None else timestamp
+        with self._lock:
+            reference = self._reference.get(key)
+            changed = reference is None or self.is_change(reference, luminance, saturation_fraction)
+            refresh = changed or timestamp - reference[2] >= self.store_interval_secs
+            store = refresh or not self.skip_unchanged
+            if changed:
+                self.changed = True
+                if reference is not None:
+                    self.change_count += 1
+            if refresh:
+                self._reference[key] = (luminance, saturation_fraction, timestamp)
+            if store:
+                self.stored_count += 1
+            else:
+                self.skipped_count += 1
+        return changed, store
+
+    def next_interval(self) -> float:
+        """Interval before the next capture. Called once per iteration: returns the minimum if anything changed since
+        the last call, otherwise the last interval multiplied by the growth factor.
+
+        Returns:
+            float: Interval in seconds
+        """
+        with self._lock:
+            if self.changed:
+                self.interval_secs = self.min_interval_secs
+            else:
+                #A minimum of 0 (capture as soon as possible) grows from 1 second
+                self.interval_secs = min(self.max_interval_secs, self.interval_secs * self.growth if self.interval_secs > 0 else 1.0)
+            self.changed = False
+            return self.interval_secs
@@ -9,7 +9,15 @@ import logging
 import math
 
 import luminance
+import pixel_formats
 
+#Active area of the sensor (the circle lit through the fisheye lens) in full resolution sensor pixels
+#temporary values hardcoded in now
+#TODO load in from json or similar
+ACTIVE_AREA_CENTRE = (1226, 1034)
+ACTIVE_AREA_RADIUS = 472
+#Margin around the active area excluded from the outer region to avoid light bleed, in full resolution sensor pixels
+ACTIVE_AREA_MARGIN = 100
 
 
 class Resources:
@@ -46,7 +54,7 @@ class Resources:
 
 class Cam_Image:
     
-    def __init__(self, image:np.ndarray, timestamp:datetime, integration_time_us:int, gain:float, aperture:float, format:str,  auto:bool=None, number:int=None, depth:float=None, pressure:float=None, cam_temp:float=None, environment_temp:float=None,  saturation_threshold:int=250, debayer_method:str = "average_greens", target_saturation_fraction:float=0.01, target_saturation_margin:float=0.005) -> None:
+    def __init__(self, image:np.ndarray, timestamp:datetime, integration_time_us:int, gain:float, aperture:float, format:str,  auto:bool=None, auto_attempts:int=None, number:int=None, depth:float=None, pressure:float=None, cam_temp:float=None, environment_temp:float=None,  saturation_threshold:int=None, debayer_method:str = "average_greens", target_saturation_fraction:float=0.01, target_saturation_margin:float=0.005, offset:tuple=(0, 0), scale:int=1, camera_id:str=None, fused_frames:int=None, storage_format:str=None) -> None:
         """Create Cam_Image object which contains an Image and a combination of pre-set and calculated metadata.
 
         Args:
@@ -56,6 +64,12 @@ class Cam_Image:
             gain (float): gain in dB
             depth (float): depth below surface when image was captured
             temp (float): Temperature of device when image was captured
+            offset (tuple): (x, y) position of the top left of the image on the sensor in full resolution pixels, if captured with a region of interest
+            scale (int): Number of sensor pixels along each axis combined into one image pixel by on-camera binning or decimation
+            camera_id (str): Label of the camera which captured the image, if several cameras are used
+            saturation_threshold (int): Pixel value above which a pixel counts as saturated. Defaults to 250 for 8-bit formats, scaled to the bit depth of the format.
+            fused_frames (int): Number of exposures fused into the image, if it is a fused HDR image (see hdr.py)
+            storage_format (str): How the image is saved, pixel_formats.RGB_STORAGE or RAW_STORAGE. Defaults to RGB_STORAGE. Images deeper than 8 bits are always stored raw.
         """        
         try:
             
@@ -84,8 +98,16 @@ class Cam_Image:
             
             self._number = number if number is not None else -1
             
+            self._offset :tuple = tuple(offset)
+            self._scale :int = scale
+            
+            #Pixel values use the bit depth of the format (8-bit formats in uint8, 10 and 12-bit formats in uint16)
+            self._bit_depth :int = pixel_formats.bit_depth(format)
+            self._max_value :int = 2**self._bit_depth - 1
+            self._storage_format :str = pixel_formats.storage_format(storage_format, self._bit_depth)
+            
             #remove extra empty dimensions
-            image = image.squeeze().astype(np.uint8)
+            image = image.squeeze().astype(np.uint8 if self._bit_depth == 8 else np.uint16)
             
             self._original_image_array = image.copy()
             
@@ -93,6 +115,8 @@ class Cam_Image:
             self.target_saturation_fraction = target_saturation_fraction
             self.target_saturation_margin = target_saturation_margin
             
+            if saturation_threshold is None:
+                saturation_threshold = pixel_formats.scale_threshold(250, self._bit_depth)
             self.saturation_threshold = saturation_threshold
             
             #Debayer (demosaic) image using cv2 colour conversion function
@@ -102,11 +126,11 @@ class Cam_Image:
             
             self._channels = ['R', 'G', 'B']
             
-            if self._format != "BayerRG8":
+            if not pixel_formats.is_bayer(self._format):
                 self._channels = None
                 self._image_array = self.original_image_array.copy()
-                #Assume image mode is L (greyscale) unless the format is BayerRG8
-                self._image = Image.fromarray(self._image_array, mode="L")
+                #Assume image mode is greyscale unless the format is a Bayer format
+                self._image = Image.fromarray(self._image_array, mode="L" if self._bit_depth == 8 else None)
             
 
             self._timestamp : datetime = timestamp
@@ -115,6 +139,7 @@ class Cam_Image:
             self._integration_time_secs : float = integration_time_us/1e6
             self._aperture : float = aperture
             self._auto : bool = auto
+            self._auto_attempts : int = auto_attempts
             
             self._gain : float = gain
             
@@ -126,6 +151,10 @@ class Cam_Image:
             
             self._environment_temp : float = environment_temp
             
+            self._camera_id : str = camera_id
+            
+            self._fused_frames : int = fused_frames
+            
         except Exception as e:
             logging.exception(f"(Cam_Image #{number}): Error creating Cam_Image instance")
             
@@ -136,40 +165,29 @@ class Cam_Image:
         if self._image_array is not None:
             return
         self._image_array = self.original_image_array.copy()
-        mode = "L"
-        if self.format=="BayerRG8":
+        mode = "L" if self._bit_depth == 8 else None
+        if pixel_formats.is_bayer(self.format):
                     mode="RGB"
                     
-                    self._image_array : np.ndarray = debayer(self.original_image_array, pattern=pattern)
+                    self._image_array : np.ndarray = debayer(self.original_image_array, pattern=pattern, bit_depth=self._bit_depth)
 
-        
-        self._image : Image.Image = Image.fromarray(self._image_array, mode=mode)
+        #PIL has no 16-bit RGB mode, so higher bit depth colour images are shown at 8-bit.
+        #They are saved at full bit depth by save().
+        preview_array = self._image_array if self._bit_depth == 8 or mode != "RGB" else pixel_formats.to_8bit(self._image_array, self._bit_depth)
+        self._image : Image.Image = Image.fromarray(preview_array, mode=mode)
 
     def _create_masks(self):
         if self._image is None:
             self._demosaic()
             
-        #temporary values for active area of camera hardcoded in now
-        #TODO load in from json or similar
-        
-        reduced_centre = [613, 517]
-        reduced_radius =  236
-        
-        
-        full_size_centre = [coord * 2 for coord in reduced_centre]
-        full_size_radius = reduced_radius * 2
-        
-        
-        centre = full_size_centre
-        radius = full_size_radius
-        margin = 100
-        
-        if sum(self._original_image_array.shape) > sum(self._image_array.shape):
-            centre = reduced_centre
-            radius = reduced_radius
-            margin = 50
-
+        #Find the active area in the image pixels, taking into account the region of interest, on-camera
+        #binning or decimation and whether debayering has reduced the resolution
+        reduction = 2 if sum(self._original_image_array.shape) > sum(self._image_array.shape) else 1
+        centre, radius = self.active_area(reduction=reduction)
+        margin = ACTIVE_AREA_MARGIN / (self._scale * reduction)
         
+        #Ring names use the radius of an unbinned frame so columns are comparable between capture profiles
+        name_scale = self._scale
 
         #print(f"Creating Mask: image_array: {self.image_array.shape} original_image_array: {self.original_image_array.shape}, format: {self.format}, centre: {centre}, radius:{radius}", file=sys.stderr)
         #Generate a mask which will hide the area outside this circle.
@@ -188,7 +206,7 @@ class Cam_Image:
         rad = radius
         radii = {}
         while rad <= diagonal_radius:
-            radii[f"radius_{rad}-{rad+margin}"] =[rad, rad + margin]
+            radii[f"radius_{round(rad*name_scale)}-{round((rad+margin)*name_scale)}"] =[rad, rad + margin]
             rad += margin
         
         
@@ -204,13 +222,13 @@ class Cam_Image:
         #Change integration time from microseconds to seconds
         integration_sec = self.integration_time_us/10e6
 
-        #If the image is monochrome, the image pixels are just relative luminance scaled to 255 so can use this if we apply a mask.
+        #If the image is monochrome, the image pixels are just relative luminance scaled to the maximum pixel value so can use this if we apply a mask.
         #If RGB, we use the IEC process as implemented in the luminance module to calculate relative luminance.        
-        if self.format == "Mono8":
-            self._relative_luminance = np.divide(get_pixel_averages_for_channels(self._image, mask=self._centre_mask, saturation_threshold=self.saturation_threshold), 255)[0]
+        if not pixel_formats.is_bayer(self.format):
+            self._relative_luminance = np.divide(get_pixel_averages_for_channels(self._image_array, mask=self._centre_mask, saturation_threshold=self.saturation_threshold), self._max_value)[0]
             
         else:
-            self._relative_luminance = luminance.calc_relative_luminance(self._image_array, mask=self._centre_mask, saturation_threshold=self.saturation_threshold)
+            self._relative_luminance = luminance.calc_relative_luminance(self._image_array, mask=self._centre_mask, saturation_threshold=self.saturation_threshold, max_value=self._max_value)
             
             
         #Calculate the unscaled absolute luminance using the IEC defined process.
@@ -244,10 +262,10 @@ class Cam_Image:
         if self._centre_mask is None:
             self._create_masks()
         #Calculate the average pixel value for each channel  in the active circle
-        self._inner_avgs :tuple[float]= get_pixel_averages_for_channels(self._image, mask=self._centre_mask)
+        self._inner_avgs :tuple[float]= get_pixel_averages_for_channels(self._image_array, mask=self._centre_mask)
         
         #Calculate the average pixel value for each channel in the outer dark area
-        self._outer_avgs:tuple[float] = get_pixel_averages_for_channels(self._image, mask=self._outer_mask)
+        self._outer_avgs:tuple[float] = get_pixel_averages_for_channels(self._image_array, mask=self._outer_mask)
 
         #Calculate the average pixel value for each channel in the corners
         self._corner_avgs: tuple[float]= get_pixel_averages_for_channels(self._image_array, mask=self._corner_mask)
@@ -256,6 +274,19 @@ class Cam_Image:
     
     
     
+    def active_area(self, reduction:int=1) -> tuple[tuple, float]:
+        """Get the centre and radius of the active area in image pixels.
+
+        Args:
+            reduction (int, optional): Additional factor the resolution has been reduced by (e.g. 2 for the average greens debayer). Defaults to 1.
+
+        Returns:
+            tuple[tuple, float]: ((x, y) centre, radius)
+        """
+        factor = self._scale * reduction
+        centre = ((ACTIVE_AREA_CENTRE[0] - self._offset[0]) / factor, (ACTIVE_AREA_CENTRE[1] - self._offset[1]) / factor)
+        return centre, ACTIVE_AREA_RADIUS / factor
+
     @property
     def original_image_array(self) -> np.ndarray:
         return self._original_image_array
@@ -277,6 +308,26 @@ class Cam_Image:
     def format(self) -> str:
         return self._format
     
+    @property
+    def bit_depth(self) -> int:
+        return self._bit_depth
+
+    @property
+    def storage_format(self) -> str:
+        return self._storage_format
+    
+    @property
+    def max_value(self) -> int:
+        return self._max_value
+    
+    @property
+    def offset(self) -> tuple:
+        return self._offset
+    
+    @property
+    def scale(self) -> int:
+        return self._scale
+    
     @property
     def timestamp(self) -> datetime:
         return self._timestamp
@@ -300,6 +351,10 @@ class Cam_Image:
     @property
     def auto(self) -> bool:
         return self._auto
+    
+    @property
+    def auto_attempts(self) -> int:
+        return self._auto_attempts
     @property
     def gain(self) -> float:
         return self._gain
@@ -319,6 +374,14 @@ class Cam_Image:
     @property
     def environment_temp(self) -> float:
         return self._environment_temp
+    
+    @property
+    def camera_id(self) -> str:
+        return self._camera_id
+    
+    @property
+    def fused_frames(self) -> int:
+        return self._fused_frames
 
     
     @property
@@ -385,16 +448,24 @@ class Cam_Image:
     def info(self)->dict:
         
         info = {"number" : self.number,
+                "camera_id": self.camera_id,
                 "time" : self.time_string('%Y-%m-%d %H:%M:%S.%f')[:-3],
                 "integration_microseconds" : self.integration_time_us,
                 "integration_seconds": self.integration_time_us/1000000,
                 "auto": self.auto,
+                "auto_attempts": self.auto_attempts,
+                "fused_frames": self.fused_frames,
                 "gain_dB" : self.gain,
                 "depth_m" : self.depth,
                 "pressure_mB" : self.pressure,
                 "device temp_°C": self.cam_temp,
                 "sensor_temp_°C": self.environment_temp,
                 "format": self.format,
+                "bit_depth": self.bit_depth,
+                "storage_format": self.storage_format,
+                "offset_x": self.offset[0],
+                "offset_y": self.offset[1],
+                "scale": self.scale,
                 "correct_saturation" : self.correct_saturation,
                 "inner_saturation_fraction": self.inner_saturation_fraction,
                 "outer_saturation_fraction": self.outer_saturation_fraction,
@@ -426,6 +497,13 @@ class Cam_Image:
     def set_auto(self, auto:bool)->None:
         self._auto = auto
 
+    def set_storage_format(self, storage_format:str)->None:
+        """Set how the image is saved - RGB_STORAGE is only used for 8-bit images (see pixel_formats.storage_format)."""
+        self._storage_format = pixel_formats.storage_format(storage_format, self._bit_depth)
+
+    def set_auto_attempts(self, attempts:int)->None:
+        self._auto_attempts = attempts
+
     def set_depth(self, depth_m: float)->None:
         self._depth = depth_m
 
@@ -465,7 +543,7 @@ class Cam_Image:
             logging.exception(f"(Cam_Image #{self.number}): Error showing image.\nThis function is not possible when using a remote shell.")
             
     def save(self, path:str|Path, additional_metadata:dict=None) -> bool:
-        """Save: Save Image using PIL Image.Image.save() function. Also saves image
+        """Save: Save Image using PIL Image.Image.save() function, in its storage_format (see pixel_formats). Also saves image
         metadata and any additional metadata fields specified in {"key":"value"} dict format
 
         Args:
@@ -482,7 +560,14 @@ class Cam_Image:
 
             path = Path(path)
 
-            self.image.save(path, pnginfo=metadata)
+            if self._storage_format == pixel_formats.RAW_STORAGE and self._bit_depth > 8:
+                #Store the raw (un-debayered) image as a 16-bit greyscale PNG, with the values shifted into the most
+                #significant bits. The bit_depth metadata gives the shift needed to recover the original values.
+                Image.fromarray(pixel_formats.to_16bit(self._original_image_array, self._bit_depth), mode="I;16").save(path, pnginfo=metadata)
+            elif self._storage_format == pixel_formats.RAW_STORAGE:
+                Image.fromarray(self._original_image_array, mode="L").save(path, pnginfo=metadata)
+            else:
+                self.image.save(path, pnginfo=metadata)
             logging.info(f"Saved image {self.number} to {path}")
             return True
         except:
@@ -528,7 +613,7 @@ def debayer_average_greens_method(image: np.ndarray, pattern:str) -> np.ndarray:
     return rgb_array
 
         
-def debayer(image:np.ndarray, pattern="RGGB")-> np.ndarray:
+def debayer(image:np.ndarray, pattern="RGGB", bit_depth:int=8)-> np.ndarray:
     """## Debayer or Demosaic an Image.
     
 
@@ -536,12 +621,17 @@ def debayer(image:np.ndarray, pattern="RGGB")-> np.ndarray:
     Args:
         image (np.ndarray): Image Bayer array
         pattern (str, optional): Image Pattern: 
+        bit_depth (int, optional): Bit depth of the image. 8-bit images are normalised to 0-255. Higher bit depths
+            keep their raw pixel scale so saturation thresholds still apply. Defaults to 8.
     Returns:
         np.ndarray: De-bayered RGB image array of shape (width, height, 3)
     """    
     
     start=datetime.now()
     
+    if bit_depth > 8:
+        return np.rint(debayer_average_greens_method(image.astype(np.float32), pattern=pattern)).astype(np.uint16)
+    
     bayer_array = image.astype(np.uint8)/255
     
 
@@ -583,13 +673,63 @@ def create_metadata(image:Cam_Image, additional_items:dict=None) ->PngInfo:
     except Exception as e:
         logging.exception(f"Error creating metadata for image #{image.number}")    
 
-def get_fast_saturation_fraction(image:Cam_Image, saturation_threshold:int=255):
+_fast_mask_cache:dict = {}
+
+def _get_fast_circle_mask(shape:tuple, decimation:int=1, centre:tuple=ACTIVE_AREA_CENTRE, radius:float=ACTIVE_AREA_RADIUS) -> np.ndarray:
+    """Get a boolean mask of the active area for a raw (un-debayered) image of the given shape,
+    decimated in the same way as decimate_raw().
+    Drawing the mask is slow compared to using it, so masks are cached by shape, decimation and geometry.
+    """
+    key = (shape, decimation, tuple(centre), radius)
+    mask = _fast_mask_cache.get(key)
+    if mask is None:
+        mask = np.array(create_circle_mask(np.empty(shape, dtype=np.uint8), centre, radius)) > 100
+        mask = decimate_raw(mask, decimation)
+        _fast_mask_cache[key] = mask
+    return mask
+
+def decimate_raw(image_array:np.ndarray, decimation:int=1) -> np.ndarray:
+    """Decimate a raw Bayer array by keeping one 2x2 Bayer cell in every [decimation] cells along each axis.
+    Keeping whole cells means every colour channel is still sampled. The result is a strided view so nothing is copied.
+
+    Args:
+        image_array (np.ndarray): Raw image array
+        decimation (int, optional): Decimation factor. Defaults to 1 (no decimation).
+
+    Returns:
+        np.ndarray: Decimated array of shape (rows/2/decimation, 2, columns/2/decimation, 2)
+    """
+    if decimation <= 1:
+        return image_array
+    height, width = image_array.shape[0:2]
+    height, width = height - height % 2, width - width % 2
+    cells = image_array[:height, :width].reshape(height//2, 2, width//2, 2)
+    return cells[::decimation, :, ::decimation, :]
+
+def get_fast_saturation_fraction(image:Cam_Image, saturation_threshold:int=None, decimation:int=1):
+    if saturation_threshold is None:
+        saturation_threshold = image.saturation_threshold
 
     original_array = image._original_image_array
-    circle_mask = create_circle_mask(original_array, (1226, 1034), 472)
-    fraction = get_fraction_saturated_pixels(original_array, circle_mask, saturation_threshold=saturation_threshold)
+    circle_mask = _get_fast_circle_mask(original_array.shape, decimation, *image.active_area())
+    fraction = get_fraction_saturated_pixels(decimate_raw(original_array, decimation), circle_mask, saturation_threshold=saturation_threshold)
     return fraction
 
+def get_fast_histogram(image:Cam_Image, decimation:int=1) -> np.ndarray:
+    """Get a histogram of the raw pixel values in the active area of an image.
+    Works on the raw array so the image does not need to be debayered.
+
+    Args:
+        image (Cam_Image): Image to process
+        decimation (int, optional): Only sample one Bayer cell in every [decimation] cells along each axis. Defaults to 1.
+
+    Returns:
+        np.ndarray: Number of pixels at each value from 0 to the maximum value of the image bit depth (e.g. 255 or 4095)
+    """
+    original_array = image._original_image_array
+    circle_mask = _get_fast_circle_mask(original_array.shape, decimation, *image.active_area())
+    return np.bincount(decimate_raw(original_array, decimation)[circle_mask].ravel(), minlength=image.max_value + 1)
+
 
         
         
@@ -615,8 +755,9 @@ def get_fraction_saturated_pixels(image: Image.Image, mask: Image.Image = None,
         
     if mask is not None:
         mask_image_array = np.array(mask)
-        mask_bool = mask_image_array > 100
-    
+        #Boolean masks (e.g. cached active area masks) can be used directly
+        mask_bool = mask_image_array if mask_image_array.dtype == np.bool_ else mask_image_array > 100
+
     
     if invert_mask:
             mask_bool  = np.invert(mask_bool) 
@@ -625,6 +766,9 @@ def get_fraction_saturated_pixels(image: Image.Image, mask: Image.Image = None,
     masked_array = image_array[mask_bool]
             
     total_pixels = masked_array.size
+    if total_pixels == 0:
+        #The region is not in the image (e.g. cropped out by a region of interest)
+        return float("nan")
     
     number_saturated  = np.size(masked_array[masked_array > saturation_threshold])
 
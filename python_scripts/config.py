@@ -0,0 +1,31 @@
+#Settings from the .env file written by install.sh
+import os
+from pathlib import Path
+
+#.env file in the Aegir directory
+ENV_FILE = Path(__file__).parent.parent / ".env"
+#Environment variable with the directory of the routines and sessions
+DATA_DIRECTORY_VARIABLE = "DATA_DIRECTORY"
+
+_loaded = False
+
+
+def load():
+    """Load the .env file into the environment, the first time this is called. Variables which are already set (e.g.
+    exported by run.sh) are kept. python-dotenv is only imported here, as it is slow to import."""
+    global _loaded
+    if _loaded:
+        return
+    from dotenv import load_dotenv
+    load_dotenv(ENV_FILE)
+    _loaded = True
+
+
+def data_directory() -> Path:
+    """The directory of the routines and sessions, from $DATA_DIRECTORY (loading the .env file if needed).
+    Raises RuntimeError if it is not set."""
+    load()
+    directory = os.environ.get(DATA_DIRECTORY_VARIABLE)
+    if directory is None or directory.strip() == "":
+        raise RuntimeError(f"{DATA_DIRECTORY_VARIABLE} is not set - use install.sh to create {ENV_FILE}")
+    return Path(directory)
@@ -0,0 +1,468 @@
+#Control socket of AEGIR, served by the process running a routine or by the daemon (see daemon.py).
+#Requests and replies are single lines of JSON over a Unix stream socket, e.g.
+#   {"command": "status"}
+#   {"ok": true, "status": {"routine": "calibration", "session": "drop_1", "image_count": 12, ...}}
+#A "subscribe" request keeps the connection open and is sent one line per event (see RoutineControl.publish).
+#Only the standard library is used so the command line client starts quickly. Run as a script to talk to AEGIR:
+#   $> python control.py status
+#   $> python control.py submit --routine [routine name] --session [session name]
+
+import argparse
+import json
+import logging
+import os
+import queue
+import select
+import socket
+import socketserver
+import sys
+import threading
+from datetime import timedelta
+from pathlib import Path
+from time import time
+
+logger = logging.getLogger()
+
+#Location of the socket, set in the .env file
+SOCKET_VARIABLE = "CONTROL_SOCKET_FILE"
+DEFAULT_SOCKET_FILE = "/tmp/AEGIR_CONTROL"
+#Longest wait for a reply, in seconds
+TIMEOUT_SECS = 5
+#Longest request or reply, in bytes
+MAX_MESSAGE_BYTES = 1 << 20
+
+#Events sent to subscribers
+STATUS_EVENT = "status"
+""" Status of the running routine, with the same fields as the status command - sent every second and after each capture """
+STOPPING_EVENT = "stopping"
+""" The routine received a stop command and is finishing its current capture """
+PAUSED_EVENT = "paused"
+RESUMED_EVENT = "resumed"
+COMPLETE_EVENT = "complete"
+""" The routine finished, with the reason it stopped """
+LOG_EVENT = "log"
+""" A log record - only sent to subscribers which asked for the log """
+JOB_EVENT = "job"
+""" A daemon job started or finished """
+
+#Events queued for a subscriber which is not reading them before it is disconnected
+SUBSCRIBER_QUEUE_LENGTH = 1000
+#How often a subscriber's connection is checked while there are no events, in seconds
+SUBSCRIBER_CHECK_SECS = 1
+
+
+def socket_path() -> Path:
+    """Path of the control socket, from $CONTROL_SOCKET_FILE or DEFAULT_SOCKET_FILE."""
+    return Path(os.environ.get(SOCKET_VARIABLE) or DEFAULT_SOCKET_FILE)
+
+
+class Unavailable(ConnectionError):
+    """Nothing is listening on the control socket."""
+
+
+def _connect(path:Path, timeout:float) -> socket.socket:
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.settimeout(timeout)
+    try:
+        connection.connect(str(path))
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        connection.close()
+        raise Unavailable(f"Nothing listening on {path}") from e
+    return connection
+
+
+def send(command:str, path:str|Path=None, timeout:float=TIMEOUT_SECS, **fields) -> dict:
+    """Send a request and wait for the reply.
+
+    Args:
+        command (str): Command name (see RoutineControl.handle and daemon.Daemon.handle)
+        path (str|Path, optional): Control socket. Defaults to socket_path().
+        timeout (float, optional): Longest wait for the reply in seconds. Defaults to TIMEOUT_SECS.
+        **fields: Arguments of the command
+
+    Returns:
+        dict: The reply. "ok" is False and "error" describes the problem if the request was refused.
+    """
+    path = socket_path() if path is None else Path(path)
+    with _connect(path, timeout) as connection:
+        connection.sendall((json.dumps({"command": command, **fields}) + "\n").encode())
+        with connection.makefile("rb") as reply:
+            line = reply.readline(MAX_MESSAGE_BYTES)
+    if not line:
+        raise Unavailable(f"{path} closed the connection without replying")
+    return json.loads(line)
+
+
+def subscribe(path:str|Path=None, logs:bool=False):
+    """Subscribe to the events of the running routine (or of the daemon).
+
+    Args:
+        path (str|Path, optional): Control socket. Defaults to socket_path().
+        logs (bool, optional): Also receive log records. Defaults to False.
+
+    Yields:
+        dict: The reply to the subscribe request (with the current status), then each event as it is published,
+            with "event" set to its type (e.g. STATUS_EVENT). Ends when the process closes the connection.
+    """
+    path = socket_path() if path is None else Path(path)
+    with _connect(path, TIMEOUT_SECS) as connection:
+        connection.sendall((json.dumps({"command": "subscribe", "logs": logs}) + "\n").encode())
+        #Events may be a long time apart
+        connection.settimeout(None)
+        with connection.makefile("rb") as events:
+            while line := events.readline(MAX_MESSAGE_BYTES):
+                yield json.loads(line)
+
+
+def is_running(path:str|Path=None, daemon:bool=False) -> bool:
+    """Whether a routine process or the daemon (or, with daemon=True, only the daemon) is answering on the control socket."""
+    try:
+        reply = send("ping", path=path, timeout=1)
+    except (OSError, ValueError):
+        return False
+    return reply.get("ok", False) and (reply.get("daemon", False) or not daemon)
+
+
+class RoutineControl:
+    """Control and status of the running routine for the control socket.
+
+    The process running the routine attaches a function building its status and the functions which carry out the
+    stop, pause and resume commands. Clients can request a status snapshot or subscribe, after which they are sent
+    every event as it is published (see the _EVENT constants), without polling. Each subscriber has its own queue, so
+    a slow client does not hold up the routine or other clients - a client which falls SUBSCRIBER_QUEUE_LENGTH
+    events behind is disconnected.
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._status_function:callable = None
+        self._commands:dict[str, callable] = {}
+        self._wake_function:callable = None
+        #Queue of each subscriber, and whether it receives log records
+        self._subscribers:dict[queue.Queue, bool] = {}
+
+    def attach(self, status_function:callable, commands:dict[str, callable], wake_function:callable=None):
+        """
+        Args:
+            status_function (callable): Returns the status of the routine as a JSON serialisable dict
+            commands (dict[str, callable]): Function carrying out each command (e.g. "stop"), returning a message for the client
+            wake_function (callable, optional): Wakes the routine's main loop, called when a client subscribes so a
+                status is published straight away. Defaults to None.
+        """
+        with self._lock:
+            self._status_function = status_function
+            self._commands = dict(commands)
+            self._wake_function = wake_function
+
+    def detach(self):
+        with self._lock:
+            self._status_function = None
+            self._commands = {}
+            self._wake_function = None
+
+    def status(self) -> dict|None:
+        """Status of the running routine, or None if no routine is running."""
+        function = self._status_function
+        return None if function is None else function()
+
+    def handle(self, request:dict) -> dict:
+        """Reply to a status or routine command request."""
+        command = request["command"]
+        if command == "status":
+            return {"ok": True, "status": self.status()}
+        function = self._commands.get(command)
+        if function is None:
+            if self._status_function is None and command in ["stop", "pause", "resume"]:
+                return {"ok": False, "error": "No routine running"}
+            return {"ok": False, "error": f"Unknown command {command}"}
+        return {"ok": True, "message": function()}
+
+    @property
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+    @property
+    def log_subscriber_count(self) -> int:
+        with self._lock:
+            return sum(1 for logs in self._subscribers.values() if logs)
+
+    def subscribe(self, logs:bool=False) -> queue.Queue:
+        """Queue of events published from now on. None is queued when the subscriber is disconnected."""
+        subscription = queue.Queue(maxsize=SUBSCRIBER_QUEUE_LENGTH)
+        with self._lock:
+            self._subscribers[subscription] = logs
+            wake_function = self._wake_function
+        if wake_function is not None:
+            wake_function()
+        return subscription
+
+    def unsubscribe(self, subscription:queue.Queue):
+        with self._lock:
+            self._subscribers.pop(subscription, None)
+
+    def publish(self, event:str, **fields):
+        """Send an event to the subscribers.
+
+        Args:
+            event (str): Event type (e.g. STATUS_EVENT)
+            **fields: JSON serialisable contents of the event
+        """
+        message = {"event": event, "time": time(), **fields}
+        with self._lock:
+            for subscription, logs in list(self._subscribers.items()):
+                if event == LOG_EVENT and not logs:
+                    continue
+                try:
+                    subscription.put_nowait(message)
+                except queue.Full:
+                    del self._subscribers[subscription]
+                    _disconnect(subscription)
+
+    def close(self):
+        """Disconnect every subscriber."""
+        with self._lock:
+            for subscription in self._subscribers:
+                _disconnect(subscription)
+            self._subscribers.clear()
+
+
+def _disconnect(subscription:queue.Queue):
+    with subscription.mutex:
+        subscription.queue.clear()
+    subscription.put_nowait(None)
+
+
+class LogPublisher(logging.Handler):
+    """Logging handler which publishes log records to the subscribers of a RoutineControl which asked for the log."""
+
+    def __init__(self, routine_control:RoutineControl, level=logging.INFO) -> None:
+        super().__init__(level)
+        self.routine_control = routine_control
+
+    def emit(self, record:logging.LogRecord):
+        if self.routine_control.log_subscriber_count == 0:
+            return
+        try:
+            self.routine_control.publish(LOG_EVENT, level=record.levelname, message=self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline(MAX_MESSAGE_BYTES)
+        if not line:
+            return
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict) or "command" not in request:
+                raise ValueError("Request must be a JSON object with a command")
+            if request["command"] == "subscribe" and self.server.routine_control is not None:
+                self._subscribe(bool(request.get("logs", False)))
+                return
+            reply = self.server.handler(request)
+        except Exception as e:
+            logger.warning(f"Control socket request failed: {e}")
+            reply = {"ok": False, "error": str(e)}
+        self._write(reply)
+
+    def _write(self, message:dict):
+        self.wfile.write((json.dumps(message, default=str) + "\n").encode())
+        self.wfile.flush()
+
+    def _subscribe(self, logs:bool):
+        routine_control:RoutineControl = self.server.routine_control
+        subscription = routine_control.subscribe(logs=logs)
+        try:
+            self._write({"ok": True, "status": routine_control.status()})
+            while True:
+                try:
+                    message = subscription.get(timeout=SUBSCRIBER_CHECK_SECS)
+                except queue.Empty:
+                    #Notice a client which has gone away while nothing is being published
+                    readable, _, _ = select.select([self.request], [], [], 0)
+                    if readable and self.request.recv(1, socket.MSG_PEEK) == b"":
+                        break
+                    continue
+                if message is None:
+                    break
+                self._write(message)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            routine_control.unsubscribe(subscription)
+
+
+class ControlServer(socketserver.ThreadingUnixStreamServer):
+    """Serves requests on the control socket, each on its own thread, by passing them to a handler function which
+    returns the reply. Subscribe requests are served from a RoutineControl. The socket is readable and writable by
+    the group so any user of the tool can use it.
+    """
+    daemon_threads = True
+
+    def __init__(self, handler:callable, routine_control:RoutineControl=None, path:str|Path=None) -> None:
+        """
+        Args:
+            handler (callable): Called with each request (a dict with at least "command") and returns the reply dict
+            routine_control (RoutineControl, optional): Serves subscribe requests. Defaults to None (not supported).
+            path (str|Path, optional): Control socket. Defaults to socket_path().
+        """
+        self.handler = handler
+        self.routine_control = routine_control
+        self.path = socket_path() if path is None else Path(path)
+        if self.path.exists():
+            #A socket left behind by a process which did not shut down cleanly is replaced
+            if is_running(self.path):
+                raise RuntimeError(f"Another process is already listening on {self.path}")
+            self.path.unlink()
+        super().__init__(str(self.path), _RequestHandler)
+        os.chmod(self.path, 0o770)
+
+    def start(self) -> "ControlServer":
+        """Serve requests on a background thread."""
+        threading.Thread(target=self.serve_forever, name="control_socket", daemon=True).start()
+        return self
+
+    def stop(self):
+        """Stop serving, disconnect subscribers and remove the socket."""
+        self.shutdown()
+        if self.routine_control is not None:
+            self.routine_control.close()
+        self.server_close()
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def format_status(status:dict) -> str:
+    """Multi-line description of a routine status, as shown by aegir -q."""
+    string = f"Routine: {status['routine']}\nSession: {status['session']}\nRuntime: {str(timedelta(seconds=int(status['runtime_secs'])))}\n"
+    string += f"Images Captured: {status['image_count']}/{status['plan_length']}\n"
+    if status.get("stored_count", status["image_count"]) != status["image_count"]:
+        #Fewer images are stored than captured when HDR brackets are fused
+        string += f"Images Stored: {status['stored_count']}\n"
+    string += f"Image Save Queue Size: {status['queue_size']}\n"
+    if status.get("depth") is not None:
+        string += f"Depth: {status['depth']:.2f}m Descent Rate: {status['descent_rate'] or 0:.2f}m/s Triggers: {status['trigger_count']}{' (waiting)' if status['awaiting_trigger'] else ''}\n"
+    if status.get("interval_secs") is not None:
+        string += f"Interval: {status['interval_secs']:.1f}s Scene Changes: {status['scene_changes']} Skipped Unchanged: {status['skipped_unchanged']}\n"
+    if len(status.get("phases", {})) > 0:
+        string += "Capture Phases:\n"
+        for name, phase in status["phases"].items():
+            string += f"  {name.ljust(22)} n={phase['count']:<6} mean={phase['mean_secs']*1e3:9.2f}ms  p95={phase['p95_secs']*1e3:9.2f}ms\n"
+    if status.get("paused"):
+        string += "PAUSED\n"
+    if status.get("stopping"):
+        string += "STOPPING\n"
+    return string
+
+
+def print_job(job:dict):
+    line = f"#{job['id']} {job['status']:<9} Routine: {job['routine']}"
+    if job.get("session"):
+        line += f" Session: {job['session']}"
+    if job.get("cameras"):
+        line += f" Cameras: {job['cameras']}"
+    if job.get("error"):
+        line += f" ({job['error']})"
+    print(line)
+
+
+def print_event(event:dict):
+    match event.get("event"):
+        case "status":
+            print(format_status(event["status"]))
+        case "log":
+            print(event["message"])
+        case "job":
+            print_job(event["job"])
+        case "complete":
+            print(f"Routine complete: {event.get('reason')}")
+        case event_type if event_type is not None:
+            print(event_type.upper())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Send a command to a running AEGIR routine or the AEGIR daemon")
+    commands = parser.add_subparsers(dest="command", required=True)
+    ping = commands.add_parser("ping", help="Exit with code 0 if a routine or the daemon is running, otherwise 1")
+    ping.add_argument("--daemon", action="store_true", help="Only exit with code 0 if the daemon is running")
+    commands.add_parser("status", help="Print the status of the running routine")
+    commands.add_parser("watch", help="Print the status of the running routine every time it changes")
+    commands.add_parser("log", help="Print the status of the running routine, then its log as it is written")
+    commands.add_parser("stop", help="Stop the running routine")
+    commands.add_parser("pause", help="Hold the running routine's captures")
+    commands.add_parser("resume", help="Continue the running routine's captures")
+    submit = commands.add_parser("submit", help="Queue a routine with the daemon")
+    submit.add_argument("--routine", required=True, help="Routine name or file")
+    submit.add_argument("--session", required=False, help="Session name")
+    submit.add_argument("--cameras", required=False, help='Comma separated serial numbers of the cameras to use, or "all"')
+    submit.add_argument("--resume", action="store_true", help="Continue the routine from where it stopped if the session has already run it")
+    submit.add_argument("--autostart", action="store_true", help="Submitted by autostart")
+    commands.add_parser("jobs", help="List the daemon's running, queued and recent jobs")
+    cancel = commands.add_parser("cancel", help="Remove a job queued with the daemon")
+    cancel.add_argument("id", type=int, help="Job number")
+    commands.add_parser("shutdown", help="Stop the running routine, drop queued jobs and close the daemon")
+    args = parser.parse_args()
+
+    if args.command == "ping":
+        sys.exit(0 if is_running(daemon=args.daemon) else 1)
+
+    try:
+        if args.command in ["watch", "log"]:
+            for event in subscribe(logs=args.command == "log"):
+                if "ok" in event:
+                    if event["status"] is not None:
+                        print(format_status(event["status"]))
+                elif args.command == "log" and event["event"] == STATUS_EVENT:
+                    continue
+                else:
+                    print_event(event)
+                sys.stdout.flush()
+            return
+
+        fields = {}
+        match args.command:
+            case "submit":
+                fields = {"routine": args.routine, "session": args.session or None, "cameras": args.cameras or None,
+                          "resume": args.resume, "autostart": args.autostart}
+            case "cancel":
+                fields = {"id": args.id}
+        reply = send(args.command, **fields)
+    except Unavailable:
+        print("No Aegir processes detected", file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        return
+    if not reply.get("ok", False):
+        print(f"Error: {reply.get('error', 'request failed')}", file=sys.stderr)
+        sys.exit(1)
+
+    match args.command:
+        case "status":
+            if reply["status"] is None:
+                print("No routine running")
+                sys.exit(1)
+            print(format_status(reply["status"]).rstrip())
+        case "submit":
+            job = reply["job"]
+            if reply["position"] == 0:
+                print(f"Job #{job['id']} starting: {job['routine']}")
+            else:
+                print(f"Job #{job['id']} queued at position {reply['position']}: {job['routine']}")
+        case "jobs":
+            if len(reply["jobs"]) == 0:
+                print("No jobs")
+            for job in reply["jobs"]:
+                print_job(job)
+        case _:
+            if reply.get("message"):
+                print(reply["message"])
+
+
+if __name__ == "__main__":
+    main()
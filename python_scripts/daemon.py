@@ -0,0 +1,389 @@
+import logging
+import os
+import queue
+import signal
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+import ms5837
+import ms5837_native
+import device_interface
+import routine
+import control
+import nodes
+
+logger = logging.getLogger()
+
+#Job statuses
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETE = "complete"
+FAILED = "failed"
+CANCELLED = "cancelled"
+#Number of finished jobs listed by the jobs command
+HISTORY_LENGTH = 20
+
+
+class Daemon:
+    """Keeps the cameras and pressure sensor connected and runs routines submitted on the control socket (see
+    control.py) one after another.
+
+    A routine run by the daemon starts without importing the camera libraries, loading the GenTL producer, resetting
+    the camera timestamps or initialising the pressure sensor, so back-to-back routines have no dead time between
+    them. Cameras are opened the first time a job uses them and kept open. If a job fails, any camera which no longer
+    responds is disconnected so the next job which uses it reconnects.
+
+    The control socket commands are:
+        ping                                                  Check the daemon is running
+        submit (routine, session, cameras, resume, autostart) Queue a routine - the same arguments as aegir.py
+        jobs                                                  Running, queued and recently finished jobs
+        cancel (id)                                           Remove a queued job
+        shutdown                                              Stop the running routine, drop queued jobs and exit
+        node (name, serial)                                   Read a node of an open camera (see nodes.py), between jobs
+        snapshot (serial)                                     Save a snapshot of the nodemap of the open cameras, between jobs
+    and the status, subscribe, stop, pause and resume commands of the running routine (see control.RoutineControl).
+    Subscribers stay connected from one job to the next, and are also sent an event when each job starts and finishes.
+    """
+
+    def __init__(self,
+                 run_routine:callable,
+                 routine_dir:Path,
+                 camera_serials:str=None,
+                 log_queue:queue.Queue=None,
+                 socket_path:str|Path=None) -> None:
+        """
+        Args:
+            run_routine (callable): Runs one routine to completion with open cameras and sensor (aegir.run_routine)
+            routine_dir (Path): Routine directory, used to check a submitted routine exists
+            camera_serials (str, optional): Cameras of jobs which don't choose their own, in the form of the --cameras
+                argument. Opened when the daemon starts. Defaults to the first camera found.
+            log_queue (queue.Queue, optional): Log queue written to each session's output log. Defaults to None.
+            socket_path (str|Path, optional): Control socket. Defaults to control.socket_path().
+        """
+        self.run_routine = run_routine
+        self.routine_index = routine.RoutineIndex(routine_dir)
+        self.camera_serials = camera_serials
+        self.log_queue = log_queue
+        self.socket_path = socket_path
+        self.routine_control = control.RoutineControl()
+
+        #Open cameras by serial number, in the order they were opened
+        self._cameras:dict[str, device_interface.Camera] = {}
+        self.sensor:ms5837.MS5837 = None
+        #Held while the cameras are being opened or used by a job, so their nodemaps aren't read from the socket thread
+        self._camera_lock = threading.Lock()
+
+        self._condition = threading.Condition()
+        self._queue:deque[dict] = deque()
+        self._history:deque[dict] = deque(maxlen=HISTORY_LENGTH)
+        self._job_count = 0
+        self._current:dict = None
+        self._current_routine:routine.Routine = None
+        self._shutdown = threading.Event()
+
+    def cameras(self, camera_serials:str=None) -> list[device_interface.Camera]:
+        """Open cameras, opening any which are not already open.
+
+        Args:
+            camera_serials (str, optional): Comma separated serial numbers, or "all". Defaults to the daemon's cameras.
+
+        Returns:
+            list[device_interface.Camera]: The cameras. Raises ConnectionError if any could not be opened.
+        """
+        camera_serials = camera_serials if camera_serials else self.camera_serials
+        if camera_serials is None or camera_serials.strip() == "":
+            if len(self._cameras) == 0:
+                self._add_camera(device_interface.open(), None)
+            devices = [next(iter(self._cameras.values()))]
+            #Set as when the first camera is opened by aegir.py
+            devices[0].camera_id = None
+            return devices
+
+        if camera_serials.strip().lower() == "all":
+            serials = [str(device["serial_number"]) for device in device_interface.list_devices()]
+        else:
+            serials = [serial.strip() for serial in camera_serials.split(",") if serial.strip() != ""]
+        for serial in serials:
+            if serial not in self._cameras:
+                self._add_camera(device_interface.open(serial_number=serial, camera_id=serial), serial)
+        devices = [self._cameras[serial] for serial in serials]
+        for serial, device in zip(serials, devices):
+            device.camera_id = serial
+        return devices
+
+    def _add_camera(self, device:device_interface.Camera, serial:str):
+        if device is None:
+            raise ConnectionError(f"Could not connect to camera {serial if serial is not None else ''}")
+        self._cameras[str(device.serial_number)] = device
+        #The snapshot is kept up to date while the daemon has the camera, as other processes can't connect to it
+        try:
+            device.save_node_snapshot()
+        except Exception as e:
+            logger.warning(f"Could not save a snapshot of the nodemap of camera {device.serial_number} ({e})")
+
+    def _open_camera(self, serial_number:str=None) -> device_interface.Camera:
+        #An open camera by serial number, or the first camera opened. Cameras are not opened here, as they may be
+        #in use by the running job.
+        if serial_number is None and len(self._cameras) > 0:
+            return next(iter(self._cameras.values()))
+        if serial_number is not None and str(serial_number) in self._cameras:
+            return self._cameras[str(serial_number)]
+        raise ValueError(f"Camera {serial_number if serial_number is not None else ''} is not open in the daemon")
+
+    @contextmanager
+    def _idle_cameras(self):
+        #The cameras while no job is using them. Raises RuntimeError rather than waiting for a job to finish.
+        if not self._camera_lock.acquire(blocking=False):
+            raise RuntimeError("The cameras are in use by a running job - try again when it has finished")
+        try:
+            yield
+        finally:
+            self._camera_lock.release()
+
+    def read_node(self, name:str, serial_number:str=None) -> tuple[str, dict|None]:
+        """Read a node of an open camera (see nodes.read_node). Raises RuntimeError while a job is running.
+
+        Returns:
+            tuple[str, dict|None]: Serial number of the camera, and the node or None if it isn't readable
+        """
+        with self._idle_cameras():
+            device = self._open_camera(serial_number)
+            return str(device.serial_number), nodes.read_node(device.nodemap, name)
+
+    def save_node_snapshots(self, serial_number:str=None) -> list[Path]:
+        """Save a snapshot of the nodemap of an open camera, or of every open camera. Returns the snapshot files.
+        Raises RuntimeError while a job is running."""
+        with self._idle_cameras():
+            if serial_number is not None:
+                return [self._open_camera(serial_number).save_node_snapshot()]
+            return [device.save_node_snapshot() for device in list(self._cameras.values())]
+
+    def _release_unresponsive_cameras(self, devices:list[device_interface.Camera]):
+        for device in devices:
+            try:
+                device.temperature
+            except Exception:
+                logger.warning(f"Camera {device.serial_number} is not responding - reconnecting at the next job")
+                self._cameras.pop(str(device.serial_number), None)
+                try:
+                    device.disconnect()
+                except Exception as e:
+                    logger.exception(e)
+
+    def open_sensor(self) -> ms5837.MS5837:
+        """The pressure sensor, opened if it is not already open. Raises ConnectionError if it cannot be opened."""
+        if self.sensor is None:
+            #The backend (bar30 C library or Python driver) is chosen by PRESSURE_SENSOR_BACKEND (see ms5837_native.py)
+            self.sensor = ms5837_native.open_sensor()
+            if self.sensor is None:
+                raise ConnectionError("Could not connect to Pressure Sensor")
+            self.sensor.setFluidDensity(ms5837.DENSITY_SALTWATER)
+        return self.sensor
+
+    def submit(self, routine_name:str, session_name:str=None, cameras:str=None, resume:bool=False, autostart:bool=False) -> tuple[dict, int]:
+        """Queue a routine.
+
+        Returns:
+            tuple[dict, int]: The job, and the number of jobs ahead of it (0 if it is about to start)
+        """
+        if routine_name is None or str(routine_name).strip() == "":
+            raise ValueError("Routine Name not specified")
+        if not Path(routine_name).is_file() and self.routine_index.refresh().find(routine_name)[0] is None:
+            raise ValueError(f"Routine {routine_name} does not exist")
+        with self._condition:
+            if self._shutdown.is_set():
+                raise RuntimeError("Daemon is shutting down")
+            self._job_count += 1
+            job = {"id": self._job_count,
+                   "routine": routine_name,
+                   "session": session_name or None,
+                   "cameras": cameras or None,
+                   "resume": bool(resume),
+                   "autostart": bool(autostart),
+                   "status": QUEUED,
+                   "submitted": datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                   "started": None,
+                   "finished": None,
+                   "error": None}
+            position = len(self._queue) + (1 if self._current is not None else 0)
+            self._queue.append(job)
+            self._condition.notify_all()
+        logger.info(f"Queued job #{job['id']}: routine {routine_name}{f', session {session_name}' if session_name else ''}")
+        return dict(job), position
+
+    def cancel(self, job_id:int) -> dict:
+        """Remove a queued job. Raises KeyError if no queued job has the id."""
+        with self._condition:
+            for job in self._queue:
+                if job["id"] == job_id:
+                    self._queue.remove(job)
+                    self._finish(job, CANCELLED)
+                    logger.info(f"Cancelled job #{job_id}")
+                    return dict(job)
+        raise KeyError(f"No queued job #{job_id}")
+
+    def stop(self, reason:str=None) -> bool:
+        """Stop the running routine. Returns whether a routine was running."""
+        with self._condition:
+            current_routine = self._current_routine
+        if current_routine is None:
+            return False
+        logger.info("Received stop request")
+        current_routine.stop(reason)
+        return True
+
+    def shutdown(self):
+        """Stop the running routine, drop the queued jobs and stop the daemon once the routine has finished."""
+        with self._condition:
+            self._shutdown.set()
+            while len(self._queue) > 0:
+                self._finish(self._queue.popleft(), CANCELLED)
+            self._condition.notify_all()
+        self.stop("Daemon shut down")
+
+    def jobs(self) -> list[dict]:
+        """The finished jobs, oldest first, then the running job and the queued jobs in the order they will run."""
+        with self._condition:
+            jobs = [*self._history, *([self._current] if self._current is not None else []), *self._queue]
+            return [dict(job) for job in jobs]
+
+    def handle(self, request:dict) -> dict:
+        """Reply to a control socket request (see control.ControlServer)."""
+        match request["command"]:
+            case "ping":
+                return {"ok": True, "daemon": True}
+            case "submit":
+                job, position = self.submit(request.get("routine"), session_name=request.get("session"), cameras=request.get("cameras"),
+                                            resume=request.get("resume", False), autostart=request.get("autostart", False))
+                return {"ok": True, "job": job, "position": position}
+            case "jobs":
+                return {"ok": True, "jobs": self.jobs()}
+            case "cancel":
+                return {"ok": True, "job": self.cancel(int(request["id"]))}
+            case "shutdown":
+                self.shutdown()
+                return {"ok": True, "message": "Daemon shutting down"}
+            case "node":
+                serial_number, entry = self.read_node(request["name"], request.get("serial"))
+                return {"ok": True, "serial_number": serial_number, "node": entry}
+            case "snapshot":
+                return {"ok": True, "paths": [str(path) for path in self.save_node_snapshots(request.get("serial"))]}
+            case _:
+                return self.routine_control.handle(request)
+
+    def _finish(self, job:dict, status:str, error:str=None):
+        #Must be called with the condition held
+        job["status"] = status
+        job["error"] = error
+        job["finished"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self._history.append(job)
+
+    def _routine_started(self, current_routine:routine.Routine):
+        with self._condition:
+            self._current_routine = current_routine
+        #A shutdown requested while the routine was loading stops it straight away
+        if self._shutdown.is_set():
+            current_routine.stop("Daemon shut down")
+
+    def _next_job(self) -> dict|None:
+        with self._condition:
+            while len(self._queue) == 0 and not self._shutdown.is_set():
+                self._condition.wait()
+            if self._shutdown.is_set():
+                return None
+            self._current = self._queue.popleft()
+            self._current["status"] = RUNNING
+            self._current["started"] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            job = dict(self._current)
+        self.routine_control.publish(control.JOB_EVENT, job=job)
+        return self._current
+
+    def _run_job(self, job:dict):
+        logger.info(f"Starting job #{job['id']}: routine {job['routine']}")
+        #Records logged while idle would otherwise be written to the next session's output log
+        while self.log_queue is not None:
+            try:
+                self.log_queue.get_nowait()
+            except queue.Empty:
+                break
+        devices = []
+        status, error = COMPLETE, None
+        with self._camera_lock:
+            try:
+                devices = self.cameras(job["cameras"])
+                self.run_routine(devices, self.open_sensor(), job["routine"], session_name=job["session"], resume=job["resume"],
+                                 auto_start=job["autostart"], log_queue=self.log_queue, routine_control=self.routine_control,
+                                 on_start=self._routine_started)
+            except Exception as e:
+                status, error = FAILED, str(e)
+                logger.error(f"Job #{job['id']} failed")
+                logger.exception(e)
+                self._release_unresponsive_cameras(devices)
+        with self._condition:
+            self._current = None
+            self._current_routine = None
+            self._finish(job, status, error)
+        self.routine_control.publish(control.JOB_EVENT, job=dict(job))
+        logger.info(f"Finished job #{job['id']}: {status}")
+
+    def run(self):
+        """Serve the control socket, open the cameras and sensor, then run jobs until shut down (by the shutdown
+        command, SIGTERM or SIGINT). Must be called on the main thread.
+
+        The socket is served before the devices are opened, and systemd is told the daemon is ready once it is, so
+        units ordered after daemon@.service (autostart@.service) find the daemon answering pings rather than
+        starting a separate routine which competes for the camera. Jobs submitted while the devices are opening
+        are queued."""
+        for signal_number in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(signal_number, lambda signal_number, frame: self.shutdown())
+
+        log_publisher = control.LogPublisher(self.routine_control)
+        log_publisher.setFormatter(logging.Formatter(fmt='%(asctime)s - %(levelname)8s - %(message)s', datefmt="%Y-%m-%d %H:%M:%S"))
+        logger.addHandler(log_publisher)
+        server = control.ControlServer(self.handle, routine_control=self.routine_control, path=self.socket_path).start()
+        logger.info(f"Daemon listening on {server.path}")
+        _notify_systemd("READY=1")
+        try:
+            try:
+                with self._camera_lock:
+                    self.cameras()
+                    self.open_sensor()
+            except Exception as e:
+                #Retried by the first job
+                logger.error("Could not open the cameras and pressure sensor when starting the daemon")
+                logger.exception(e)
+
+            while (job := self._next_job()) is not None:
+                self._run_job(job)
+        finally:
+            _notify_systemd("STOPPING=1")
+            server.stop()
+            logger.removeHandler(log_publisher)
+            for device in self._cameras.values():
+                try:
+                    device.disconnect()
+                except Exception as e:
+                    logger.exception(e)
+            self._cameras.clear()
+            if self.sensor is not None and hasattr(self.sensor, "close"):
+                self.sensor.close()
+            logger.info("Daemon stopped")
+
+
+def _notify_systemd(state:str):
+    #Send a state (e.g. READY=1) to systemd for a Type=notify unit. Does nothing when not started by systemd.
+    address = os.environ.get("NOTIFY_SOCKET")
+    if not address:
+        return
+    if address.startswith("@"):
+        #Abstract namespace socket
+        address = "\0" + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify_socket:
+            notify_socket.connect(address)
+            notify_socket.sendall(state.encode())
+    except OSError as e:
+        logger.warning(f"Could not notify systemd of {state} ({e})")
@@ -1,9 +1,13 @@
 from harvesters.core import Harvester, ParameterSet, ParameterKey, ImageAcquirer, NodeMap, Buffer
 import os
+from pathlib import Path
 import numpy as np
 from datetime import datetime, timedelta
 import traceback
-from cam_image import Cam_Image
+from cam_image import Cam_Image, ACTIVE_AREA_CENTRE, ACTIVE_AREA_RADIUS
+from timing import PhaseTimer
+import pixel_formats
+import nodes
 from time import sleep, time
 import math
 import sys
@@ -26,6 +30,7 @@ RGB8 = "RGB8"
 """ 8-bit RGB pixel format """
 BAYER_RG8 = "BayerRG8"
 """ 8-bit Bayer RG pixel format """
+#10 and 12-bit formats, including packed variants, are listed in pixel_formats.FORMATS
 
 #Acquisition Modes
 SINGLE_FRAME = "SingleFrame"
@@ -42,6 +47,28 @@ LONG_EXPOSURE = "LongExposure"
 """ Long Exposure Sensor Mode """
 
 
+#Capture Profiles
+FULL = "full"
+""" Full resolution, full sensor """
+ROI = "roi"
+""" Full resolution, cropped to the bounding box of the active area """
+BINNED = "binned"
+""" 2x2 on-camera binning, cropped to the bounding box of the active area """
+DECIMATED = "decimated"
+""" 2x2 on-camera decimation, cropped to the bounding box of the active area """
+DECIMATED_4 = "decimated_4"
+""" 4x4 on-camera decimation, cropped to the bounding box of the active area """
+
+CAPTURE_PROFILES = {FULL: {"binning": 1, "decimation": 1, "roi": False},
+                    ROI: {"binning": 1, "decimation": 1, "roi": True},
+                    BINNED: {"binning": 2, "decimation": 1, "roi": True},
+                    DECIMATED: {"binning": 1, "decimation": 2, "roi": True},
+                    DECIMATED_4: {"binning": 1, "decimation": 4, "roi": True}}
+
+#Margin kept around the active area when cropping to a region of interest, in full resolution pixels.
+#Large enough to keep the light bleed margin and part of the outer dark region.
+ROI_MARGIN = 200
+
 #Time Units
 US = "microseconds"
 """ Microseconds """
@@ -66,15 +93,67 @@ NANOSECONDS = "nanoseconds"
 
 logger = logging.getLogger()
 
-def open():
+#One harvester (GenTL producer) is shared by every open camera
+_harvester:Harvester = None
+_harvester_lock = threading.Lock()
+_open_cameras:list = []
+
+def get_harvester() -> Harvester:
+    """
+    Get the shared harvester, creating it and loading the GenTL producer if needed.
+
+    Returns:
+        Harvester: The shared harvester
+    """
+    global _harvester
+    with _harvester_lock:
+        if _harvester is None:
+            _harvester = Harvester()
+            _harvester.add_file(PRODUCER_PATH)
+            _harvester.update()
+        return _harvester
+
+def list_devices(update:bool=True) -> list[dict]:
+    """
+    List the cameras available to the GenTL producer.
+
+    Args:
+        update (bool): Rescan for devices first. Default is True.
+
+    Returns:
+        list[dict]: serial_number, model, vendor and id of each device
+    """
+    harvester = get_harvester()
+    if update:
+        harvester.update()
+    return [{"serial_number": info.serial_number,
+             "model": info.model,
+             "vendor": info.vendor,
+             "id": info.id_} for info in harvester.device_info_list]
+
+def open(serial_number:str=None, camera_id:str=None):
     try:
-        camera = Camera()
-        logger.info(f"Connected to camera")
+        camera = Camera(serial_number=serial_number, camera_id=camera_id)
+        logger.info(f"Connected to camera {camera.serial_number}")
         return camera
     except Exception as e:
-        logger.error("Could not connect to camera")
+        logger.error(f"Could not connect to camera {serial_number if serial_number is not None else ''}")
         logger.exception(e, stack_info=True)
         return None
+
+def open_all(serial_numbers:list[str]=None) -> list:
+    """
+    Open several cameras by serial number. Each camera's camera_id is set to its serial number.
+
+    Args:
+        serial_numbers (list[str], optional): Serial numbers of the cameras to open. Opens every available camera if None.
+
+    Returns:
+        list: The opened cameras. Cameras which could not be opened are None.
+    """
+    if serial_numbers is None:
+        serial_numbers = [device["serial_number"] for device in list_devices()]
+    return [open(serial_number=serial_number, camera_id=str(serial_number)) for serial_number in serial_numbers]
         
 
 
@@ -83,19 +162,29 @@ class Camera:
 
     def connect(self):
 
-        self.harvester.update()
+        serial_numbers = [info.serial_number for info in self.harvester.device_info_list]
+        if len(serial_numbers) == 0 or (self.serial_number is not None and self.serial_number not in serial_numbers):
+            self.harvester.update()
+            serial_numbers = [info.serial_number for info in self.harvester.device_info_list]
         
-        if len(self.harvester.device_info_list) == 0:
+        if len(serial_numbers) == 0:
             raise Exception("No devices found")
+        if self.serial_number is not None and self.serial_number not in serial_numbers:
+            raise Exception(f"Device {self.serial_number} not found. Available devices: {serial_numbers}")
 
         # Create an image acquirer with auto chunk data update enabled
         self.acquisition_params = ParameterSet()
         self.acquisition_params.add(ParameterKey.ENABLE_AUTO_CHUNK_DATA_UPDATE, True)
-        self.device:ImageAcquirer = self.harvester.create(config=self.acquisition_params)
-        
+        if self.serial_number is None:
+            self.device:ImageAcquirer = self.harvester.create(config=self.acquisition_params)
+        else:
+            self.device:ImageAcquirer = self.harvester.create({"serial_number": self.serial_number}, config=self.acquisition_params)
+
         self.nodemap:NodeMap = self.device.remote_device.node_map
         self.data_stream = self.device.data_streams[0]
         self.ds_nodemap: NodeMap= self.data_stream.node_map
+        if self.serial_number is None:
+            self.serial_number = self.nodemap.DeviceSerialNumber.value
         #Set Buffer Handling Mode to Newest Only
         self.ds_nodemap.StreamBufferHandlingMode.set_value("NewestOnly")
         
@@ -108,19 +197,38 @@ class Camera:
 
 
 
-    def __init__(self) -> None:
-        
-        self.harvester = Harvester() 
+    def __init__(self, serial_number:str=None, camera_id:str=None) -> None:
+        """
+        Args:
+            serial_number (str, optional): Serial number of the camera to open. Opens the first camera found if None.
+            camera_id (str, optional): Label stored with each image from this camera. Needed to tell cameras apart when several are used.
+        """
         
-        # Add producer file path
-        self.harvester.add_file(PRODUCER_PATH)
-
+        self.harvester = get_harvester()
+        self.serial_number:str = serial_number
+        self.camera_id:str = camera_id
 
         self.connect()
+        _open_cameras.append(self)
 
         self.start_time = datetime.now()
 
         self.cap_thread:threading.Thread = None
+
+        #Capture profile (on-camera binning/decimation and region of interest)
+        self.capture_profile:str = FULL
+        self.roi_margin:int = ROI_MARGIN
+        #Position of the image on the sensor and the number of sensor pixels combined into one image pixel
+        self.roi_offset:tuple = (0, 0)
+        self.pixel_scale:int = 1
+
+        #Timer for the phases of a capture. Replace with a routine's timer to aggregate per routine.
+        self.timer:PhaseTimer = PhaseTimer("camera")
+
+        #Integration time limits of each sensor mode, recorded as the camera visits them
+        self.sensor_mode_limits:dict[str, tuple] = {}
+        self._record_integration_min_max()
+
         #Set Pixel Format to BayerRG8 if available, else set to Mono8
         if BAYER_RG8 in self._valid_pixel_formats():
             self.nodemap.PixelFormat.set_value(BAYER_RG8)
@@ -131,6 +239,14 @@ class Camera:
         chunks = ["Timestamp", "ExposureTime", "Width", "Height", "PixelFormat", "Gain"]
         self.activate_chunks(chunks)
 
+        #Nodes are looked up in a snapshot of the nodemap without connecting (see nodes.py). One is taken the first
+        #time the camera connects, then only on request (or by the daemon), as reading every node takes a while.
+        try:
+            if not nodes.snapshot_path(self.serial_number).exists():
+                self.save_node_snapshot()
+        except Exception as e:
+            logger.warning(f"Could not save a snapshot of the nodemap of camera {self.serial_number} ({e})")
+
     
     def activate_chunks(self, chunks:list[str]=["Timestamp", "ExposureTime", "Width", "Height", "PixelFormat", "Gain"]):  
         self.nodemap.ChunkModeActive.set_value("False")
@@ -167,10 +283,11 @@ class Camera:
             
             buffer:Buffer = None
             
-            for i in range(self.data_stream.num_announced -1):
-                buffer:Buffer = self.device.fetch()
-                buffer.queue()
-                buffer = None
+            with self.timer.phase("flush_buffers"):
+                for i in range(self.data_stream.num_announced -1):
+                    buffer:Buffer = self.device.fetch()
+                    buffer.queue()
+                    buffer = None
 
             correct_integration_attempts = 0
             incorrect_integration_attempts = 0
@@ -183,11 +300,14 @@ class Camera:
 
             fetch_attempts = 0
             integration_time_us = None
+            fetch_start = time()
             while buffer is None:
                 
                 try:
-                    buffer:Buffer = self.device.fetch()
-                    buffer.update_chunk_data()
+                    with self.timer.phase("fetch"):
+                        buffer:Buffer = self.device.fetch()
+                    with self.timer.phase("chunk_update"):
+                        buffer.update_chunk_data()
                     integration_time_us = self.nodemap.ChunkExposureTime.value
                     
                     if target_integration_time_us is not None:
@@ -220,42 +340,222 @@ class Camera:
                     if fetch_attempts > 10:
                         logger.error("Failed to fetch buffer after 10 attempts")
                         raise Exception("Failed to fetch buffer after 10 attempts")
+            self.timer.record("fetch_total", time() - fetch_start)
 
-            clock_timestamp = buffer.timestamp_ns/(10**9)
-            component = buffer.payload.components[0]
-            image = component.data
-            
-            image_array = image.reshape(component.height, component.width).copy()
+            try:
+                gain = self.nodemap.ChunkGain.value
+            except Exception:
+                gain = self.nodemap.Gain.value
+            return self._image_from_buffer(buffer, integration_time_us=integration_time_us, gain=gain, return_type=return_type)
+        except Exception as e:
+            logger.error("Error capturing image")
+            logger.exception(e, stack_info=True)
 
-            if return_type == NDARRAY:
-                buffer.queue()
-                return image_array
+            traceback.print_exception(e, file=sys.stderr)
+            return None    
 
-            format = component.data_format
+    def _image_from_buffer(self, buffer:Buffer, integration_time_us:float, gain:float=1, return_type:str=CAM_IMAGE):
+        """
+        Copy the image out of a fetched buffer and requeue the buffer.
 
-            
+        Args:
+            buffer (Buffer): Fetched buffer
+            integration_time_us (float): Integration time of the frame in microseconds
+            gain (float): Gain of the frame in dB. Default is 1.
+            return_type (str): CAM_IMAGE or NDARRAY. Default is CAM_IMAGE.
+
+        Returns:
+            Cam_Image|np.ndarray: The image
+        """
+        clock_timestamp = buffer.timestamp_ns/(10**9)
+        component = buffer.payload.components[0]
+        image = component.data
+        format = component.data_format
+        
+        #Copy (and unpack 10 and 12-bit formats) before the buffer is requeued
+        with self.timer.phase("unpack" if pixel_formats.is_packed(format) else "array_copy"):
+            image_array = pixel_formats.unpack(image, component.width, component.height, format)
+
+        if return_type == NDARRAY:
             buffer.queue()
+            return image_array
 
-            timestamp = self.start_time + timedelta(seconds = clock_timestamp)
-            
-            temperature = self.nodemap.DeviceTemperature.value
+        
+        buffer.queue()
 
+        timestamp = self.start_time + timedelta(seconds = clock_timestamp)
+        
+        temperature = self.nodemap.DeviceTemperature.value
+
+        with self.timer.phase("create_cam_image"):
             return Cam_Image(image_array, 
                              format=format,
                              timestamp = timestamp, 
                              integration_time_us = integration_time_us,
-                             gain = 1, 
+                             gain = gain, 
                              aperture=1,
-                             cam_temp=temperature)
-        except Exception as e:
-            logger.error("Error capturing image")
-            logger.exception(e, stack_info=True)
+                             cam_temp=temperature,
+                             camera_id=self.camera_id,
+                             offset=self.roi_offset,
+                             scale=self.pixel_scale)
 
-            traceback.print_exception(e, file=sys.stderr)
-            return None    
+    @property
+    def supports_sequencer(self) -> bool:
+        """
+        Whether the camera has a sequencer which can step through a list of integration time and gain settings on its own.
+        """
+        try:
+            self.nodemap.SequencerMode.value
+            self.nodemap.SequencerSetSelector.max
+            self.nodemap.SequencerSetSave
+            return True
+        except Exception:
+            return False
+
+    def capture_bracket(self, settings:list[tuple], time_unit:str=MICROSECONDS, return_type:str=CAM_IMAGE) -> list:
+        """
+        Capture a bracket of frames, each with its own integration time and gain.
+
+        If the camera has a sequencer the whole bracket is uploaded to it once and the frames are streamed back
+        in a single acquisition, so each frame only costs its own exposure and readout. The integration time and
+        gain of each frame are taken from its chunk data. Sequencer sets cannot span sensor modes, so the bracket
+        is captured in runs of settings which share a sensor mode, and in runs no longer than the number of
+        sequencer sets. Without a sequencer the frames are captured one at a time.
+
+        The sensor mode, integration time and gain the camera had before the bracket are restored afterwards, so
+        settings staged for the next capture still apply.
+
+        Args:
+            settings (list[tuple]): (integration time, gain) of each frame, in capture order
+            time_unit (str): The unit of the integration times. Default is MICROSECONDS.
+            return_type (str): CAM_IMAGE or NDARRAY. Default is CAM_IMAGE.
+
+        Returns:
+            list: The captured images in the order of the settings. Frames which could not be captured are None.
+        """
+        settings_us = [(convert_time(int_time, time_unit, MICROSECONDS), gain) for int_time, gain in settings]
+        if len(settings_us) == 0:
+            return []
+
+        sensor_mode = self.nodemap.UserSetSelector.value
+        previous_time_us = self.nodemap.ExposureTime.value
+        previous_gain = self.nodemap.Gain.value
+        try:
+            if not self.supports_sequencer:
+                logger.info("Camera has no sequencer - capturing bracket one frame at a time")
+                images = []
+                for int_time_us, gain in settings_us:
+                    self.gain(gain)
+                    int_time_us = self.integration_time(int_time_us, MICROSECONDS)
+                    images.append(self.capture_image(return_type=return_type, target_integration_time_us=int_time_us))
+                return images
+            return self._capture_bracket_runs(settings_us, return_type=return_type)
+        finally:
+            self.change_sensor_mode(sensor_mode)
+            self.nodemap.ExposureTime.set_value(previous_time_us)
+            self.nodemap.Gain.set_value(previous_gain)
+
+    def _capture_bracket_runs(self, settings_us:list[tuple], return_type:str=CAM_IMAGE) -> list:
+        #Capture a bracket with the sequencer. Split into runs which can be captured without changing sensor mode.
+        default_max = self.integration_time_range(time_unit=MICROSECONDS)[2]
+        if default_max is None:
+            default_max = self._get_integration_min_max(time_unit=MICROSECONDS)[1]
+        runs = []
+        for int_time_us, gain in settings_us:
+            mode = LONG_EXPOSURE if int_time_us > default_max else DEFAULT
+            if len(runs) == 0 or runs[-1][0] != mode:
+                runs.append((mode, []))
+            runs[-1][1].append((int_time_us, gain))
+        
+        images = []
+        for mode, run in runs:
+            self.change_sensor_mode(mode)
+            set_count = int(self.nodemap.SequencerSetSelector.max) + 1
+            for start in range(0, len(run), set_count):
+                images.extend(self._capture_sequence(run[start:start + set_count], return_type=return_type))
+        return images
+
+    def _capture_sequence(self, settings_us:list[tuple], return_type:str=CAM_IMAGE) -> list:
+        """
+        Upload integration time and gain settings to the sequencer and capture one frame with each.
+        All settings must fit in the current sensor mode and the sequencer's number of sets.
+
+        Args:
+            settings_us (list[tuple]): (integration time in microseconds, gain) of each frame
+            return_type (str): CAM_IMAGE or NDARRAY. Default is CAM_IMAGE.
+
+        Returns:
+            list: The captured images in the order of the settings. Frames which could not be fetched are None.
+        """
+        acquisition_state = self.device.is_acquiring()
+        acquisition_mode = self.nodemap.AcquisitionMode.value
+        buffer_handling_mode = self.ds_nodemap.StreamBufferHandlingMode.value
+        self.stop_acquisition()
+        
+        min_time, max_time = self._get_integration_min_max(time_unit=MICROSECONDS)
+        gain_min, gain_max = self._get_gain_min_max()
+        images = [None]*len(settings_us)
+        try:
+            with self.timer.phase("sequencer_upload"):
+                self.nodemap.SequencerMode.set_value("Off")
+                self.nodemap.SequencerConfigurationMode.set_value("On")
+                for index, (int_time_us, gain) in enumerate(settings_us):
+                    self.nodemap.SequencerSetSelector.set_value(index)
+                    self.nodemap.ExposureTime.set_value(max(min_time, min(max_time, int_time_us)))
+                    self.nodemap.Gain.set_value(max(gain_min, min(gain_max, gain)))
+                    #Each set moves on to the next one at the end of its frame
+                    self._set_node_if_available("SequencerPathSelector", 0)
+                    self._set_node_if_available("SequencerTriggerSource", "FrameEnd")
+                    self.nodemap.SequencerSetNext.set_value((index + 1) % len(settings_us))
+                    self.nodemap.SequencerSetSave.execute()
+                self.nodemap.SequencerSetStart.set_value(0)
+                self.nodemap.SequencerConfigurationMode.set_value("Off")
+                self.nodemap.SequencerMode.set_value("On")
+            
+            #Keep every frame of the bracket rather than only the newest
+            self.ds_nodemap.StreamBufferHandlingMode.set_value("OldestFirst")
+            self.nodemap.AcquisitionFrameCount.set_value(len(settings_us))
+            self.start_acquisition(mode=MULTI_FRAME)
+            
+            for index, (int_time_us, gain) in enumerate(settings_us):
+                try:
+                    with self.timer.phase("fetch"):
+                        buffer:Buffer = self.device.fetch(timeout=int_time_us/1e6 + 10)
+                    with self.timer.phase("chunk_update"):
+                        buffer.update_chunk_data()
+                    frame_time_us = self.nodemap.ChunkExposureTime.value
+                    frame_gain = self.nodemap.ChunkGain.value
+                    if abs(frame_time_us - int_time_us) > int_time_us/10:
+                        logger.warning(f"Bracket frame {index} exposure time {frame_time_us/1e6}s does not match target {int_time_us/1e6}s")
+                    images[index] = self._image_from_buffer(buffer, integration_time_us=frame_time_us, gain=frame_gain, return_type=return_type)
+                except Exception as e:
+                    logger.error(f"Error fetching bracket frame {index}")
+                    logger.exception(e)
+        finally:
+            self.stop_acquisition()
+            self.nodemap.SequencerMode.set_value("Off")
+            self.ds_nodemap.StreamBufferHandlingMode.set_value(buffer_handling_mode)
+            self.nodemap.AcquisitionMode.set_value(acquisition_mode)
+            if acquisition_state:
+                self.start_acquisition(mode=acquisition_mode)
+        return images
     
     
     def start_continuous_capture(self, callback,  callback_args=[], auto:bool=False, integration_time_us=None, gain:float=None, callback_as_thread:bool=True):
+        """
+        Capture continuously on a background thread, calling a function with each frame, until stop_continous_capture.
+
+        Args:
+            callback (callable): Called with (image_array, integration_time_us, shape, *callback_args), where image_array
+                is a copy of the frame's raw pixel data and shape is its (height, width)
+            callback_args (list, optional): Extra arguments of the callback. Default is [].
+            auto (bool, optional): Use the camera's continuous auto exposure. Default is False.
+            integration_time_us (float, optional): Integration time if not auto. Default is None (unchanged).
+            gain (float, optional): Not used. Default is None.
+            callback_as_thread (bool, optional): Run the callback on its own thread, so a slow callback doesn't hold up
+                fetching. The newest frame wins - a frame which arrives while the callback is busy replaces any frame
+                still waiting for it. Otherwise the callback runs on the capture thread. Default is True.
+        """
         self.cap_thread = threading.Thread(target=self._continous_capture_thread, args = [callback, callback_args, auto, integration_time_us, gain, callback_as_thread], daemon=True)
         self.cap_thread.daemon = True
         self.cap_thread.start()
@@ -275,7 +575,28 @@ class Camera:
         self.stop_capture = False
         if auto:
             self.nodemap.ExposureAuto.set_value(CONTINUOUS)
+
+        #Newest frame not yet passed to the callback thread
+        frame_ready = threading.Condition()
+        waiting_frame:list = []
+
+        def callback_worker():
+            while True:
+                with frame_ready:
+                    while len(waiting_frame) == 0 and not self.stop_capture:
+                        frame_ready.wait()
+                    if len(waiting_frame) == 0:
+                        return
+                    frame = waiting_frame.pop()
+                try:
+                    callback(*frame, *callback_args)
+                except Exception as e:
+                    traceback.print_exception(e)
+
         callback_thread:threading.Thread = None
+        if callback_as_thread:
+            callback_thread = threading.Thread(target=callback_worker, name="capture_callback", daemon=True)
+            callback_thread.start()
         self.start_acquisition()
         while not self.stop_capture:
             try:
@@ -284,19 +605,25 @@ class Camera:
                 with self.device.fetch() as buffer:
                     component = buffer.payload.components[0]
                     image_array = component.data.copy()
-                    shape = np.array((component.height, component.width)).copy()
+                    shape = (component.height, component.width)
                     integration_time_us = self.nodemap.ChunkExposureTime.value
-                    if callback_as_thread:
-                        callback_thread = threading.Thread(target=callback, args=[image_array, integration_time_us, shape, *callback_args], daemon=True)
-                        callback_thread.daemon = True
-                        callback_thread.start()
-                    else:
-                        callback(image_array, integration_time_us, callback_args)
+                if callback_as_thread:
+                    with frame_ready:
+                        waiting_frame[:] = [(image_array, integration_time_us, shape)]
+                        frame_ready.notify()
+                else:
+                    callback(image_array, integration_time_us, shape, *callback_args)
             except Exception as e:
                 traceback.print_exception(e)
                 self.stop_capture = True
                 break
 
+        if callback_thread is not None:
+            with frame_ready:
+                self.stop_capture = True
+                waiting_frame.clear()
+                frame_ready.notify()
+            callback_thread.join()
         self.stop_acquisition()
         self.nodemap.ExposureAuto.set_value(auto_value)
         self.change_sensor_mode(sensor_mode)
@@ -371,7 +698,45 @@ class Camera:
         max_time = convert_time(self.nodemap.ExposureTime.max, MICROSECONDS, time_unit)
         return min_time, max_time
     
+    def _record_integration_min_max(self):
+        """
+        Record the integration time limits (in microseconds) of the current sensor mode.
+        """
+        try:
+            self.sensor_mode_limits[self.nodemap.SensorOperationMode.value] = self._get_integration_min_max(time_unit=MICROSECONDS)
+        except Exception as e:
+            logger.warning("Could not read integration time limits")
+            logger.exception(e)
+
+    def integration_time_range(self, time_unit:str=MICROSECONDS) -> tuple:
+        """
+        Get the integration time limits over all sensor modes visited so far, and the longest integration
+        time available without switching to the long exposure sensor mode.
+
+        Args:
+            time_unit (str): The unit of time to convert the integration times to. Default is MICROSECONDS.
+
+        Returns:
+            tuple: (minimum, maximum, default mode maximum). The default mode maximum is None if the default mode has not been visited.
+        """
+        if len(self.sensor_mode_limits) == 0:
+            self._record_integration_min_max()
+        min_time = min(limits[0] for limits in self.sensor_mode_limits.values())
+        max_time = max(limits[1] for limits in self.sensor_mode_limits.values())
+        default_max = self.sensor_mode_limits[DEFAULT][1] if DEFAULT in self.sensor_mode_limits else None
+        if LONG_EXPOSURE not in self.sensor_mode_limits:
+            #The long exposure mode maximum is not known until it has been visited, so don't limit the maximum
+            max_time = None
+        convert = lambda value: None if value is None else convert_time(value, MICROSECONDS, time_unit)
+        return convert(min_time), convert(max_time), convert(default_max)
+
     def integration_time(self, time:float=None, time_unit:str=MICROSECONDS):
+        if time is None:
+            return self._integration_time(time=time, time_unit=time_unit)
+        with self.timer.phase("set_integration_time"):
+            return self._integration_time(time=time, time_unit=time_unit)
+
+    def _integration_time(self, time:float=None, time_unit:str=MICROSECONDS):
         try:
 
 
@@ -433,6 +798,10 @@ class Camera:
             return None
         
     def change_sensor_mode(self, mode:str=DEFAULT):
+        with self.timer.phase("sensor_mode_switch"):
+            self._change_sensor_mode(mode)
+
+    def _change_sensor_mode(self, mode:str=DEFAULT):
         logger.info(f"Changing sensor mode to {mode}")
 
         if mode not in [DEFAULT, LONG_EXPOSURE, "UserSet0", "UserSet1"]:
@@ -461,17 +830,144 @@ class Camera:
         self.nodemap.UserSetSelector.set_value(mode)
         self.nodemap.UserSetLoad.execute()
         
+        #Loading the user set resets binning, decimation and the region of interest
+        self._apply_capture_profile()
         self.nodemap.PixelFormat.set_value(current_pixel_format)
         self.nodemap.Gain.set_value(current_gain)
         self.ds_nodemap.StreamBufferHandlingMode.set_value(current_buffer_handling_mode)
         self.nodemap.AcquisitionMode.set_value(acquisition_mode)
         
+        self._record_integration_min_max()
+
         if acquisition_state:
             logger.info("Resuming acquisition")
             self.start_acquisition()
 
         logger.info(f"Mode changed to {self.nodemap.AcquisitionMode.value}")
     
+    def set_capture_profile(self, profile:str=FULL, roi_margin:int=None):
+        """
+        Set the capture profile, which configures on-camera binning or decimation and crops the image to a region
+        of interest around the active area. Reducing the image on the camera reduces the USB bandwidth, copy cost and
+        processing time of each frame. Acquisition is stopped while the profile is changed.
+
+        Args:
+            profile (str): One of FULL, ROI, BINNED, DECIMATED or DECIMATED_4. Default is FULL.
+            roi_margin (int, optional): Margin around the active area kept in the region of interest, in full resolution pixels.
+
+        Returns:
+            str: The profile set
+        """
+        if profile not in CAPTURE_PROFILES:
+            logger.error(f"Capture profile {profile} is invalid")
+            raise ValueError(f"Invalid Capture Profile. Valid profiles: {list(CAPTURE_PROFILES.keys())}")
+        if roi_margin is not None:
+            self.roi_margin = roi_margin
+        if profile == self.capture_profile and roi_margin is None:
+            return profile
+
+        with self.timer.phase("capture_profile_switch"):
+            acquisition_state = self.device.is_acquiring()
+            self.stop_acquisition()
+            self.capture_profile = profile
+            self._apply_capture_profile()
+            self._record_integration_min_max()
+            if acquisition_state:
+                self.start_acquisition()
+        logger.info(f"Capture profile set to {profile} - offset: {self.roi_offset}, scale: {self.pixel_scale}, size: {self.nodemap.Width.value}x{self.nodemap.Height.value}")
+        return profile
+
+    def _apply_capture_profile(self):
+        """
+        Write the current capture profile to the camera. Acquisition must be stopped.
+        """
+        settings = CAPTURE_PROFILES[self.capture_profile]
+
+        #Reset the region of interest to the full sensor before changing binning or decimation as they change the maximum size
+        self._set_node_if_available("OffsetX", 0)
+        self._set_node_if_available("OffsetY", 0)
+        
+        scale = 1
+        scale *= self._set_pixel_reduction("Binning", settings["binning"])
+        scale *= self._set_pixel_reduction("Decimation", settings["decimation"])
+        
+        self.nodemap.Width.set_value(self.nodemap.Width.max)
+        self.nodemap.Height.set_value(self.nodemap.Height.max)
+        
+        offset = (0, 0)
+        if settings["roi"]:
+            offset = self._set_roi(scale)
+        
+        self.pixel_scale = scale
+        self.roi_offset = offset
+
+    def _set_node_if_available(self, name:str, value) -> bool:
+        try:
+            getattr(self.nodemap, name).set_value(value)
+            return True
+        except Exception:
+            return False
+
+    def _set_pixel_reduction(self, node_prefix:str, factor:int) -> int:
+        """
+        Set on-camera binning or decimation in both axes.
+
+        Args:
+            node_prefix (str): "Binning" or "Decimation"
+            factor (int): Number of pixels along each axis to combine
+
+        Returns:
+            int: The factor applied (1 if the camera does not support it)
+        """
+        try:
+            horizontal = getattr(self.nodemap, f"{node_prefix}Horizontal")
+            vertical = getattr(self.nodemap, f"{node_prefix}Vertical")
+            factor = int(min(factor, horizontal.max, vertical.max))
+            if node_prefix == "Binning":
+                #Average rather than sum binned pixels so integration times are comparable with unbinned images
+                self._set_node_if_available("BinningHorizontalMode", "Average")
+                self._set_node_if_available("BinningVerticalMode", "Average")
+            horizontal.set_value(factor)
+            vertical.set_value(factor)
+            return factor
+        except Exception as e:
+            if factor > 1:
+                logger.warning(f"Camera does not support {node_prefix.lower()} - using a factor of 1")
+                logger.exception(e)
+            return 1
+
+    def _set_roi(self, scale:int) -> tuple:
+        """
+        Crop the image to the bounding box of the active area plus the ROI margin.
+
+        Args:
+            scale (int): Current binning/decimation factor
+
+        Returns:
+            tuple: (x, y) offset of the region of interest in full resolution pixels
+        """
+        radius = ACTIVE_AREA_RADIUS + self.roi_margin
+        
+        def axis(centre:float, size_node, offset_node) -> tuple:
+            #Keep offsets and sizes even so the Bayer pattern is unchanged
+            increment = max(2, int(size_node.inc), int(offset_node.inc))
+            start = max(0, (centre - radius) / scale)
+            start = int(start // increment) * increment
+            end = min(size_node.max, math.ceil((centre + radius) / scale))
+            size = int(math.ceil((end - start) / increment)) * increment
+            size = min(size, int((size_node.max - start) // increment) * increment)
+            return start, size
+        
+        left, width = axis(ACTIVE_AREA_CENTRE[0], self.nodemap.Width, self.nodemap.OffsetX)
+        top, height = axis(ACTIVE_AREA_CENTRE[1], self.nodemap.Height, self.nodemap.OffsetY)
+        
+        self.nodemap.Width.set_value(width)
+        self.nodemap.Height.set_value(height)
+        self.nodemap.OffsetX.set_value(left)
+        self.nodemap.OffsetY.set_value(top)
+        
+        return (left*scale, top*scale)
+    
     def _get_gain_min_max(self):
         return self.nodemap.Gain.min, self.nodemap.Gain.max
     
@@ -482,10 +978,11 @@ class Camera:
             if gain < 0:
                 raise ValueError("Gain must be positive")
             
-            gain_min, gain_max = self._get_gain_min_max()
-            gain = max(gain_min, min(gain_max, gain))
-            
-            self.nodemap.Gain.set_value(gain)
+            with self.timer.phase("set_gain"):
+                gain_min, gain_max = self._get_gain_min_max()
+                gain = max(gain_min, min(gain_max, gain))
+                
+                self.nodemap.Gain.set_value(gain)
             return self.nodemap.Gain.value
         except Exception as e:
             print("Problem setting gain")
@@ -519,9 +1016,16 @@ class Camera:
             self.device.stop()
     
     def disconnect(self):
+        global _harvester
         self.stop_acquisition()
         self.device.destroy()
-        self.harvester.reset()
+        if self in _open_cameras:
+            _open_cameras.remove(self)
+        #Only reset the shared harvester once the last camera is closed
+        with _harvester_lock:
+            if len(_open_cameras) == 0 and _harvester is not None:
+                _harvester.reset()
+                _harvester = None
         
     def print_settings(self):
         print("User Set: ", self.nodemap.UserSetSelector.value)
@@ -570,7 +1074,69 @@ class Camera:
             
     def _valid_pixel_formats(self):
         return self.nodemap.PixelFormat._get_symbolics()
+
+    @property
+    def pixel_format(self) -> str:
+        return self.nodemap.PixelFormat.value
+
+    @property
+    def bit_depth(self) -> int:
+        return pixel_formats.bit_depth(self.pixel_format)
+
+    def set_pixel_format(self, format:str) -> str:
+        """
+        Set the pixel format. Acquisition is stopped while the format is changed.
+
+        Args:
+            format (str): GenICam pixel format name. Must be offered by the camera and listed in pixel_formats.FORMATS.
+
+        Returns:
+            str: The pixel format set
+        """
+        if format not in self._valid_pixel_formats() or format not in pixel_formats.FORMATS:
+            logger.error(f"Pixel format {format} is not available")
+            raise ValueError(f"Invalid Pixel Format. Available formats: {[name for name in self._valid_pixel_formats() if name in pixel_formats.FORMATS]}")
+        if format == self.nodemap.PixelFormat.value:
+            return format
         
+        acquisition_state = self.device.is_acquiring()
+        self.stop_acquisition()
+        self.nodemap.PixelFormat.set_value(format)
+        if acquisition_state:
+            self.start_acquisition()
+        logger.info(f"Pixel format set to {format}")
+        return format
+
+    def set_bit_depth(self, bits:int=8, packed:bool=True) -> str:
+        """
+        Set the pixel format to the format closest to a bit depth, keeping the current colour (Bayer) or monochrome type.
+
+        Args:
+            bits (int): Bit depth (8, 10 or 12). Default is 8.
+            packed (bool): Prefer packed formats, which halve the USB bandwidth of 10 and 12-bit images
+                at the cost of unpacking them on the host. Default is True.
+
+        Returns:
+            str: The pixel format set
+        """
+        format = pixel_formats.choose_format(self._valid_pixel_formats(), bayer=pixel_formats.is_bayer(self.pixel_format), bits=bits, packed=packed)
+        if format is None:
+            logger.warning(f"No supported {bits}-bit pixel format - keeping {self.pixel_format}")
+            return self.pixel_format
+        if pixel_formats.bit_depth(format) != bits:
+            logger.warning(f"No {bits}-bit pixel format available - using {format}")
+        return self.set_pixel_format(format)
+        
+    def save_node_snapshot(self) -> Path:
+        """
+        Save a snapshot of the value, type and limits of every readable node of the camera, used to look up nodes
+        without connecting to the camera (see nodes.py).
+
+        Returns:
+            Path: The snapshot file
+        """
+        return nodes.save(nodes.snapshot(self.nodemap, self.serial_number))
+
     def _node_list(self, nodemap=None):
         if nodemap is None:
             nodemap = self.nodemap
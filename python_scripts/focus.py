@@ -1,49 +1,224 @@
+#Focus assistant - shows how sharp the centre of the image is while the lens is adjusted, with the peak and trend so
+#the best focus can be found by turning through it and back.
+import logging
+import sys
+import threading
+from collections import deque
+from time import time, monotonic, sleep
 import numpy as np
-import time
 import device_interface
-import traceback
 
- 
-def run_focus_script():
-    cam:device_interface.Camera = device_interface.open()
+logger = logging.getLogger()
+
+#Sharpness metrics
+SOBEL = "sobel"
+""" Mean squared Sobel gradient (Tenengrad) - steady, good for most scenes """
+LAPLACIAN = "laplacian"
+""" Variance of the Laplacian - more sensitive to fine detail, and to noise """
+METRICS = [SOBEL, LAPLACIAN]
+
+#Sharpness is measured on this fraction of the image width and height around the centre,
+CENTRE_FRACTION = 1/3
+#limited to this many 2x2 cells across and down, so each measurement costs about the same whatever the image size
+MAX_WINDOW_CELLS = (320, 240)
+#Default sharpness measurements (and display updates) per second
+TARGET_RATE_HZ = 10
+#Capture profile while focusing - on-camera binning quarters the USB bandwidth and the copy of each frame
+FOCUS_PROFILE = device_interface.BINNED
+#Measurements kept for the rolling peak and the trend
+HISTORY_SECS = 10
+#Measurements compared for the trend, in seconds
+TREND_SECS = 1
+#Relative change in sharpness over TREND_SECS shown as rising or falling
+TREND_THRESHOLD = 0.02
+#Width of the sharpness bar in characters
+BAR_WIDTH = 30
+
+
+def centre_cells(image_array:np.ndarray, centre_fraction:float=CENTRE_FRACTION, max_cells:tuple[int, int]=MAX_WINDOW_CELLS) -> np.ndarray:
+    """The centre of a raw image with each 2x2 cell summed, so the Bayer pattern of a colour image doesn't show up as
+    detail. Only the window is converted, so the cost is bounded by max_cells.
+
+    Args:
+        image_array (np.ndarray): Raw image array (height, width)
+        centre_fraction (float, optional): Fraction of the width and height used. Defaults to CENTRE_FRACTION.
+        max_cells (tuple[int, int], optional): Largest window in cells across and down. Defaults to MAX_WINDOW_CELLS.
+
+    Returns:
+        np.ndarray: Integer array of cell sums
+    """
+    height, width = image_array.shape[0:2]
+    columns = max(3, min(max_cells[0], int(width * centre_fraction) // 2))
+    rows = max(3, min(max_cells[1], int(height * centre_fraction) // 2))
+    #Keep to whole cells so every cell has the same colour filters
+    left = max(0, (width - 2*columns) // 4 * 2)
+    top = max(0, (height - 2*rows) // 4 * 2)
+    window = image_array[top:top + 2*rows, left:left + 2*columns].astype(np.int32)
+    rows, columns = window.shape[0] // 2, window.shape[1] // 2
+    return window[:2*rows, :2*columns].reshape(rows, 2, columns, 2).sum(axis=(1, 3))
+
+
+def sharpness(cells:np.ndarray, metric:str=SOBEL) -> float:
+    """Sharpness of an image window in integer arithmetic, relative to its mean brightness squared so changes in
+    exposure or gain don't show up as changes in focus. Only comparable between windows of the same scene.
+
+    Args:
+        cells (np.ndarray): Integer array of pixel (or cell) values, e.g. from centre_cells
+        metric (str, optional): SOBEL or LAPLACIAN. Defaults to SOBEL.
+
+    Returns:
+        float: Sharpness (higher is sharper), or 0 if the window is black
+    """
+    match metric:
+        case "sobel":
+            horizontal = cells[:, 2:] - cells[:, :-2]
+            vertical = cells[2:, :] - cells[:-2, :]
+            gradient_x = (horizontal[:-2] + 2*horizontal[1:-1] + horizontal[2:]).astype(np.int64)
+            gradient_y = (vertical[:, :-2] + 2*vertical[:, 1:-1] + vertical[:, 2:]).astype(np.int64)
+            value = (np.sum(gradient_x * gradient_x) + np.sum(gradient_y * gradient_y)) / gradient_x.size
+        case "laplacian":
+            laplacian = (4*cells[1:-1, 1:-1] - cells[:-2, 1:-1] - cells[2:, 1:-1] - cells[1:-1, :-2] - cells[1:-1, 2:]).astype(np.int64)
+            total = int(np.sum(laplacian))
+            value = (np.sum(laplacian * laplacian) - total * total / laplacian.size) / laplacian.size
+        case _:
+            raise ValueError(f"Unknown sharpness metric {metric} - use one of {METRICS}")
+    mean = int(np.sum(cells, dtype=np.int64)) / cells.size
+    return float(1000 * value / (mean * mean)) if mean > 0 else 0.0
+
+
+class FocusTracker:
+    """Rolling history of sharpness measurements, with the peak of the history, the best measurement since the tracker
+    was created, and the trend."""
+
+    def __init__(self, history_secs:float=HISTORY_SECS, trend_secs:float=TREND_SECS) -> None:
+        self.history_secs = history_secs
+        self.trend_secs = trend_secs
+        self._history:deque[tuple[float, float]] = deque()
+        self.best = 0.0
+
+    def add(self, value:float, timestamp:float=None):
+        timestamp = time() if timestamp is None else timestamp
+        self._history.append((timestamp, value))
+        while self._history[0][0] < timestamp - self.history_secs:
+            self._history.popleft()
+        self.best = max(self.best, value)
+
+    @property
+    def latest(self) -> float:
+        return self._history[-1][1] if len(self._history) > 0 else 0.0
+
+    @property
+    def peak(self) -> float:
+        """Highest sharpness in the history."""
+        return max([value for _, value in self._history], default=0.0)
+
+    def trend(self) -> float:
+        """Change in mean sharpness between the last trend_secs and the trend_secs before, relative to the peak."""
+        if len(self._history) < 2:
+            return 0.0
+        now = self._history[-1][0]
+        recent = [value for timestamp, value in self._history if timestamp > now - self.trend_secs]
+        previous = [value for timestamp, value in self._history if now - 2*self.trend_secs < timestamp <= now - self.trend_secs]
+        peak = self.peak
+        if len(previous) == 0 or peak <= 0:
+            return 0.0
+        return (sum(recent) / len(recent) - sum(previous) / len(previous)) / peak
+
+    def __str__(self) -> str:
+        peak = self.peak
+        fraction = self.latest / peak if peak > 0 else 0
+        filled = int(round(fraction * BAR_WIDTH))
+        trend = self.trend()
+        direction = "rising " if trend > TREND_THRESHOLD else "falling" if trend < -TREND_THRESHOLD else "steady "
+        return (f"Sharpness {self.latest:9.2f} [{'#' * filled}{'-' * (BAR_WIDTH - filled)}] {fraction:4.0%} of peak "
+                f"{peak:.2f} - {direction} (best {self.best:.2f})")
+
+
+class FocusAssistant:
+    """Measures the sharpness of frames from the camera's continuous capture at a fixed rate and shows it on one line.
+
+    Frames are passed to measure on the capture callback thread, newest first (see
+    device_interface.Camera.start_continuous_capture), so a measurement is always of the newest frame and the display
+    never lags behind the lens. Measurements are held to rate_hz, and frames which arrive in between are dropped.
+    """
+
+    def __init__(self, metric:str=SOBEL, rate_hz:float=TARGET_RATE_HZ) -> None:
+        if metric not in METRICS:
+            raise ValueError(f"Unknown sharpness metric {metric} - use one of {METRICS}")
+        self.metric = metric
+        self.period = 1 / max(0.1, rate_hz)
+        self.tracker = FocusTracker()
+        self.measurements = 0
+        self._next_measurement = monotonic()
+        #Measurement time and rate, for the display
+        self._measure_secs = 0.0
+        self._rate_hz = 0.0
+        self._last_measurement:float = None
+        self._lock = threading.Lock()
+
+    def measure(self, image_array:np.ndarray, integration_time_us:float, shape:tuple):
+        with self._lock:
+            start = monotonic()
+            value = sharpness(centre_cells(image_array.reshape(shape)), self.metric)
+            self.tracker.add(value)
+            self.measurements += 1
+            self._measure_secs = monotonic() - start
+            if self._last_measurement is not None:
+                rate_hz = 1 / max(1e-6, start - self._last_measurement)
+                self._rate_hz = rate_hz if self._rate_hz == 0 else 0.8 * self._rate_hz + 0.2 * rate_hz
+            self._last_measurement = start
+            print(f"\r{self.tracker} | {integration_time_us/1e3:7.2f}ms exposure | {self._rate_hz:4.1f}/s, "
+                  f"{self._measure_secs*1e3:4.1f}ms each\033[K", end="", flush=True)
+            #Keep to the rate without drifting, but don't try to catch up
+            self._next_measurement = max(self._next_measurement + self.period, monotonic())
+            sleep(max(0, self._next_measurement - monotonic()))
+
+
+def _set_frame_rate(cam:device_interface.Camera, rate_hz:float) -> float|None:
+    #Limit the camera's frame rate so frames which would be dropped aren't sent and copied. Returns the previous rate.
+    try:
+        previous = cam.nodemap.AcquisitionFrameRate.value
+        node = cam.nodemap.AcquisitionFrameRate
+        node.set_value(max(node.min, min(node.max, rate_hz)))
+        return previous
+    except Exception:
+        return None
+
+
+def run_focus_script(serial_number:str=None, metric:str=SOBEL, rate_hz:float=TARGET_RATE_HZ, profile:str=FOCUS_PROFILE):
+    """Show the sharpness of the centre of the image until Ctrl+C is pressed.
+
+    Args:
+        serial_number (str, optional): Serial number of the camera. Defaults to the first camera found.
+        metric (str, optional): Sharpness metric, SOBEL or LAPLACIAN. Defaults to SOBEL.
+        rate_hz (float, optional): Measurements per second. Defaults to TARGET_RATE_HZ.
+        profile (str, optional): Capture profile while focusing. Defaults to FOCUS_PROFILE.
+    """
+    assistant = FocusAssistant(metric=metric, rate_hz=rate_hz)
+    cam:device_interface.Camera = device_interface.open(serial_number=serial_number)
     if cam is None:
         print("No camera found")
-        exit()
-
-    def calc_focus(image_array:np.ndarray, integration_time_us, shape, *args):
-        image_array = image_array.reshape(shape)
-        height, width = shape
-        centre_array = image_array[int(height/2-height/6):int(height/2+height/6), int(width/2-width/6):int(width/2+width/6)]
-        gy, gx = np.gradient(centre_array)
-        gnorm = np.sqrt(gx**2 + gy**2)
-        sharpness = np.average(gnorm)
-        print(f"Sharpness: {round(sharpness, 2)} - Int Time: {str(round(integration_time_us/1e3, 2)).ljust(6, '0')}ms - T: {round(cam.temp)}°C                ", end="\r", flush=True)    
+        sys.exit(1)
 
+    original_profile = cam.capture_profile
+    cam.set_capture_profile(profile)
+    original_frame_rate = _set_frame_rate(cam, rate_hz)
     cam.set_to_manual()
     cam.set_auto_params(target=240, tolerance=5, percentile=10, max_int=100, time_unit=device_interface.MILLISECONDS)
-
     cam.integration_time(150)
-    cam.start_continuous_capture(callback=calc_focus, auto=True, callback_as_thread=True)
-
-
-    capturing = True
-    while capturing:
-        try:
-            time.sleep(0.01)
-        except KeyboardInterrupt:
-            cam.stop_continous_capture()
-            capturing = False
-            print("\nExiting...")
-            break
-        except Exception as e:
-            traceback.print_exception(e)
-            break
-
-    while cam.acquiring:
-        time.sleep(0.01)
-        print("Exiting...                                                                                                  ", end="\r")
-        
-    print("\nDone")
-
-
-        
\ No newline at end of file
+
+    print(f"Measuring {metric} sharpness at up to {rate_hz:g} per second - turn the focus through the peak and back. Ctrl+C to exit.")
+    cam.start_continuous_capture(callback=assistant.measure, auto=True, callback_as_thread=True)
+    try:
+        while cam.cap_thread.is_alive():
+            sleep(0.1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\nExiting...")
+        cam.stop_continous_capture()
+        if original_frame_rate is not None:
+            _set_frame_rate(cam, original_frame_rate)
+        cam.set_capture_profile(original_profile)
+        cam.disconnect()
+    print(f"Best sharpness {assistant.tracker.best:.2f} ({assistant.measurements} measurements)")
@@ -0,0 +1,148 @@
+import numpy as np
+import logging
+
+from cam_image import Cam_Image
+import pixel_formats
+from auto_exposure import gain_to_linear
+
+logger = logging.getLogger()
+
+#Rows of the image fused at a time. Limits the memory of the stacked frames to a few MB per frame.
+ROWS_PER_BLOCK = 256
+#Percentile of the radiance of unsaturated pixels which sets the scale of the fused image, so a few hot or specular
+#pixels don't set the scale of the whole image
+SCALE_PERCENTILE = 99.9
+#Fraction of the 16-bit range the SCALE_PERCENTILE pixel is scaled to, leaving headroom for the brighter pixels
+SCALE_LEVEL = 0.5
+#Step between the pixels sampled for the percentile. Odd, so every colour of a Bayer mosaic is sampled.
+SCALE_SAMPLE_STEP = 7
+
+
+def weights(values:np.ndarray, saturation_threshold:float, black_level:float=0.0) -> np.ndarray:
+    """Weight of each pixel value in the fusion. A triangle (hat) function which is highest at mid scale and zero
+    for values at or below the black level and above the saturation threshold, where the value carries no
+    information about the radiance.
+
+    Args:
+        values (np.ndarray): Raw pixel values
+        saturation_threshold (float): Pixel value above which a pixel counts as saturated
+        black_level (float, optional): Pixel value of an unexposed pixel. Defaults to 0.
+
+    Returns:
+        np.ndarray: Weights from 0 to 0.5 of the same shape as values
+    """
+    position = (values - black_level) / (saturation_threshold - black_level)
+    weight = np.minimum(position, 1 - position)
+    weight[values > saturation_threshold] = 0
+    return np.clip(weight, 0, None)
+
+
+def radiance_map(arrays:list[np.ndarray], exposures:list[float], saturation_threshold:float, black_level:float=0.0, rows_per_block:int=ROWS_PER_BLOCK) -> np.ndarray:
+    """Merge raw frames of different exposures into one map of relative radiance (pixel value per second of
+    integration at a linear gain of 1).
+
+    Each frame's estimate of the radiance (value / exposure) is averaged, weighted by how well exposed the pixel is
+    and by the exposure (longer exposures have less relative noise). Pixels which are saturated in every frame take
+    the estimate of the shortest exposure and pixels which are dark in every frame take the estimate of the longest.
+    Works on any raw layout including Bayer mosaics as every pixel is fused independently.
+
+    Args:
+        arrays (list[np.ndarray]): Raw frames of the same shape
+        exposures (list[float]): Integration time in seconds multiplied by the linear gain of each frame
+        saturation_threshold (float): Pixel value above which a pixel counts as saturated
+        black_level (float, optional): Pixel value of an unexposed pixel. Defaults to 0.
+        rows_per_block (int, optional): Rows fused at a time. Defaults to ROWS_PER_BLOCK.
+
+    Returns:
+        np.ndarray: float32 radiance map of the same shape as the frames
+    """
+    exposures = np.asarray(exposures, dtype=np.float32)
+    order = np.argsort(exposures)
+    arrays = [arrays[index] for index in order]
+    exposures = exposures[order]
+    exposure_column = exposures.reshape(-1, *([1] * arrays[0].ndim))
+
+    radiance = np.empty(arrays[0].shape, dtype=np.float32)
+    for start in range(0, arrays[0].shape[0], rows_per_block):
+        block = slice(start, start + rows_per_block)
+        values = np.stack([array[block] for array in arrays]).astype(np.float32)
+        weight = weights(values, saturation_threshold, black_level) * exposure_column
+        estimates = (values - black_level) / exposure_column
+        weight_sum = weight.sum(axis=0)
+        fused = (weight * estimates).sum(axis=0) / np.maximum(weight_sum, 1e-12)
+
+        unweighted = weight_sum == 0
+        if unweighted.any():
+            fallback = np.where(values[-1] <= saturation_threshold, estimates[-1], estimates[0])
+            fused[unweighted] = fallback[unweighted]
+        radiance[block] = np.clip(fused, 0, None)
+    return radiance
+
+
+def fuse(images:list[Cam_Image], black_level:float=0.0, rows_per_block:int=ROWS_PER_BLOCK) -> Cam_Image:
+    """Fuse a bracket of images of the same scene into a single 16-bit image.
+
+    The radiance map is scaled so the SCALE_PERCENTILE of its unsaturated pixels reaches SCALE_LEVEL of the 16-bit
+    range, and the returned image is given the equivalent integration time and the gain of the first image, so region
+    statistics and luminance are calculated in the same way as for a single exposure. Only pixels saturated in every
+    image of the bracket are stored at full scale and count as saturated - brighter pixels clipped by the scaling are
+    stored just below it. Metadata (timestamp, depth, etc) is taken from the first image.
+
+    Args:
+        images (list[Cam_Image]): Images to fuse, with the same shape and format type (Bayer or monochrome)
+        black_level (float, optional): Pixel value of an unexposed pixel at the bit depth of the images. Defaults to 0.
+        rows_per_block (int, optional): Rows fused at a time. Defaults to ROWS_PER_BLOCK.
+
+    Returns:
+        Cam_Image: Fused image in BayerRG16 or Mono16 format
+    """
+    images = [image for image in images if image is not None]
+    if len(images) == 0:
+        raise ValueError("No images to fuse")
+    reference = images[0]
+    if len(images) == 1:
+        return reference
+    if any(image.original_image_array.shape != reference.original_image_array.shape for image in images):
+        raise ValueError("Images to fuse must have the same shape")
+
+    bayer = pixel_formats.is_bayer(reference.format)
+    if any(pixel_formats.is_bayer(image.format) != bayer for image in images):
+        raise ValueError("Images to fuse must all be Bayer or all be monochrome")
+
+    #Frames may have different bit depths, so bring them all to the deepest
+    bits = max(image.bit_depth for image in images)
+    arrays = [image.original_image_array.astype(np.uint16) << (bits - image.bit_depth) for image in images]
+    saturation_threshold = min(image.saturation_threshold * 2**(bits - image.bit_depth) for image in images)
+    exposures = [image.integration_time_secs * gain_to_linear(image.gain) for image in images]
+
+    radiance = radiance_map(arrays, exposures, saturation_threshold, black_level=black_level, rows_per_block=rows_per_block)
+    #Saturated in the shortest exposure, so saturated in all of them
+    saturated = arrays[int(np.argmin(exposures))] > saturation_threshold
+
+    #Scale the radiance from a high percentile of the unsaturated pixels rather than the brightest pixel
+    full_scale = 2**16 - 1
+    sample = radiance[~saturated].ravel()[::SCALE_SAMPLE_STEP]
+    scale_radiance = float(np.percentile(sample, SCALE_PERCENTILE)) if sample.size > 0 else 0.0
+    equivalent_exposure = SCALE_LEVEL * full_scale / scale_radiance if scale_radiance > 0 else max(exposures)
+    fused_array = np.rint(np.clip(radiance * equivalent_exposure, 0, full_scale - 1)).astype(np.uint16)
+    fused_array[saturated] = full_scale
+    integration_time_us = equivalent_exposure / gain_to_linear(reference.gain) * 1e6
+
+    logger.info(f"Fused {len(images)} images - exposures {min(exposures):.6f}s to {max(exposures):.6f}s, equivalent integration time {integration_time_us/1e6:.6f}s")
+
+    return Cam_Image(fused_array,
+                     format="BayerRG16" if bayer else "Mono16",
+                     timestamp=reference.timestamp,
+                     integration_time_us=integration_time_us,
+                     gain=reference.gain,
+                     aperture=reference.aperture,
+                     auto=reference.auto,
+                     depth=reference.depth,
+                     pressure=reference.pressure,
+                     cam_temp=float(np.mean([image.cam_temp for image in images if image.cam_temp is not None])) if reference.cam_temp is not None else None,
+                     environment_temp=reference.environment_temp,
+                     offset=reference.offset,
+                     scale=reference.scale,
+                     saturation_threshold=full_scale - 1,
+                     camera_id=reference.camera_id,
+                     fused_frames=len(images))
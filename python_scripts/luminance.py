@@ -7,16 +7,17 @@ import traceback
 ISO = "ISO"
 DB = "DB"
  
-def normalise_colours(image_array : np.ndarray) -> np.ndarray:
-    """Normalises 8-bit RGB values (0-255) to non-linear sR'G'B' values (0-1)
+def normalise_colours(image_array : np.ndarray, max_value:int=255) -> np.ndarray:
+    """Normalises RGB values (0-max_value, e.g. 0-255 for 8-bit) to non-linear sR'G'B' values (0-1)
 
     Args:
         image_array (np.array): numpy array of image pixels
+        max_value (int, optional): Maximum pixel value of the image bit depth. Defaults to 255.
 
     Returns:
         numpy.array: Non-linear sR'G'B array
     """    
-    return  np.divide(image_array, 255)
+    return  np.divide(image_array, max_value)
 
 
 def linearise_colours(image_array : np.ndarray) -> np.ndarray:
@@ -68,11 +69,12 @@ def lin_sRGB_to_XYZ(colour : list[float]|tuple[float]|np.ndarray) -> tuple[float
     return xyz
 
 
-def calc_relative_luminance(image : Image.Image | np.ndarray, mask: Image.Image|np.ndarray = None, saturation_threshold:int=255) -> float:
+def calc_relative_luminance(image : Image.Image | np.ndarray, mask: Image.Image|np.ndarray = None, saturation_threshold:int=255, max_value:int=255) -> float:
     """Calculate relative luminance of an image in Candela per Sq. Meter (cd/m^2)
 
     Args:
         image (Image.Image | np.ndarray): PIL Image (Must be in RGB8 mode) or Numpy array containing RGB pixel values.
+        max_value (int, optional): Maximum pixel value of the image bit depth. Defaults to 255.
     Returns:
         float: relative luminance of image
     """    
@@ -89,7 +91,7 @@ def calc_relative_luminance(image : Image.Image | np.ndarray, mask: Image.Image|
         image = np.array(image)
         
     
-    norm_array = normalise_colours(image)
+    norm_array = normalise_colours(image, max_value=max_value)
 
     lin_array = linearise_colours(norm_array)
     
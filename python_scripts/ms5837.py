@@ -3,7 +3,9 @@ try:
 except:
     print('Try sudo apt-get install python-smbus2')
     
-from time import sleep
+from time import sleep, time, monotonic
+import asyncio
+import numpy as np
 
 # Models
 MODEL_02BA = 0
@@ -36,6 +38,20 @@ UNITS_Centigrade = 1
 UNITS_Farenheit  = 2
 UNITS_Kelvin     = 3
 
+# Conversion states (see startRead and poll)
+STATE_IDLE = 0
+STATE_CONVERTING_D1 = 1
+STATE_CONVERTING_D2 = 2
+
+# Fields of the arrays returned by readSamples
+SAMPLE_DTYPE = np.dtype([("time", np.float64), ("depth", np.float32), ("pressure", np.float32), ("temperature", np.float32)])
+
+# Maximum conversion time increases linearly with oversampling
+# max time (seconds) ~= 2.2e-6(x) where x = OSR = (2^8, 2^9, ..., 2^13)
+# We use 2.5e-6 for some overhead
+def conversionTime(oversampling=OSR_8192):
+    return 2.5e-6 * 2**(8+oversampling)
+
     
 class MS5837(object):
     
@@ -63,6 +79,13 @@ class MS5837(object):
         self._D1 = 0
         self._D2 = 0
         
+        # Non-blocking conversion state
+        self._state = STATE_IDLE
+        self._oversampling = OSR_8192
+        self._deadline = None
+        self._readStart = None
+        self._readTime = None
+        
     def init(self):
         if self._bus is None:
             "No bus!"
@@ -88,7 +111,38 @@ class MS5837(object):
         
         return True
         
+    # Blocking read of pressure and temperature. Takes two conversion times (about 40ms at OSR_8192)
     def read(self, oversampling=OSR_8192):
+        if not self.startRead(oversampling):
+            return False
+        
+        try:
+            while not self.poll():
+                sleep(max(0, self._deadline - monotonic()))
+        except:
+            self.cancelRead()
+            raise
+        
+        return True
+    
+    # Asynchronous read for asyncio event loops - the loop is free while the sensor converts
+    async def readAsync(self, oversampling=OSR_8192):
+        if not self.startRead(oversampling):
+            return False
+        
+        try:
+            while not self.poll():
+                await asyncio.sleep(max(0, self._deadline - monotonic()))
+        except:
+            self.cancelRead()
+            raise
+        
+        return True
+    
+    # Start a non-blocking read: request the D1 (pressure) conversion and return immediately.
+    # Call poll() at or after deadline() to move the read on. Oversampling can be chosen per read,
+    # e.g. OSR_256 for a fast coarse read (about 1ms) or OSR_8192 for a precise one.
+    def startRead(self, oversampling=OSR_8192):
         if self._bus is None:
             print("No bus!")
             return False
@@ -97,25 +151,45 @@ class MS5837(object):
             print("Invalid oversampling option!")
             return False
         
+        if self._state != STATE_IDLE:
+            print("Read already in progress!")
+            return False
+        
+        self._oversampling = oversampling
+        self._readStart = time()
+        
         # Request D1 conversion (pressure)
         self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D1_256 + 2*oversampling)
+        self._deadline = monotonic() + conversionTime(oversampling)
+        self._state = STATE_CONVERTING_D1
+        
+        return True
     
-        # Maximum conversion time increases linearly with oversampling
-        # max time (seconds) ~= 2.2e-6(x) where x = OSR = (2^8, 2^9, ..., 2^13)
-        # We use 2.5e-6 for some overhead
-        sleep(2.5e-6 * 2**(8+oversampling))
+    # Move a read started with startRead() on if its current conversion is complete. Never blocks on a conversion.
+    # Returns True once the read is complete and pressure(), temperature() and depth() have been updated.
+    def poll(self):
+        if self._state == STATE_IDLE:
+            return False
         
-        d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
-        self._D1 = d[0] << 16 | d[1] << 8 | d[2]
+        if monotonic() < self._deadline:
+            return False
         
-        # Request D2 conversion (temperature)
-        self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D2_256 + 2*oversampling)
-    
-        # As above
-        sleep(2.5e-6 * 2**(8+oversampling))
- 
         d = self._bus.read_i2c_block_data(self._MS5837_ADDR, self._MS5837_ADC_READ, 3)
+        
+        if self._state == STATE_CONVERTING_D1:
+            self._D1 = d[0] << 16 | d[1] << 8 | d[2]
+            
+            # Request D2 conversion (temperature)
+            self._bus.write_byte(self._MS5837_ADDR, self._MS5837_CONVERT_D2_256 + 2*self._oversampling)
+            self._deadline = monotonic() + conversionTime(self._oversampling)
+            self._state = STATE_CONVERTING_D2
+            return False
+        
         self._D2 = d[0] << 16 | d[1] << 8 | d[2]
+        self._state = STATE_IDLE
+        self._deadline = None
+        # Time of the middle of the read
+        self._readTime = (self._readStart + time()) / 2
 
         # Calculate compensated pressure and temperature
         # using raw ADC values and internal calibration
@@ -123,6 +197,37 @@ class MS5837(object):
         
         return True
     
+    # Read [count] samples, starting one every [interval] seconds (or back to back if 0)
+    # Returns a numpy array of SAMPLE_DTYPE (time of the middle of each read, depth in m, pressure in mbar, temperature in C).
+    # Stops early and returns the samples read so far if a read fails.
+    def readSamples(self, count, interval=0, oversampling=OSR_8192):
+        samples = np.zeros(count, dtype=SAMPLE_DTYPE)
+        next_sample = monotonic()
+        for i in range(count):
+            sleep(max(0, next_sample - monotonic()))
+            next_sample += interval
+            if not self.read(oversampling):
+                return samples[:i]
+            samples[i] = (self._readTime, self.depth(), self.pressure(), self.temperature())
+        return samples
+    
+    # Abandon a read in progress, e.g. after a bus error. The sensor discards a conversion which is not read.
+    def cancelRead(self):
+        self._state = STATE_IDLE
+        self._deadline = None
+    
+    # Whether a non-blocking read is in progress
+    def busy(self):
+        return self._state != STATE_IDLE
+    
+    # Time (monotonic clock) when the current conversion will be complete, or None if no read is in progress
+    def deadline(self):
+        return self._deadline
+    
+    # Wall clock time (time.time()) of the middle of the last completed read
+    def readTime(self):
+        return self._readTime
+    
     def setFluidDensity(self, denisty):
         self._fluidDensity = denisty
         
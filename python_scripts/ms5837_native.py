@@ -0,0 +1,233 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+from pathlib import Path
+from time import time, monotonic
+import numpy as np
+import ms5837
+
+logger = logging.getLogger()
+
+#Pressure sensor backends (see open_sensor)
+PYTHON_BACKEND = "python"
+""" ms5837.py over smbus2 - compensation maths and waits in Python """
+NATIVE_BACKEND = "native"
+""" The bar30 C library (bar30/build/libbar30.so) over the pigpio daemon """
+AUTO_BACKEND = "auto"
+""" The native backend if the library can be loaded, otherwise the Python backend """
+
+#Environment variables selecting the backend and the location of the library
+BACKEND_VARIABLE = "PRESSURE_SENSOR_BACKEND"
+LIBRARY_VARIABLE = "BAR30_LIBRARY"
+#Default location of the library, built by 'make' in the bar30 directory
+DEFAULT_LIBRARY_PATH = Path(__file__).resolve().parent.parent / "bar30" / "build" / "libbar30.so"
+
+#ms5837.h MS5837_SELECT_SENSOR
+_SENSOR_PRESSURE = 0
+_SENSOR_TEMPERATURE = 1
+
+_library:ctypes.CDLL = None
+
+
+def load_library(path:str|Path=None) -> ctypes.CDLL:
+    """Load the bar30 shared library and declare the signatures of the functions used.
+
+    Args:
+        path (str|Path, optional): Library file. Defaults to $BAR30_LIBRARY, then DEFAULT_LIBRARY_PATH, then a library
+            named bar30 on the system library path.
+
+    Returns:
+        ctypes.CDLL: The library. Raises OSError if it cannot be found or loaded.
+    """
+    global _library
+    if _library is not None and path is None:
+        return _library
+    candidates = [path] if path is not None else [os.environ.get(LIBRARY_VARIABLE), DEFAULT_LIBRARY_PATH, ctypes.util.find_library("bar30")]
+    candidates = [str(candidate) for candidate in candidates if candidate]
+    library = None
+    for candidate in candidates:
+        try:
+            library = ctypes.CDLL(candidate)
+            break
+        except OSError:
+            continue
+    if library is None:
+        raise OSError(f"bar30 library not found (tried {', '.join(candidates)}). Build it with 'make lib' in the bar30 directory.")
+
+    instance, sensor = ctypes.c_void_p, ctypes.c_void_p
+    library.bar30_instance_size.restype = ctypes.c_size_t
+    library.bar30_instance_size.argtypes = []
+    library.bar30_sensor.restype = sensor
+    library.bar30_sensor.argtypes = [instance]
+    library.bar30_init.restype = ctypes.c_int
+    library.bar30_init.argtypes = [instance, ctypes.c_uint16, ctypes.c_bool]
+    library.bar30_stop.restype = ctypes.c_int
+    library.bar30_stop.argtypes = [instance]
+    library.bar30_read_samples.restype = ctypes.c_int
+    library.bar30_read_samples.argtypes = [instance, ctypes.c_int, ctypes.c_uint32, ctypes.c_uint32,
+                                           ctypes.POINTER(ctypes.c_double), ctypes.POINTER(ctypes.c_float), ctypes.POINTER(ctypes.c_float)]
+    library.ms5837_start_conversion.restype = ctypes.c_uint16
+    library.ms5837_start_conversion.argtypes = [sensor, ctypes.c_int, ctypes.c_int]
+    library.ms5837_read_conversion.restype = ctypes.c_uint32
+    library.ms5837_read_conversion.argtypes = [sensor]
+    library.ms5837_calculate.restype = ctypes.c_bool
+    library.ms5837_calculate.argtypes = [sensor]
+    library.ms5837_pressure_mbar.restype = ctypes.c_float
+    library.ms5837_pressure_mbar.argtypes = [sensor]
+    library.ms5837_temperature_celcius.restype = ctypes.c_float
+    library.ms5837_temperature_celcius.argtypes = [sensor]
+    if path is None:
+        _library = library
+    return library
+
+
+class Bar30(ms5837.MS5837):
+    """MS5837-30BA read through the bar30 C library, with the same interface as ms5837.MS5837.
+
+    Conversions, compensation and the I2C transfers run in C. The blocking and non-blocking reads (read, startRead and
+    poll) keep the conversion state in Python so the sensor can still be interleaved with other work, while
+    readSamples reads a whole batch in one call, paced in C, for high rate logging with little jitter.
+    Requires the pigpio daemon (sudo pigpiod).
+    """
+
+    def __init__(self, bus=1, library_path:str|Path=None):
+        #The smbus connection of the Python driver is not used
+        self._model = ms5837.MODEL_30BA
+        self._bus_number = bus
+        self._bus = None
+        self._fluidDensity = ms5837.DENSITY_FRESHWATER
+        self._pressure = 0
+        self._temperature = 0
+        self._state = ms5837.STATE_IDLE
+        self._oversampling = ms5837.OSR_8192
+        self._deadline = None
+        self._readStart = None
+        self._readTime = None
+
+        self._lib = load_library(library_path)
+        self._instance = ctypes.create_string_buffer(self._lib.bar30_instance_size())
+        self._sensor = self._lib.bar30_sensor(self._instance)
+        self._initialised = False
+
+    def init(self):
+        if self._lib.bar30_init(self._instance, self._bus_number, False) != 0:
+            return False
+        self._initialised = True
+        return True
+
+    def close(self):
+        if self._initialised:
+            self._lib.bar30_stop(self._instance)
+            self._initialised = False
+
+    def startRead(self, oversampling=ms5837.OSR_8192):
+        if not self._initialised:
+            print("Sensor not initialised!")
+            return False
+
+        if oversampling < ms5837.OSR_256 or oversampling > ms5837.OSR_8192:
+            print("Invalid oversampling option!")
+            return False
+
+        if self._state != ms5837.STATE_IDLE:
+            print("Read already in progress!")
+            return False
+
+        self._oversampling = oversampling
+        self._readStart = time()
+        wait_us = self._lib.ms5837_start_conversion(self._sensor, _SENSOR_PRESSURE, oversampling)
+        if wait_us == 0:
+            return False
+        self._deadline = monotonic() + wait_us / 1e6
+        self._state = ms5837.STATE_CONVERTING_D1
+        return True
+
+    def poll(self):
+        if self._state == ms5837.STATE_IDLE or monotonic() < self._deadline:
+            return False
+
+        if self._lib.ms5837_read_conversion(self._sensor) == 0:
+            self.cancelRead()
+            raise IOError("bar30: conversion read failed")
+
+        if self._state == ms5837.STATE_CONVERTING_D1:
+            wait_us = self._lib.ms5837_start_conversion(self._sensor, _SENSOR_TEMPERATURE, self._oversampling)
+            self._deadline = monotonic() + wait_us / 1e6
+            self._state = ms5837.STATE_CONVERTING_D2
+            return False
+
+        self._state = ms5837.STATE_IDLE
+        self._deadline = None
+        self._readTime = (self._readStart + time()) / 2
+        if not self._lib.ms5837_calculate(self._sensor):
+            raise IOError("bar30: compensation failed (calibration not loaded)")
+        #Stored in the units of the Python driver so pressure(), temperature() and depth() are inherited
+        self._pressure = self._lib.ms5837_pressure_mbar(self._sensor)
+        self._temperature = self._lib.ms5837_temperature_celcius(self._sensor) * 100
+        return True
+
+    def readSamples(self, count, interval=0, oversampling=ms5837.OSR_8192):
+        if not self._initialised:
+            print("Sensor not initialised!")
+            return np.zeros(0, dtype=ms5837.SAMPLE_DTYPE)
+        timestamps = np.zeros(count, dtype=np.float64)
+        pressures = np.zeros(count, dtype=np.float32)
+        temperatures = np.zeros(count, dtype=np.float32)
+        read = self._lib.bar30_read_samples(self._instance, oversampling, count, int(round(interval * 1e6)),
+                                            timestamps.ctypes.data_as(ctypes.POINTER(ctypes.c_double)),
+                                            pressures.ctypes.data_as(ctypes.POINTER(ctypes.c_float)),
+                                            temperatures.ctypes.data_as(ctypes.POINTER(ctypes.c_float)))
+        samples = np.zeros(read, dtype=ms5837.SAMPLE_DTYPE)
+        samples["time"] = timestamps[:read]
+        samples["pressure"] = pressures[:read]
+        samples["temperature"] = temperatures[:read]
+        samples["depth"] = (pressures[:read] * ms5837.UNITS_Pa - 101300) / (self._fluidDensity * 9.80665)
+        if read > 0:
+            self._pressure = float(pressures[read - 1])
+            self._temperature = float(temperatures[read - 1]) * 100
+            self._readTime = float(timestamps[read - 1])
+        return samples
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def open_sensor(backend:str=None, bus:int=1) -> ms5837.MS5837|None:
+    """Connect to an MS5837-30BA pressure sensor with the chosen backend.
+
+    Args:
+        backend (str, optional): PYTHON_BACKEND, NATIVE_BACKEND or AUTO_BACKEND. Defaults to $PRESSURE_SENSOR_BACKEND,
+            or AUTO_BACKEND if that is not set. In AUTO_BACKEND mode the Python driver is used if the library cannot
+            be loaded or the sensor cannot be initialised through it (e.g. the pigpio daemon is not running).
+        bus (int, optional): I2C bus number. Defaults to 1.
+
+    Returns:
+        ms5837.MS5837|None: The initialised sensor, or None if it could not be initialised
+    """
+    backend = (backend or os.environ.get(BACKEND_VARIABLE) or AUTO_BACKEND).lower()
+    if backend not in [PYTHON_BACKEND, NATIVE_BACKEND, AUTO_BACKEND]:
+        raise ValueError(f"Unknown pressure sensor backend {backend} - use {PYTHON_BACKEND}, {NATIVE_BACKEND} or {AUTO_BACKEND}")
+
+    if backend in [NATIVE_BACKEND, AUTO_BACKEND]:
+        try:
+            sensor = Bar30(bus)
+            if sensor.init():
+                logger.info("Using the bar30 library for the pressure sensor")
+                return sensor
+            logger.warning("Could not initialise the pressure sensor through the bar30 library")
+        except OSError as e:
+            if backend == NATIVE_BACKEND:
+                raise
+            logger.info(f"bar30 library not available ({e})")
+        if backend == NATIVE_BACKEND:
+            return None
+
+    sensor = ms5837.MS5837_30BA(bus)
+    if not sensor.init():
+        return None
+    logger.info("Using the Python driver for the pressure sensor")
+    return sensor
@@ -0,0 +1,250 @@
+#Snapshots of the camera nodemaps: every readable node with its value, type and limits, saved in the data directory so
+#a node can be looked up without connecting to the camera.
+#Call from the command line with:
+#$> nodes.py get [node name] [--serial serial number] [--live]
+#$> nodes.py names [prefix] [--serial serial number]
+#$> nodes.py refresh [--serial serial number]
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+import config
+import control
+
+logger = logging.getLogger()
+
+#Snapshots are saved in this directory of the data directory, one file per camera
+SNAPSHOT_DIRECTORY = "config"
+SNAPSHOT_PREFIX = "nodemap_"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+#Node types (the class names of the harvesters nodes) which have a value
+VALUE_TYPES = ["IInteger", "IFloat", "IBoolean", "IString", "IEnumeration"]
+#Limits of numeric nodes, by snapshot key and node attribute
+LIMITS = {"min": "min", "max": "max", "increment": "inc", "unit": "unit"}
+
+
+def read_node(nodemap, name:str) -> dict|None:
+    """Read a node's value, type and limits from a live nodemap.
+
+    Args:
+        nodemap (NodeMap): Camera nodemap (device_interface.Camera.nodemap)
+        name (str): Node name
+
+    Returns:
+        dict|None: type, value and, where the node has them, min, max, increment, unit and entries (the values of an
+            enumeration). None if the node doesn't exist, has no value or isn't readable.
+    """
+    try:
+        node = getattr(nodemap, name)
+    except Exception:
+        return None
+    node_type = type(node).__name__
+    if node_type not in VALUE_TYPES:
+        return None
+    try:
+        entry = {"type": node_type[1:], "value": node.value}
+    except Exception:
+        return None
+    if node_type in ["IInteger", "IFloat"]:
+        for key, attribute in LIMITS.items():
+            try:
+                entry[key] = getattr(node, attribute)
+            except Exception:
+                pass
+    elif node_type == "IEnumeration":
+        try:
+            entry["entries"] = list(node._get_symbolics())
+        except Exception:
+            pass
+    return entry
+
+
+def snapshot(nodemap, serial_number:str) -> dict:
+    """Read every readable node of a live nodemap. Each node is read once, so this takes a second or so."""
+    nodes = {}
+    for item in nodemap._get_nodes():
+        try:
+            name = item._get_node()._get_name()
+        except Exception:
+            continue
+        entry = read_node(nodemap, name)
+        if entry is not None:
+            nodes[name] = entry
+    return {"version": SNAPSHOT_VERSION,
+            "serial_number": str(serial_number),
+            "taken": datetime.now().strftime(SNAPSHOT_TIME_FORMAT),
+            "nodes": nodes}
+
+
+def snapshot_path(serial_number:str) -> Path:
+    return config.data_directory() / SNAPSHOT_DIRECTORY / f"{SNAPSHOT_PREFIX}{serial_number}.json"
+
+
+def save(node_snapshot:dict) -> Path:
+    """Save a snapshot, replacing the camera's previous snapshot. Returns the snapshot file."""
+    path = snapshot_path(node_snapshot["serial_number"])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    #Written to a temporary file and renamed, so a snapshot being read is never half written
+    temporary_path = path.with_suffix(".tmp")
+    with open(temporary_path, "w") as file:
+        json.dump(node_snapshot, file)
+    os.replace(temporary_path, path)
+    logger.info(f"Saved snapshot of {len(node_snapshot['nodes'])} nodes of camera {node_snapshot['serial_number']} to {path}")
+    return path
+
+
+def load(serial_number:str=None) -> dict|None:
+    """Load a camera's snapshot.
+
+    Args:
+        serial_number (str, optional): Serial number of the camera. Defaults to the camera snapshotted most recently.
+
+    Returns:
+        dict|None: The snapshot, or None if there is no snapshot of the camera
+    """
+    if serial_number is None:
+        directory = config.data_directory() / SNAPSHOT_DIRECTORY
+        paths = sorted(directory.glob(f"{SNAPSHOT_PREFIX}*.json"), key=lambda path: path.stat().st_mtime) if directory.is_dir() else []
+        if len(paths) == 0:
+            return None
+        path = paths[-1]
+    else:
+        path = snapshot_path(serial_number)
+    try:
+        with open(path, "r") as file:
+            node_snapshot = json.load(file)
+    except FileNotFoundError:
+        return None
+    if node_snapshot.get("version") != SNAPSHOT_VERSION:
+        return None
+    return node_snapshot
+
+
+def find(node_snapshot:dict, name:str) -> list[tuple[str, dict]]:
+    """Find nodes in a snapshot by name.
+
+    Args:
+        node_snapshot (dict): Snapshot (see snapshot)
+        name (str): Node name. Matched exactly, then ignoring case, then as part of the node names.
+
+    Returns:
+        list[tuple[str, dict]]: Name and entry of each matching node
+    """
+    nodes = node_snapshot["nodes"]
+    if name in nodes:
+        return [(name, nodes[name])]
+    lower_name = name.lower()
+    matches = [(node_name, entry) for node_name, entry in nodes.items() if node_name.lower() == lower_name]
+    if len(matches) == 0:
+        matches = [(node_name, entry) for node_name, entry in nodes.items() if lower_name in node_name.lower()]
+    return matches
+
+
+def read_live(name:str, serial_number:str=None) -> tuple[str, dict|None]:
+    """Read a node from the camera. If the daemon is running the node is read from its open camera, otherwise the
+    camera is connected to (which fails if a routine is using it), and its snapshot is refreshed while connected.
+
+    Returns:
+        tuple[str, dict|None]: Serial number of the camera, and the node (see read_node) or None if it isn't readable
+    """
+    if control.is_running(daemon=True):
+        reply = _send_to_daemon("node", name=name, serial=serial_number)
+        return reply["serial_number"], reply["node"]
+
+    camera = _open_camera(serial_number)
+    try:
+        camera.save_node_snapshot()
+        return str(camera.serial_number), read_node(camera.nodemap, name)
+    finally:
+        camera.disconnect()
+
+
+def refresh(serial_number:str=None) -> list[Path]:
+    """Save a new snapshot of a camera (or, if the daemon is running, of each of its open cameras). Returns the
+    snapshot files."""
+    if control.is_running(daemon=True):
+        return [Path(path) for path in _send_to_daemon("snapshot", serial=serial_number)["paths"]]
+    camera = _open_camera(serial_number)
+    try:
+        return [camera.save_node_snapshot()]
+    finally:
+        camera.disconnect()
+
+
+def _send_to_daemon(command:str, **fields) -> dict:
+    reply = control.send(command, **fields)
+    if not reply.get("ok", False):
+        raise ConnectionError(reply.get("error", f"The daemon could not carry out {command}"))
+    return reply
+
+
+def _open_camera(serial_number:str=None):
+    import device_interface
+    camera = device_interface.open(serial_number=serial_number)
+    if camera is None:
+        raise ConnectionError(f"Could not connect to camera{f' {serial_number}' if serial_number else ''} - is a routine using it?")
+    return camera
+
+
+def format_entry(name:str, entry:dict) -> str:
+    string = f"{name}: {entry['value']}"
+    if "unit" in entry and entry["unit"]:
+        string += f" {entry['unit']}"
+    details = [entry["type"]]
+    if "min" in entry and "max" in entry:
+        details.append(f"{entry['min']} to {entry['max']}" + (f" in steps of {entry['increment']}" if "increment" in entry else ""))
+    if "entries" in entry:
+        details.append(", ".join(entry["entries"]))
+    return f"{string} ({'; '.join(details)})"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up camera nodes in the nodemap snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+    get_parser = commands.add_parser("get", help="Show the value, type and limits of a node")
+    get_parser.add_argument("name", help="Node name - matched exactly, then ignoring case, then as part of the node names")
+    get_parser.add_argument("--live", action="store_true", help="Read the node from the camera (through the daemon if it is running) instead of the snapshot")
+    names_parser = commands.add_parser("names", help="List the names of the nodes in the snapshot (used for tab completion)")
+    names_parser.add_argument("prefix", nargs="?", default="", help="Only list names starting with this")
+    commands.add_parser("refresh", help="Connect to the camera and save a new snapshot")
+    for command_parser in commands.choices.values():
+        command_parser.add_argument("--serial", required=False, help="Serial number of the camera (default: the camera snapshotted most recently)")
+    args = parser.parse_args()
+    config.load()
+
+    match args.command:
+        case "get":
+            if args.live:
+                serial_number, entry = read_live(args.name, args.serial)
+                if entry is None:
+                    print(f"Camera {serial_number} has no readable node {args.name}", file=sys.stderr)
+                    sys.exit(1)
+                print(format_entry(args.name, entry))
+                return
+            node_snapshot = load(args.serial)
+            if node_snapshot is None:
+                print("No nodemap snapshot - use 'get --live' or 'refresh' with a camera connected", file=sys.stderr)
+                sys.exit(1)
+            matches = find(node_snapshot, args.name)
+            if len(matches) == 0:
+                print(f"No node {args.name} in the snapshot of camera {node_snapshot['serial_number']}", file=sys.stderr)
+                sys.exit(1)
+            for name, entry in matches:
+                print(format_entry(name, entry))
+            print(f"(snapshot of camera {node_snapshot['serial_number']} from {node_snapshot['taken']} - use --live for the current value)")
+        case "names":
+            node_snapshot = load(args.serial)
+            if node_snapshot is not None:
+                print("\n".join([name for name in node_snapshot["nodes"] if name.startswith(args.prefix)]))
+        case "refresh":
+            for path in refresh(args.serial):
+                print(f"Saved {path}")
+
+
+if __name__ == "__main__":
+    main()
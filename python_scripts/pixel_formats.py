@@ -0,0 +1,210 @@
+import numpy as np
+import logging
+
+logger = logging.getLogger()
+
+#Packing schemes
+UNPACKED = "unpacked"
+""" One pixel per byte (8-bit) or one pixel per little-endian 16-bit word """
+PACKED_10P = "10p"
+""" GenICam PFNC 10-bit packed - 4 pixels in 5 bytes, least significant bits first """
+PACKED_12P = "12p"
+""" GenICam PFNC 12-bit packed - 2 pixels in 3 bytes, least significant bits first """
+PACKED_12_LEGACY = "12packed"
+""" GigE Vision 12-bit packed - 2 pixels in 3 bytes, most significant bits in the outer bytes """
+PACKED_10G40 = "10g40"
+""" IDS 10-bit grouped - 4 bytes of the 8 most significant bits of 4 pixels, then 1 byte of their 2 least significant bits """
+PACKED_12G24 = "12g24"
+""" IDS 12-bit grouped - 2 bytes of the 8 most significant bits of 2 pixels, then 1 byte of their 4 least significant bits """
+
+#Pixel formats supported by the pipeline: bit depth, packing, and whether the format is a Bayer mosaic
+FORMATS = {"Mono8":            {"bits": 8,  "packing": UNPACKED,         "bayer": False},
+           "Mono10":           {"bits": 10, "packing": UNPACKED,         "bayer": False},
+           "Mono12":           {"bits": 12, "packing": UNPACKED,         "bayer": False},
+           "Mono10p":          {"bits": 10, "packing": PACKED_10P,       "bayer": False},
+           "Mono12p":          {"bits": 12, "packing": PACKED_12P,       "bayer": False},
+           "Mono12Packed":     {"bits": 12, "packing": PACKED_12_LEGACY, "bayer": False},
+           "Mono10g40IDS":     {"bits": 10, "packing": PACKED_10G40,     "bayer": False},
+           "Mono12g24IDS":     {"bits": 12, "packing": PACKED_12G24,     "bayer": False},
+           "Mono16":           {"bits": 16, "packing": UNPACKED,         "bayer": False},
+           "BayerRG8":         {"bits": 8,  "packing": UNPACKED,         "bayer": True},
+           "BayerRG10":        {"bits": 10, "packing": UNPACKED,         "bayer": True},
+           "BayerRG12":        {"bits": 12, "packing": UNPACKED,         "bayer": True},
+           "BayerRG10p":       {"bits": 10, "packing": PACKED_10P,       "bayer": True},
+           "BayerRG12p":       {"bits": 12, "packing": PACKED_12P,       "bayer": True},
+           "BayerRG12Packed":  {"bits": 12, "packing": PACKED_12_LEGACY, "bayer": True},
+           "BayerRG10g40IDS":  {"bits": 10, "packing": PACKED_10G40,     "bayer": True},
+           "BayerRG12g24IDS":  {"bits": 12, "packing": PACKED_12G24,     "bayer": True},
+           "BayerRG16":        {"bits": 16, "packing": UNPACKED,         "bayer": True}}
+
+#How images are stored (see cam_image.Cam_Image.save), recorded in the storage_format metadata of each image
+RGB_STORAGE = "rgb"
+""" Debayered to RGB at half resolution (colour images) or greyscale (monochrome images) - 8-bit images only """
+RAW_STORAGE = "raw"
+""" The raw (un-debayered) sensor data as a greyscale PNG - 8-bit images as they are, deeper images shifted to fill 16 bits """
+STORAGE_FORMATS = [RGB_STORAGE, RAW_STORAGE]
+
+#Bytes of packed data and the number of pixels they hold for each packing scheme
+_GROUPS = {PACKED_10P: (5, 4), PACKED_12P: (3, 2), PACKED_12_LEGACY: (3, 2), PACKED_10G40: (5, 4), PACKED_12G24: (3, 2)}
+
+
+def bit_depth(format:str) -> int:
+    """Bit depth of a pixel format. Unknown formats are assumed to be 8-bit.
+
+    Args:
+        format (str): GenICam pixel format name
+
+    Returns:
+        int: Number of significant bits per pixel
+    """
+    return FORMATS.get(str(format), FORMATS["Mono8"])["bits"]
+
+def max_value(format:str) -> int:
+    """Largest pixel value of a pixel format (e.g. 255 for 8-bit, 4095 for 12-bit)."""
+    return 2**bit_depth(format) - 1
+
+def is_bayer(format:str) -> bool:
+    """Whether a pixel format is a Bayer mosaic."""
+    return FORMATS.get(str(format), {"bayer": str(format).startswith("Bayer")})["bayer"]
+
+def is_packed(format:str) -> bool:
+    """Whether a pixel format packs more than one pixel into some bytes."""
+    return str(format) in FORMATS and FORMATS[str(format)]["packing"] != UNPACKED
+
+def scale_threshold(value_8bit:float, bits:int) -> int:
+    """Scale a pixel value threshold set for 8-bit images to another bit depth, keeping the same fraction of full scale.
+
+    Args:
+        value_8bit (float): Threshold for 8-bit images (e.g. 250)
+        bits (int): Target bit depth
+
+    Returns:
+        int: Threshold at the target bit depth (e.g. 4015 for 250 at 12-bit)
+    """
+    return int(round((value_8bit + 1) * 2**(bits - 8))) - 1
+
+def storage_format(requested:str, bits:int) -> str:
+    """Storage format of an image. RGB_STORAGE is only available for 8-bit images, so deeper images are always
+    stored raw.
+
+    Args:
+        requested (str): RGB_STORAGE or RAW_STORAGE, or None for RGB_STORAGE where it is available
+        bits (int): Bit depth of the image
+
+    Returns:
+        str: RGB_STORAGE or RAW_STORAGE
+    """
+    if requested not in [None, *STORAGE_FORMATS]:
+        raise ValueError(f"Unknown storage format {requested} - use one of {STORAGE_FORMATS}")
+    return RAW_STORAGE if bits > 8 or requested == RAW_STORAGE else RGB_STORAGE
+
+def choose_format(available:list[str], bayer:bool, bits:int=8, packed:bool=True) -> str:
+    """Choose the supported pixel format closest to the requested bit depth from the formats a camera offers.
+
+    Packed formats halve the USB bandwidth of 16-bit formats at the cost of unpacking on the host.
+
+    Args:
+        available (list[str]): Pixel formats offered by the camera
+        bayer (bool): Whether to choose a Bayer (colour) format
+        bits (int, optional): Requested bit depth. Defaults to 8.
+        packed (bool, optional): Prefer packed formats. Defaults to True.
+
+    Returns:
+        str: Pixel format name, or None if no supported format is available
+    """
+    candidates = [name for name in available if name in FORMATS and FORMATS[name]["bayer"] == bayer]
+    if len(candidates) == 0:
+        return None
+    def rank(name:str):
+        details = FORMATS[name]
+        #Prefer the requested depth, then the deepest format below it, then the shallowest above it
+        depth_rank = (0, 0) if details["bits"] == bits else ((1, -details["bits"]) if details["bits"] < bits else (2, details["bits"]))
+        packing_rank = 0 if (details["packing"] != UNPACKED) == packed or details["bits"] == 8 else 1
+        #Prefer the standard PFNC packings over vendor specific ones
+        vendor_rank = 1 if details["packing"] in [PACKED_10G40, PACKED_12G24, PACKED_12_LEGACY] else 0
+        return depth_rank, packing_rank, vendor_rank
+    return sorted(candidates, key=rank)[0]
+
+def unpack(data:np.ndarray, width:int, height:int, format:str) -> np.ndarray:
+    """Unpack raw image data into an array of one value per pixel.
+
+    8-bit formats are returned as uint8, all others as uint16 holding the value in the least significant bits.
+    Unpacking is vectorised over groups of bytes, so it costs a few passes over the data rather than a loop per pixel.
+    If the data has already been unpacked (one element per pixel) it is only reshaped.
+
+    Args:
+        data (np.ndarray): Image data as delivered by the buffer
+        width (int): Image width in pixels
+        height (int): Image height in pixels
+        format (str): GenICam pixel format name
+
+    Returns:
+        np.ndarray: Array of shape (height, width). Always a copy of the data.
+    """
+    pixels = width * height
+    bits = bit_depth(format)
+    data = np.asarray(data)
+
+    if data.size == pixels:
+        #Already one value per pixel
+        return data.reshape(height, width).astype(np.uint8 if bits == 8 else np.uint16, copy=True)
+
+    raw = np.frombuffer(data.tobytes() if not data.flags.c_contiguous else data, dtype=np.uint8)
+    packing = FORMATS.get(str(format), FORMATS["Mono8"])["packing"]
+
+    if packing == UNPACKED:
+        if bits == 8:
+            return raw[:pixels].reshape(height, width).copy()
+        return raw[:2*pixels].view("<u2").reshape(height, width).astype(np.uint16)
+
+    group_bytes, group_pixels = _GROUPS[packing]
+    groups = raw[:pixels // group_pixels * group_bytes].reshape(-1, group_bytes).astype(np.uint16)
+    out = np.empty((groups.shape[0], group_pixels), dtype=np.uint16)
+
+    match packing:
+        case p if p == PACKED_10P:
+            out[:, 0] = groups[:, 0] | ((groups[:, 1] & 0x03) << 8)
+            out[:, 1] = (groups[:, 1] >> 2) | ((groups[:, 2] & 0x0F) << 6)
+            out[:, 2] = (groups[:, 2] >> 4) | ((groups[:, 3] & 0x3F) << 4)
+            out[:, 3] = (groups[:, 3] >> 6) | (groups[:, 4] << 2)
+        case p if p == PACKED_12P:
+            out[:, 0] = groups[:, 0] | ((groups[:, 1] & 0x0F) << 8)
+            out[:, 1] = (groups[:, 1] >> 4) | (groups[:, 2] << 4)
+        case p if p == PACKED_12_LEGACY:
+            out[:, 0] = (groups[:, 0] << 4) | (groups[:, 1] & 0x0F)
+            out[:, 1] = (groups[:, 2] << 4) | (groups[:, 1] >> 4)
+        case p if p == PACKED_10G40:
+            for i in range(4):
+                out[:, i] = (groups[:, i] << 2) | ((groups[:, 4] >> (2*i)) & 0x03)
+        case p if p == PACKED_12G24:
+            out[:, 0] = (groups[:, 0] << 4) | (groups[:, 2] & 0x0F)
+            out[:, 1] = (groups[:, 1] << 4) | (groups[:, 2] >> 4)
+
+    return out.reshape(height, width)
+
+def to_8bit(image_array:np.ndarray, bits:int) -> np.ndarray:
+    """Reduce an image to 8-bit by dropping the least significant bits.
+
+    Args:
+        image_array (np.ndarray): Image with values of [bits] bits
+        bits (int): Bit depth of the image
+
+    Returns:
+        np.ndarray: uint8 image
+    """
+    if bits <= 8:
+        return image_array.astype(np.uint8)
+    return (image_array >> (bits - 8)).astype(np.uint8)
+
+def to_16bit(image_array:np.ndarray, bits:int) -> np.ndarray:
+    """Scale an image to fill 16 bits by shifting values into the most significant bits, for storage.
+    The original values can be recovered by shifting right by (16 - bits).
+
+    Args:
+        image_array (np.ndarray): Image with values of [bits] bits
+        bits (int): Bit depth of the image
+
+    Returns:
+        np.ndarray: uint16 image
+    """
+    return (image_array.astype(np.uint16) << (16 - bits)).astype(np.uint16)
@@ -0,0 +1,243 @@
+import json
+import logging
+import math
+import threading
+from pathlib import Path
+from time import time, monotonic
+import numpy as np
+import ms5837
+
+logger = logging.getLogger()
+
+#Columns of the sample stream and their data types in the ring buffer and the stream files
+COLUMNS = {"time": np.float64, "depth": np.float32, "pressure": np.float32, "temperature": np.float32}
+#Samples kept in memory for interpolation, in seconds
+BUFFER_SECS = 600
+#Samples are written to the stream files in blocks of this many seconds
+FLUSH_SECS = 10
+#Stream files are written to this directory in the session directory
+STREAM_DIRECTORY = "environment"
+
+
+def oversampling_index(oversampling:int) -> int:
+    """Convert an oversampling ratio (256 to 8192) to the ms5837 OSR_ setting."""
+    index = int(round(math.log2(max(256, min(8192, int(oversampling)))))) - 8
+    return max(ms5837.OSR_256, min(ms5837.OSR_8192, index))
+
+
+class PressureSampler:
+    """Reads the pressure sensor on its own thread at a fixed rate into a timestamped ring buffer.
+
+    Captures look up the depth, pressure and temperature interpolated to the middle of their exposure instead of
+    reading the sensor themselves, so no I2C conversions are made on the capture path. Each sample is timestamped with
+    the middle of its conversions. The full stream is also written to the session as one binary file per column
+    (see load_stream).
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, sensor:ms5837.MS5837, rate_hz:float=4, oversampling:int=8192, buffer_secs:float=BUFFER_SECS) -> None:
+        """
+        Args:
+            sensor (ms5837.MS5837): Initialised pressure sensor
+            rate_hz (float, optional): Samples per second. Limited by the conversion time at the oversampling ratio
+                (about 40ms per sample at 8192). Defaults to 4.
+            oversampling (int, optional): Oversampling ratio of each conversion, 256 to 8192. Defaults to 8192.
+            buffer_secs (float, optional): Length of the ring buffer in seconds. Defaults to BUFFER_SECS.
+        """
+        self.sensor = sensor
+        self.rate_hz = max(0.1, rate_hz)
+        self.oversampling = oversampling_index(oversampling)
+        self.capacity = max(16, int(math.ceil(self.rate_hz * buffer_secs)))
+        self._buffer = {name: np.zeros(self.capacity, dtype=dtype) for name, dtype in COLUMNS.items()}
+        #Total number of samples taken. The newest sample is at (count - 1) % capacity
+        self.count = 0
+        self.failures = 0
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._thread:threading.Thread = None
+        self._listeners:list[callable] = []
+        self._stream_directory:Path = None
+        self._written = 0
+        #Serialises direct reads of the sensor (e.g. before the sampler is started) with the sampler's reads
+        self.sensor_lock = threading.Lock()
+
+    def __str__(self) -> str:
+        return f"{self.rate_hz}Hz, oversampling {2**(8 + self.oversampling)}"
+
+    def add_listener(self, listener:callable):
+        """Call a function with (depth, timestamp) after every sample. Listeners run on the sampler thread, so must be quick."""
+        self._listeners.append(listener)
+
+    def record_to(self, session_directory:str|Path):
+        """Write the sample stream to the stream directory of a session. Samples still in the buffer are included."""
+        with self._condition:
+            self._stream_directory = Path(session_directory) / STREAM_DIRECTORY
+            self._stream_directory.mkdir(parents=True, exist_ok=True)
+            with open(self._stream_directory / "columns.json", "w") as file:
+                json.dump({name: np.dtype(dtype).str for name, dtype in COLUMNS.items()}, file)
+            self._written = max(0, self.count - self.capacity)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="pressure_sampler", daemon=True)
+        self._thread.start()
+        logger.info(f"Started pressure sampler ({self})")
+
+    def stop(self):
+        """Stop sampling and write the rest of the stream."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        self.flush()
+
+    def read_now(self, oversampling:int=None) -> tuple[float, float, float, float]:
+        """Read the sensor once. The sensor converts without blocking (see ms5837.MS5837.startRead), so the wait
+        between conversions of the sampler's reads is interrupted if the sampler is stopped.
+
+        Args:
+            oversampling (int, optional): Oversampling ratio of this read (256 to 8192), e.g. 256 for a fast coarse
+                read. Defaults to the sampler's oversampling.
+
+        Returns:
+            tuple[float, float, float, float]: Time of the middle of the read, depth (m), pressure (mbar) and temperature (°C)
+        """
+        oversampling = self.oversampling if oversampling is None else oversampling_index(oversampling)
+        #Only the sampler's own reads are interrupted by stopping it
+        interrupt = self._stop if threading.current_thread() is self._thread else threading.Event()
+        with self.sensor_lock:
+            if not self.sensor.startRead(oversampling):
+                raise IOError("Pressure sensor read failed")
+            try:
+                while not self.sensor.poll():
+                    if interrupt.wait(max(0, self.sensor.deadline() - monotonic())):
+                        raise InterruptedError("Pressure sensor sampler stopped during a read")
+            except:
+                self.sensor.cancelRead()
+                raise
+            return self.sensor.readTime(), self.sensor.depth(), self.sensor.pressure(), self.sensor.temperature()
+
+    def _run(self):
+        period = 1 / self.rate_hz
+        next_sample = time()
+        last_flush = time()
+        while not self._stop.is_set():
+            try:
+                sample = self.read_now()
+                self._append(sample)
+                for listener in self._listeners:
+                    listener(sample[1], sample[0])
+            except InterruptedError:
+                break
+            except Exception as e:
+                self.failures += 1
+                if self.failures == 1 or self.failures % 100 == 0:
+                    logger.warning(f"Pressure sensor sample failed ({self.failures} failures)")
+                    logger.exception(e)
+            if time() - last_flush >= FLUSH_SECS:
+                last_flush = time()
+                self.flush()
+            #Keep to the sample rate without drifting, but don't try to catch up on missed samples
+            next_sample = max(next_sample + period, time())
+            self._stop.wait(next_sample - time())
+
+    def _append(self, sample:tuple):
+        with self._condition:
+            index = self.count % self.capacity
+            for name, value in zip(COLUMNS, sample):
+                self._buffer[name][index] = value
+            self.count += 1
+            self._condition.notify_all()
+
+    def _ordered(self, start:int=None) -> dict[str, np.ndarray]:
+        #Must be called with the condition held. Samples from start (a sample count) to the newest, oldest first.
+        first = max(self.count - self.capacity, 0 if start is None else start)
+        indices = np.arange(first, self.count) % self.capacity
+        return {name: column[indices] for name, column in self._buffer.items()}
+
+    def latest(self) -> tuple[float, float, float]:
+        """Newest depth (m), pressure (mbar) and temperature (°C). Reads the sensor if there are no samples yet."""
+        with self._condition:
+            if self.count > 0:
+                index = (self.count - 1) % self.capacity
+                return tuple(float(self._buffer[name][index]) for name in ["depth", "pressure", "temperature"])
+        return self.read_now()[1:]
+
+    def at(self, timestamp:float, timeout:float=None) -> tuple[float, float, float]:
+        """Depth, pressure and temperature interpolated to a time.
+
+        If the time is after the newest sample, waits for the next sample (up to timeout) so the values are
+        interpolated rather than held. Times outside the buffer take the nearest sample.
+
+        Args:
+            timestamp (float): Time (as time.time()), e.g. the middle of an exposure
+            timeout (float, optional): Longest wait for a later sample. Defaults to two sample periods.
+
+        Returns:
+            tuple[float, float, float]: Depth (m), pressure (mbar) and temperature (°C)
+        """
+        timeout = 2 / self.rate_hz if timeout is None else timeout
+        with self._condition:
+            deadline = time() + timeout
+            while self._thread is not None and (self.count == 0 or self._buffer["time"][(self.count - 1) % self.capacity] < timestamp):
+                remaining = deadline - time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            if self.count == 0:
+                samples = None
+            else:
+                samples = self._ordered()
+        if samples is None:
+            return self.read_now()[1:]
+        return tuple(float(np.interp(timestamp, samples["time"], samples[name])) for name in ["depth", "pressure", "temperature"])
+
+    def window(self, start:float, end:float=None) -> dict[str, np.ndarray]:
+        """Samples between two times still in the buffer, as one array per column."""
+        with self._condition:
+            samples = self._ordered()
+        mask = samples["time"] >= start
+        if end is not None:
+            mask &= samples["time"] <= end
+        return {name: column[mask] for name, column in samples.items()}
+
+    def flush(self):
+        """Append samples taken since the last flush to the stream files."""
+        with self._condition:
+            if self._stream_directory is None or self._written >= self.count:
+                return
+            samples = self._ordered(self._written)
+            self._written = self.count
+            directory = self._stream_directory
+        try:
+            for name, column in samples.items():
+                with open(directory / f"{name}.bin", "ab") as file:
+                    column.tofile(file)
+        except Exception as e:
+            logger.error(f"Could not write pressure sensor stream to {directory}")
+            logger.exception(e)
+
+
+def load_stream(session_directory:str|Path) -> dict[str, np.ndarray]:
+    """Load the pressure sensor stream written to a session by PressureSampler.
+
+    Args:
+        session_directory (str|Path): Session directory
+
+    Returns:
+        dict[str, np.ndarray]: One array per column (time, depth, pressure, temperature), or empty arrays if no stream was recorded
+    """
+    directory = Path(session_directory) / STREAM_DIRECTORY
+    try:
+        with open(directory / "columns.json", "r") as file:
+            dtypes = json.load(file)
+    except FileNotFoundError:
+        return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+    columns = {name: np.fromfile(directory / f"{name}.bin", dtype=np.dtype(dtype)) if (directory / f"{name}.bin").exists() else np.zeros(0, dtype=np.dtype(dtype))
+               for name, dtype in dtypes.items()}
+    #A partly written block (e.g. after a power cut) is trimmed to the shortest column
+    length = min(len(column) for column in columns.values())
+    return {name: column[:length] for name, column in columns.items()}
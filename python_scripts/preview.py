@@ -0,0 +1,411 @@
+#Live preview of the camera over HTTP, for checking what the camera sees during deployment prep over SSH or from a
+#laptop on the same network. Serves a decimated, contrast-stretched MJPEG stream and the current metrics:
+#   http://[host]:[port]/             page with the stream and metrics
+#   http://[host]:[port]/stream.mjpg  MJPEG stream (also opens in VLC, ffplay etc.)
+#   http://[host]:[port]/frame.jpg    single frame
+#   http://[host]:[port]/metrics      metrics as JSON
+#Call from the command line with:
+#$> preview.py [--port port] [--host address] [--serial serial number] [--rate per second] [--width pixels]
+import argparse
+import io
+import json
+import logging
+import math
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+import numpy as np
+from PIL import Image
+import device_interface
+import focus
+import pixel_formats
+
+logger = logging.getLogger()
+
+#Address and port served on - all interfaces so the preview can be opened from another computer
+DEFAULT_HOST = "0.0.0.0"
+DEFAULT_PORT = 8080
+#Most preview frames encoded per second. Fewer are encoded if the clients take them more slowly.
+MAX_RATE_HZ = 10
+#Widest preview image in pixels - frames are decimated on the host to fit
+MAX_WIDTH = 960
+JPEG_QUALITY = 75
+#Capture profile while previewing - on-camera binning quarters the USB bandwidth and the copy of each frame
+PREVIEW_PROFILE = device_interface.BINNED
+#Percentiles of the pixel values stretched to black and white
+STRETCH_PERCENTILES = (0.5, 99.5)
+#Longest wait of a client for a frame before checking whether the server is stopping, in seconds
+CLIENT_WAIT_SECS = 1
+#Send buffer of a stream connection - small, so a client which falls behind holds up its writes (and so asks for
+#fewer previews) within a frame or two rather than after megabytes of queued frames
+STREAM_SEND_BUFFER_BYTES = 128 * 1024
+#Multipart boundary of the MJPEG stream
+BOUNDARY = "aegirframe"
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head><title>{title}</title>
+<style>body {{ background: #111; color: #ddd; font-family: monospace; }} img {{ max-width: 100%; }}</style>
+</head>
+<body>
+<img src="/stream.mjpg">
+<pre id="metrics"></pre>
+<script>
+async function update() {{
+    try {{
+        const metrics = await (await fetch("/metrics")).json();
+        document.getElementById("metrics").textContent = Object.entries(metrics).map(([name, value]) => name + ": " + value).join("\\n");
+    }} catch (e) {{}}
+}}
+update();
+setInterval(update, 1000);
+</script>
+</body>
+</html>
+"""
+
+
+def preview_array(image_array:np.ndarray, bayer:bool, max_width:int=MAX_WIDTH) -> np.ndarray:
+    """Reduce a raw image to the preview size. Bayer images are decimated in whole 2x2 cells, each of which becomes
+    one RGB pixel (assuming an RGGB pattern), so no debayering is needed.
+
+    Args:
+        image_array (np.ndarray): Unpacked raw image array (height, width)
+        bayer (bool): Whether the image is a Bayer mosaic
+        max_width (int, optional): Widest preview in pixels. Defaults to MAX_WIDTH.
+
+    Returns:
+        np.ndarray: (height, width, 3) array for a Bayer image, otherwise (height, width), of the raw values
+    """
+    height, width = image_array.shape[0:2]
+    if not bayer:
+        step = max(1, math.ceil(width / max_width))
+        return image_array[::step, ::step]
+    step = max(1, math.ceil(width / 2 / max_width))
+    height, width = height - height % 2, width - width % 2
+    cells = image_array[:height, :width].reshape(height//2, 2, width//2, 2)[::step, :, ::step, :]
+    green = ((cells[:, 0, :, 1].astype(np.uint32) + cells[:, 1, :, 0]) >> 1).astype(image_array.dtype)
+    return np.stack([cells[:, 0, :, 0], green, cells[:, 1, :, 1]], axis=-1)
+
+
+def stretch(array:np.ndarray, max_value:int, percentiles:tuple[float, float]=STRETCH_PERCENTILES) -> tuple[np.ndarray, int, int]:
+    """Stretch the contrast of an image to 8 bits, so the low and high percentiles become black and white. Uses a
+    lookup table of every possible value, so it is one indexing pass over the image.
+
+    Args:
+        array (np.ndarray): Unsigned integer image with values up to max_value
+        max_value (int): Largest possible value (e.g. 255 for 8-bit)
+        percentiles (tuple[float, float], optional): Percentiles stretched to black and white. Defaults to STRETCH_PERCENTILES.
+
+    Returns:
+        tuple[np.ndarray, int, int]: uint8 image, and the values stretched to black and white
+    """
+    low, high = np.percentile(array[::2, ::2], percentiles)
+    low, high = int(low), max(int(high), int(low) + 1)
+    table = np.clip((np.arange(max_value + 1, dtype=np.float32) - low) * (255 / (high - low)), 0, 255).astype(np.uint8)
+    return table[np.minimum(array, max_value)], low, high
+
+
+class PreviewStream:
+    """Latest frame from the camera and the latest preview encoded from it.
+
+    add_frame is the capture callback and only keeps a reference to the newest frame, so previewing never holds up
+    acquisition. An encoder thread encodes the newest frame only when a client has taken the previous preview and is
+    waiting for the next, at most max_rate_hz times a second, so nothing is encoded without a client and the preview
+    rate follows the fastest client. Slower clients get the newest preview when they are ready, skipping the rest.
+    """
+
+    def __init__(self, pixel_format:str, max_rate_hz:float=MAX_RATE_HZ, max_width:int=MAX_WIDTH, quality:int=JPEG_QUALITY) -> None:
+        self.pixel_format = pixel_format
+        self.bayer = pixel_formats.is_bayer(pixel_format)
+        self.max_value = pixel_formats.max_value(pixel_format)
+        self.saturation_threshold = pixel_formats.scale_threshold(250, pixel_formats.bit_depth(pixel_format))
+        self.period = 1 / max(0.1, max_rate_hz)
+        self.max_width = max_width
+        self.quality = quality
+
+        self._condition = threading.Condition()
+        self._frame:tuple = None
+        self._frame_count = 0
+        self._encoded_frame_count = 0
+        self._jpeg:bytes = None
+        self._sequence = 0
+        self._demand = False
+        self._clients = 0
+        self._stopped = False
+        self._thread:threading.Thread = None
+
+        #Metrics
+        self._started = monotonic()
+        self._frame_time:float = None
+        self._camera_rate_hz = 0.0
+        self._last_encode = 0.0
+        self._preview_rate_hz = 0.0
+        self._integration_time_us:float = None
+        self._preview_metrics = {}
+
+    def start(self) -> "PreviewStream":
+        self._thread = threading.Thread(target=self._encode_loop, name="preview_encoder", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def add_frame(self, image_array:np.ndarray, integration_time_us:float, shape:tuple):
+        now = monotonic()
+        with self._condition:
+            self._frame = (image_array, integration_time_us, shape)
+            self._frame_count += 1
+            self._integration_time_us = integration_time_us
+            if self._frame_time is not None:
+                self._camera_rate_hz = 0.9 * self._camera_rate_hz + 0.1 / max(1e-6, now - self._frame_time)
+            self._frame_time = now
+            if self._demand:
+                self._condition.notify_all()
+
+    @property
+    def sequence(self) -> int:
+        """Number of the latest preview."""
+        return self._sequence
+
+    def connect(self):
+        with self._condition:
+            self._clients += 1
+
+    def disconnect(self):
+        with self._condition:
+            self._clients -= 1
+
+    def next_jpeg(self, after:int) -> tuple[int, bytes]|None:
+        """Wait for a preview newer than a sequence number.
+
+        Args:
+            after (int): Sequence number of the client's last preview
+
+        Returns:
+            tuple[int, bytes]|None: Sequence number and JPEG data of the preview, or None if there was no new preview
+                within CLIENT_WAIT_SECS or the stream is stopping
+        """
+        with self._condition:
+            if self._sequence <= after and not self._stopped:
+                self._demand = True
+                self._condition.notify_all()
+                self._condition.wait_for(lambda: self._sequence > after or self._stopped, timeout=CLIENT_WAIT_SECS)
+            if self._sequence <= after or self._stopped:
+                return None
+            return self._sequence, self._jpeg
+
+    def metrics(self) -> dict:
+        with self._condition:
+            frame_age = monotonic() - self._frame_time if self._frame_time is not None else None
+            return {"pixel_format": self.pixel_format,
+                    "exposure_ms": round(self._integration_time_us / 1e3, 3) if self._integration_time_us is not None else None,
+                    "camera_fps": round(self._camera_rate_hz, 1) if frame_age is not None and frame_age < 2 else 0,
+                    "frames": self._frame_count,
+                    "preview_fps": round(self._preview_rate_hz, 1) if self._clients > 0 else 0,
+                    "clients": self._clients,
+                    **self._preview_metrics,
+                    "uptime_secs": int(monotonic() - self._started)}
+
+    def _encode_loop(self):
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._stopped or (self._demand and self._frame_count > self._encoded_frame_count))
+                if self._stopped:
+                    return
+            #Hold to the rate, then take the frame which is newest after waiting
+            sleep(max(0, self._last_encode + self.period - monotonic()))
+            with self._condition:
+                image_array, integration_time_us, shape = self._frame
+                self._encoded_frame_count = self._frame_count
+            try:
+                jpeg, preview_metrics = self._encode(image_array, shape)
+            except Exception as e:
+                logger.error("Error encoding preview")
+                logger.exception(e)
+                sleep(self.period)
+                continue
+            now = monotonic()
+            with self._condition:
+                if self._last_encode > 0:
+                    self._preview_rate_hz = 0.8 * self._preview_rate_hz + 0.2 / max(1e-6, now - self._last_encode)
+                self._last_encode = now
+                self._jpeg = jpeg
+                self._preview_metrics = preview_metrics
+                self._sequence += 1
+                self._demand = False
+                self._condition.notify_all()
+
+    def _encode(self, image_array:np.ndarray, shape:tuple) -> tuple[bytes, dict]:
+        start = monotonic()
+        height, width = shape
+        if image_array.size != height * width:
+            image_array = pixel_formats.unpack(image_array, width, height, self.pixel_format)
+        image_array = image_array.reshape(shape)
+        preview = preview_array(image_array, self.bayer, self.max_width)
+        stretched, black, white = stretch(preview, self.max_value)
+        buffer = io.BytesIO()
+        Image.fromarray(stretched, mode="RGB" if self.bayer else "L").save(buffer, format="JPEG", quality=self.quality)
+        sharpness = focus.sharpness(focus.centre_cells(image_array))
+        return buffer.getvalue(), {"size": f"{width}x{height}",
+                                   "preview_size": f"{preview.shape[1]}x{preview.shape[0]}",
+                                   "black_level": black,
+                                   "white_level": white,
+                                   "saturated_percent": round(100 * float(np.mean(preview >= self.saturation_threshold)), 2),
+                                   "sharpness": round(sharpness, 2),
+                                   "encode_ms": round((monotonic() - start) * 1e3, 1),
+                                   "jpeg_kb": round(buffer.tell() / 1024, 1)}
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        stream:PreviewStream = self.server.stream
+        match urlsplit(self.path).path:
+            case "/" | "/index.html":
+                self._send(PAGE.format(title=self.server.title).encode(), "text/html; charset=utf-8")
+            case "/metrics":
+                self._send(json.dumps(stream.metrics()).encode(), "application/json")
+            case "/frame.jpg":
+                stream.connect()
+                try:
+                    frame = stream.next_jpeg(stream.sequence)
+                finally:
+                    stream.disconnect()
+                if frame is None:
+                    self.send_error(503, "No frame from the camera")
+                    return
+                self._send(frame[1], "image/jpeg")
+            case "/stream.mjpg":
+                self._stream(stream)
+            case _:
+                self.send_error(404)
+
+    def _send(self, body:bytes, content_type:str):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _stream(self, stream:PreviewStream):
+        self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, STREAM_SEND_BUFFER_BYTES)
+        self.send_response(200)
+        self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={BOUNDARY}")
+        self.send_header("Cache-Control", "no-store")
+        self.end_headers()
+        logger.info(f"Preview client {self.client_address[0]} connected")
+        stream.connect()
+        try:
+            sequence = stream.sequence
+            while not self.server.stopping:
+                frame = stream.next_jpeg(sequence)
+                if frame is None:
+                    continue
+                sequence, jpeg = frame
+                #Writing blocks while the client catches up, so a slow client asks for fewer previews
+                self.wfile.write(f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode())
+                self.wfile.write(jpeg)
+                self.wfile.write(b"\r\n")
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            stream.disconnect()
+            logger.info(f"Preview client {self.client_address[0]} disconnected")
+
+    def log_message(self, format, *args):
+        logger.debug(f"Preview request from {self.client_address[0]}: {format % args}")
+
+
+class PreviewServer(ThreadingHTTPServer):
+    """Serves a PreviewStream over HTTP, each client on its own thread."""
+    daemon_threads = True
+
+    def __init__(self, stream:PreviewStream, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT, title:str="AEGIR preview") -> None:
+        self.stream = stream
+        self.title = title
+        self.stopping = False
+        super().__init__((host, port), _RequestHandler)
+
+    def start(self) -> "PreviewServer":
+        """Serve requests on a background thread."""
+        threading.Thread(target=self.serve_forever, name="preview_server", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopping = True
+        self.shutdown()
+        self.server_close()
+
+
+def run_preview(serial_number:str=None, host:str=DEFAULT_HOST, port:int=DEFAULT_PORT, rate_hz:float=MAX_RATE_HZ,
+                max_width:int=MAX_WIDTH, profile:str=PREVIEW_PROFILE):
+    """Serve a live preview of a camera until Ctrl+C is pressed.
+
+    Args:
+        serial_number (str, optional): Serial number of the camera. Defaults to the first camera found.
+        host (str, optional): Address to serve on. Defaults to DEFAULT_HOST (all interfaces).
+        port (int, optional): Port to serve on. Defaults to DEFAULT_PORT.
+        rate_hz (float, optional): Most previews per second. Defaults to MAX_RATE_HZ.
+        max_width (int, optional): Widest preview in pixels. Defaults to MAX_WIDTH.
+        profile (str, optional): Capture profile while previewing. Defaults to PREVIEW_PROFILE.
+    """
+    cam:device_interface.Camera = device_interface.open(serial_number=serial_number)
+    if cam is None:
+        print("No camera found")
+        sys.exit(1)
+
+    original_profile = cam.capture_profile
+    original_format = cam.pixel_format
+    server:PreviewServer = None
+    stream:PreviewStream = None
+    try:
+        cam.set_capture_profile(profile)
+        #The preview is 8-bit, so 8-bit frames halve the USB bandwidth and need no unpacking
+        pixel_format = cam.set_bit_depth(8)
+        cam.set_to_manual()
+        stream = PreviewStream(pixel_format, max_rate_hz=rate_hz, max_width=max_width).start()
+        server = PreviewServer(stream, host=host, port=port, title=f"AEGIR preview - camera {cam.serial_number}").start()
+        cam.start_continuous_capture(callback=stream.add_frame, auto=True, callback_as_thread=False)
+
+        print(f"Serving the preview of camera {cam.serial_number} on http://{host if host != DEFAULT_HOST else '[this address]'}:{port}/ - Ctrl+C to exit.")
+        while cam.cap_thread.is_alive():
+            sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("\nExiting...")
+        if server is not None:
+            server.stop()
+        if stream is not None:
+            stream.stop()
+        cam.stop_continous_capture()
+        cam.set_pixel_format(original_format)
+        cam.set_capture_profile(original_profile)
+        cam.disconnect()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a live MJPEG preview of the camera over HTTP")
+    parser.add_argument("--host", default=DEFAULT_HOST, help=f"Address to serve on (default: {DEFAULT_HOST}, all interfaces)")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT, help=f"Port to serve on (default: {DEFAULT_PORT})")
+    parser.add_argument("--serial", required=False, help="Serial number of the camera (default: the first camera found)")
+    parser.add_argument("--rate", type=float, default=MAX_RATE_HZ, help=f"Most previews per second (default: {MAX_RATE_HZ})")
+    parser.add_argument("--width", type=int, default=MAX_WIDTH, help=f"Widest preview in pixels (default: {MAX_WIDTH})")
+    parser.add_argument("--profile", choices=list(device_interface.CAPTURE_PROFILES), default=PREVIEW_PROFILE, help=f"Capture profile while previewing (default: {PREVIEW_PROFILE})")
+    args = parser.parse_args()
+    run_preview(serial_number=args.serial, host=args.host, port=args.port, rate_hz=args.rate, max_width=args.width, profile=args.profile)
+
+
+if __name__ == "__main__":
+    main()
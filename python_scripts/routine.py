@@ -7,14 +7,59 @@ import numpy as np
 import threading
 import queue
 import logging
+import os
+import json
+import select
+from collections import deque
+from timing import PhaseTimer
+from cadence import AdaptiveCadence
+import pixel_formats
 
 CAPTURE_START = "capture_start"
 CAPTURE_END="capture_end"
+
+#Trigger modes - when each iteration of the integration times and gains is captured
+TIME_TRIGGER = "time"
+""" Iterations are started by time (interval_time and repeat_interval_time) """
+DEPTH_TRIGGER = "depth"
+""" Iterations are started by depth steps and descent rate changes measured by the pressure sensor """
+
+#Longest time between pressure sensor samples in depth trigger mode
+DEPTH_SAMPLE_INTERVAL_SECS = 0.25
+#Depth samples over this time are used to estimate the descent rate
+DEPTH_RATE_WINDOW_SECS = 2.0
+
+#Routine files and the cache of their parsed parameters kept in the routine directory (see RoutineIndex)
+ROUTINE_EXTENSIONS = ["txt", "yaml", "yml"]
+INDEX_FILENAME = ".routine_index.json"
+INDEX_VERSION = 1
+
+#Time units accepted for the *_unit parameters (see convert_to_seconds)
+TIME_UNITS = ["hours", "hour", "hrs", "hr", "hs", "h",
+              "minutes", "minute", "mins", "min", "m",
+              "seconds", "second", "sec", "secs", "s",
+              "milliseconds", "millisecond", "ms",
+              "microseconds", "microsecond", "us"]
+
+#Rough time taken to switch between the DEFAULT and LONG_EXPOSURE sensor modes (stop acquisition, load user set, restore settings, restart)
+SENSOR_MODE_SWITCH_SECS = 1.5
+#Default longest integration time available in the DEFAULT sensor mode
+LONG_EXPOSURE_THRESHOLD_SECS = 1.0
+#The scheduler sleeps until this long before a capture is due, then waits in short sleeps so captures start on time
+SCHEDULER_SPIN_SECS = 0.002
 ACCEPTED_PARAMS={"name":str, "initial_delay_time_secs":(float,int), "number_limit":(float,int),
                  "time_limit_secs":(float,int), "repeat":(float, int), "repeat_interval_time_secs":(float,int), "interval_mode":str,
                  "interval_secs":(float,int), "integration_time_secs":(float,int),
                  "loop_integration_time":bool, "gain":(float,int), "loop_gain":bool,
-                 "min_tick_length_secs":(float,int), "all_combinations":bool}
+                 "min_tick_length_secs":(float,int), "all_combinations":bool,
+                 "metering_decimation":(float,int), "optimise_plan":bool, "long_exposure_threshold_secs":(float,int),
+                 "capture_profile":str, "metering_profile":str, "bracket_mode":bool,
+                 "bit_depth":(float,int), "packed_pixels":bool, "storage_format":str, "hdr_mode":bool, "hdr_stops":(float,int,list),
+                 "trigger_mode":str, "depth_step":(float,int), "descent_rate_threshold":(float,int), "depth_fallback_interval_secs":(float,int),
+                 "adaptive_cadence":bool, "adaptive_min_interval_secs":(float,int), "adaptive_max_interval_secs":(float,int),
+                 "adaptive_growth":(float,int), "luminance_tolerance":(float,int), "saturation_tolerance":(float,int),
+                 "skip_unchanged":bool, "unchanged_store_interval_secs":(float,int),
+                 "sensor_sample_rate":(float,int), "sensor_oversampling":(float,int)}
 
 
 logger = logging.getLogger()
@@ -22,7 +67,7 @@ logger = logging.getLogger()
 
 class Routine:
     
-    def placeholder_capture(integration_time, gain, auto, capture_n=None):
+    def placeholder_capture(integration_time, gain, auto, capture_n=None, next_settings=None):
         int_string = f"{round(integration_time, 6)}s"
         if integration_time == 0 or auto:
             int_string = "Auto-adjust"
@@ -35,6 +80,11 @@ class Routine:
     
         return None
 
+    def placeholder_bracket(bracket:list[dict], capture_n=None):
+        for n, settings in enumerate(bracket):
+            Routine.placeholder_capture(settings["integration_time"], settings["gain"], False, None if capture_n is None else capture_n + n)
+        return len(bracket)
+
     def __init__(self, name,
                  initial_delay_time_secs:float=0, 
                  number_limit:int|float=10000,
@@ -48,8 +98,34 @@ class Routine:
                  gain:float|list=1, 
                  loop_gain:bool=False,
                  all_combinations:bool=False,
-                 min_tick_length_secs:float=0.01,
-                 capture_function:callable=placeholder_capture) -> None:
+                 min_tick_length_secs:float=None,
+                 metering_decimation:int=4,
+                 optimise_plan:bool=False,
+                 long_exposure_threshold_secs:float=LONG_EXPOSURE_THRESHOLD_SECS,
+                 capture_profile:str="full",
+                 metering_profile:str=None,
+                 bracket_mode:bool=False,
+                 bit_depth:int=8,
+                 packed_pixels:bool=True,
+                 storage_format:str=None,
+                 hdr_mode:bool=False,
+                 hdr_stops:tuple|list|float=(-2, 0, 2),
+                 trigger_mode:str=TIME_TRIGGER,
+                 depth_step:float=0.5,
+                 descent_rate_threshold:float=0,
+                 depth_fallback_interval_secs:float=0,
+                 adaptive_cadence:bool=False,
+                 adaptive_min_interval_secs:float=None,
+                 adaptive_max_interval_secs:float=60*60,
+                 adaptive_growth:float=2.0,
+                 luminance_tolerance:float=0.1,
+                 saturation_tolerance:float=0.005,
+                 skip_unchanged:bool=False,
+                 unchanged_store_interval_secs:float=0,
+                 sensor_sample_rate:float=4,
+                 sensor_oversampling:int=8192,
+                 capture_function:callable=placeholder_capture,
+                 bracket_function:callable=placeholder_bracket) -> None:
 
         
         
@@ -62,33 +138,32 @@ class Routine:
         self.repeat:int = int(repeat)
         self.repeat_interval_time_secs:float = repeat_interval_time_secs
         
+        #Only one iteration of settings is stored. A single integration time and gain is one setting repeated
+        #for the whole number limit, so it is not expanded.
+        single_setting = not all_combinations and np.size(integration_time_secs) == 1 and np.size(gain) == 1
         settings = Routine._create_settings_matrix(integration_times=integration_time_secs,
                                                        gains=gain,
                                                        all_combinations=all_combinations,
-                                                       number_limit=self.number_limit,
+                                                       number_limit=1 if single_setting else self.number_limit,
                                                        loop_gain=loop_gain,
                                                        loop_integration_time=loop_integration_time)
         
-        self.iteration_length = np.size(settings[0,:])
-        
-        if self.repeat == 0:
-            self.repeat = int(self.number_limit / self.iteration_length)
+        self.iteration_length = self.number_limit if single_setting else np.size(settings[0,:])
+        self.single_setting:bool = single_setting
         
+        self.optimise_plan:bool = optimise_plan
+        self.long_exposure_threshold_secs:float = long_exposure_threshold_secs
+        self.mode_switches_unoptimised = CapturePlan(settings, self.iteration_length, self.repeat, self.number_limit).count_mode_switches(self.long_exposure_threshold_secs)
         
-        settings = np.tile(settings, self.repeat)
+        if self.optimise_plan:
+            # Group each iteration by sensor mode and run every other repeat in reverse (after its auto captures)
+            # so consecutive iterations meet in the same sensor mode
+            settings = Routine._optimise_settings_matrix(settings, self.long_exposure_threshold_secs)
 
+        #Settings of each capture are generated from the plan as they are needed (repeat of 0 runs until a limit is reached)
+        self.plan = CapturePlan(settings, self.iteration_length, self.repeat, self.number_limit, serpentine=self.optimise_plan)
         
-        self.int_times_seconds:np.ndarray = settings[0,:self.number_limit]
-        self.gains:np.ndarray = settings[1,:self.number_limit]
-        
-        #Create queue which holds the settings for each photo.
-        self.params_queue : queue.Queue = queue.Queue()
-        for param_set in range(self.int_times_seconds.shape[0]):
-            self.params_queue.put({'integration_time': self.int_times_seconds[param_set],
-                                   'gain': self.gains[param_set]})
-        
-        # Add a None value to the end of the queue. When this is reached, the image acquisition thread will stop
-        self.params_queue.put(None)
+        self.mode_switches = self.plan.count_mode_switches(self.long_exposure_threshold_secs)
 
 
                 
@@ -99,26 +174,127 @@ class Routine:
         
         self.interval_secs = interval_time_secs
         
+        #Auto exposure metering statistics only sample one in every [metering_decimation] Bayer cells along each axis
+        self.metering_decimation:int = max(1, int(metering_decimation))
+        
+        #On-camera binning/decimation and region of interest (see device_interface.CAPTURE_PROFILES)
+        self.capture_profile:str = capture_profile.lower()
+        #Optional reduced profile for auto exposure metering frames after the first attempt. If it is used, the session
+        #image is captured with the capture profile at the accepted integration time once metering is complete.
+        if metering_profile is not None and metering_profile.lower() in ["", "none", self.capture_profile]:
+            metering_profile = None
+        self.metering_profile:str = metering_profile.lower() if metering_profile is not None else None
+        
+        #Pixel format bit depth (8, 10 or 12) and whether packed formats are preferred for 10 and 12-bit images
+        self.bit_depth:int = int(bit_depth)
+        self.packed_pixels:bool = packed_pixels
+        #How images are saved - debayered RGB or the raw sensor data. Images deeper than 8 bits (including fused HDR
+        #images) are always saved raw (see pixel_formats.storage_format).
+        if storage_format is not None and str(storage_format).lower() not in pixel_formats.STORAGE_FORMATS:
+            logger.warning(f"Storage format not recognised, setting to default: {pixel_formats.RGB_STORAGE}")
+            storage_format = None
+        elif storage_format is not None and str(storage_format).lower() == pixel_formats.RGB_STORAGE and self.bit_depth > 8:
+            logger.warning(f"{self.bit_depth}-bit images can't be saved as {pixel_formats.RGB_STORAGE} - saving them {pixel_formats.RAW_STORAGE}")
+        self.storage_format:str = pixel_formats.storage_format(None if storage_format is None else str(storage_format).lower(), self.bit_depth)
+        
+        #Fuse each bracket into one HDR image. Auto-adjust captures are bracketed by hdr_stops
+        #(in stops, i.e. powers of 2, relative to the accepted integration time).
+        self.hdr_mode:bool = hdr_mode
+        hdr_stops = [float(stop) for stop in np.atleast_1d(hdr_stops)]
+        self.hdr_stops:list[float] = hdr_stops if 0 in hdr_stops else [0.0] + hdr_stops
+        
+        #Capture each iteration as one bracket (uploaded to the camera sequencer where available)
+        #rather than one capture per tick. Interval settings then only apply between brackets.
+        self.bracket_mode:bool = bracket_mode or (hdr_mode and bool(np.any(self.plan.settings[0,:] != 0)))
+        
         capture_start = self.interval_mode == CAPTURE_START
         capture_end = self.interval_mode == CAPTURE_END
-        self.expected_time = self.int_times_seconds.size +sum(self.int_times_seconds) + self.repeat*self.repeat_interval_time_secs + capture_start*self.interval_secs*self.int_times_seconds[self.int_times_seconds > self.interval_secs -1].size + capture_end*self.interval_secs*self.int_times_seconds.size
+        plan_size = len(self.plan)
+        plan_integration_secs = self.plan.total(lambda int_times, gains: np.sum(int_times))
+        long_captures = self.plan.total(lambda int_times, gains: np.count_nonzero(int_times > self.interval_secs - 1))
+        self.expected_time = plan_size + plan_integration_secs + self.plan.iterations*self.repeat_interval_time_secs + capture_start*self.interval_secs*long_captures + capture_end*self.interval_secs*plan_size
         self.expected_time = int(min(self.time_limit_secs, self.expected_time))
         
         
-        self.tick_length = min(min_tick_length_secs, 0.001)
+        #No longer used - the routine sleeps until the next capture, stop signal or limit (see wait_for_event).
+        #Still accepted so older routine files load.
+        if min_tick_length_secs is not None:
+            logger.warning(f"Routine {name}: min_tick_length is deprecated and has no effect - the routine waits until the next capture is due")
         #Variables for running
         self.capture_function = capture_function
+        self.bracket_function = bracket_function
         self.start_time = None
         self.run_time = 0
         self.next_capture = None
         self.image_count = 0
+        #Images stored - one per capture, but one per bracket when the bracket is fused into an HDR image, so it can be
+        #less than image_count (the number of captures in the plan taken)
+        self.stored_count = 0
+        #Number of captures in the plan completed by the capture thread
+        self.progress = 0
+        #Progress once the capture being taken is complete, recorded with its images so the session's progress only
+        #moves on when they have been saved
+        self.capture_progress = 0
         self.complete = threading.Event()
         self.last_time_printed=0
         self.capturing_images=threading.Event()
         self.stop_signal = threading.Event()
         self.stop_reason = None
+        #Captures are held while paused (see pause)
+        self.paused = threading.Event()
+        
+        #Depth triggered capture: an iteration is captured each time the depth changes by depth_step metres from the
+        #depth of the last iteration, and (if descent_rate_threshold is set) when the descent rate crosses the threshold
+        #in either direction. If depth_fallback_interval_secs is set, an iteration is also captured after that long
+        #without a trigger. The time limit still applies.
+        if trigger_mode.lower() not in [TIME_TRIGGER, DEPTH_TRIGGER]:
+            logger.warning(f"Trigger mode not recognised, setting to default: {TIME_TRIGGER}")
+            trigger_mode = TIME_TRIGGER
+        self.trigger_mode:str = trigger_mode.lower()
+        self.depth_step:float = abs(depth_step)
+        self.descent_rate_threshold:float = descent_rate_threshold
+        self.depth_fallback_interval_secs:float = depth_fallback_interval_secs
+        self.depth:float = None
+        self.descent_rate:float = None
+        self.awaiting_trigger = False
+        self.awaiting_since:float = None
+        self.pending_trigger:str = None
+        self.last_trigger_depth:float = None
+        self.trigger_count = 0
+        self._descending:bool = None
+        self._depth_samples:deque = deque()
+        self._depth_lock = threading.Lock()
+        
+        #Adaptive cadence: the interval between iterations (or between captures for a single setting) stretches while
+        #the scene is unchanged and snaps back to the minimum when it changes (see cadence.AdaptiveCadence).
+        #Skipping unchanged frames uses the same scene comparison, with or without the adaptive interval.
+        self.adaptive_cadence:bool = adaptive_cadence
+        self.cadence:AdaptiveCadence = None
+        if adaptive_cadence or skip_unchanged:
+            configured_interval = self.interval_secs if single_setting else self.repeat_interval_time_secs
+            self.cadence = AdaptiveCadence(min_interval_secs=configured_interval if adaptive_min_interval_secs is None else adaptive_min_interval_secs,
+                                           max_interval_secs=adaptive_max_interval_secs,
+                                           growth=adaptive_growth,
+                                           luminance_tolerance=luminance_tolerance,
+                                           saturation_tolerance=saturation_tolerance,
+                                           skip_unchanged=skip_unchanged,
+                                           store_interval_secs=unchanged_store_interval_secs)
+        #Next capture time set from the adaptive interval, and the time it was counted from
+        self._cadence_deadline:float = None
+        self._cadence_start:float = None
+        self._schedule_lock = threading.Lock()
+        
+        #Pressure sensor samples per second and oversampling ratio of each conversion (see pressure_sampler.PressureSampler)
+        self.sensor_sample_rate:float = sensor_sample_rate
+        self.sensor_oversampling:int = int(sensor_oversampling)
         self.capture_queue :queue.Queue = queue.Queue()
         self.capture_start_time = None
+        #Self-pipe used to wake wait_for_event when the capture thread finishes a capture or the routine is stopped
+        self._wake_read_fd, self._wake_write_fd = os.pipe()
+        os.set_blocking(self._wake_read_fd, False)
+        os.set_blocking(self._wake_write_fd, False)
+        #Durations of each phase of a capture while running this routine
+        self.phase_timer = PhaseTimer(self.name)
         
     def __str__(self):
         string = ""
@@ -127,15 +303,40 @@ class Routine:
         string += f"\nNumber Limit: {self.number_limit}"
         string += f"\nTime Limit: {str(timedelta(seconds=self.time_limit_secs))}"
         string += f"\nInterval: {self.interval_secs}s"
+        string += f"\nBracket Mode: {self.bracket_mode}"
+        if self.hdr_mode:
+            string += f"\nHDR Mode: fused brackets, auto-adjust stops {self.hdr_stops}"
         string += f"\nInterval Mode: {self.interval_mode}"
+        if self.trigger_mode == DEPTH_TRIGGER:
+            string += f"\nTrigger: depth steps of {self.depth_step}m"
+            if self.descent_rate_threshold > 0:
+                string += f", descent rate crossing {self.descent_rate_threshold}m/s"
+            if self.depth_fallback_interval_secs > 0:
+                string += f", or every {self.depth_fallback_interval_secs}s without a trigger"
+        if self.adaptive_cadence:
+            string += f"\nAdaptive Cadence: {self.cadence}"
+        elif self.cadence is not None:
+            string += f"\nSkip Unchanged: one frame of each setting stored every {self.cadence.store_interval_secs}s"
         string += f"\nIteration Length: {self.iteration_length}"
-        string += f"\nRepeat: {self.repeat}"
+        string += f"\nRepeat: {self.repeat if self.repeat > 0 else 'Until limit'}"
         string += f"\nRepeat Interval: {self.repeat_interval_time_secs}s"
-        string += f"\nIntegration_times (s): { (str(self.int_times_seconds[:7]).strip(']') + '...]') if len(str(self.int_times_seconds)) > 10 else str(self.int_times_seconds)}"
-        string += f"\nGain settings: { (str(self.gains[:7]).strip(']') + '...]') if len(str(self.gains)) > 10 else str(self.gains)}"
-        string += f"\nPlanned Image total: {self.int_times_seconds.size}"
-        string += f"\nTime Estimate: {datetime.fromtimestamp(time.time() + self.expected_time).strftime('%Y-%m-%d %H:%M:%S')} ({str(timedelta(seconds=self.expected_time))})"
-        string += f"\nTick length: {self.tick_length}"
+        int_times, gains = self.plan.head(8)
+        string += f"\nIntegration_times (s): { (str(int_times[:7]).strip(']') + '...]') if int_times.size > 7 else str(int_times)}"
+        string += f"\nGain settings: { (str(gains[:7]).strip(']') + '...]') if gains.size > 7 else str(gains)}"
+        string += f"\nPlanned Image total: {len(self.plan)}"
+        if self.plan.position > 0:
+            string += f" (resuming from #{self.plan.position})"
+        string += f"\nSensor Mode Switches: {self.mode_switches}"
+        if self.optimise_plan:
+            saved = (self.mode_switches_unoptimised - self.mode_switches) * SENSOR_MODE_SWITCH_SECS
+            string += f" (Optimised from {self.mode_switches_unoptimised} - saves ~{str(timedelta(seconds=int(saved)))})"
+        string += f"\nTime Estimate: {datetime.fromtimestamp(time.time() + self.expected_time).strftime('%Y-%m-%d %H:%M:%S')} ({str(timedelta(seconds=self.expected_time))}) - rough, use 'aegir simulate' for a calibrated prediction"
+        string += f"\nCapture Profile: {self.capture_profile}"
+        string += f"\nBit Depth: {self.bit_depth}{' (packed)' if self.packed_pixels and self.bit_depth > 8 else ''}"
+        string += f"\nStorage Format: {self.storage_format}"
+        if self.metering_profile is not None:
+            string += f"\nMetering Profile: {self.metering_profile}"
+        string += f"\nMetering Decimation: {self.metering_decimation}"
         return string
     
     def log_routine_info(self):
@@ -144,6 +345,103 @@ class Routine:
 
 
     
+    def notify(self):
+        """Wake a thread waiting in wait_for_event so it ticks the routine."""
+        if self._wake_write_fd is None:
+            return
+        try:
+            os.write(self._wake_write_fd, b"\0")
+        except BlockingIOError:
+            #The pipe is full so a wake is already pending
+            pass
+
+    def close(self):
+        """Close the pipe used to wake the scheduler once the routine has finished, e.g. before the daemon runs the next routine."""
+        read_fd, write_fd = self._wake_read_fd, self._wake_write_fd
+        self._wake_read_fd = self._wake_write_fd = None
+        for fd in [read_fd, write_fd]:
+            if fd is not None:
+                os.close(fd)
+
+    def stop(self, reason:str=None):
+        """Send the stop signal and wake the scheduler.
+
+        Args:
+            reason (str, optional): Reason for stopping, recorded if no other reason has been. Defaults to None.
+        """
+        if reason is not None and self.stop_reason is None:
+            self.stop_reason = reason
+        self.stop_signal.set()
+        self.notify()
+
+    def pause(self):
+        """Hold captures until unpause is called. A capture already in progress finishes, and the time limit still counts down."""
+        self.paused.set()
+        self.notify()
+
+    def unpause(self):
+        """Continue capturing after pause. A capture which became due while paused is taken straight away."""
+        with self._schedule_lock:
+            if self.next_capture is not None:
+                self.next_capture = max(self.next_capture, time.time())
+        self.paused.clear()
+        self.notify()
+
+    def next_deadline(self) -> float:
+        """Time (as time.time()) of the next scheduled event of the routine - the next capture or the time limit.
+
+        Returns:
+            float: Deadline, or None if nothing is scheduled until the capture thread next finishes a capture
+        """
+        if self.start_time is None:
+            return time.time()
+        if self.stop_signal.is_set():
+            #Only waiting for the capture thread to finish, which notifies when it does
+            return None
+        deadlines = []
+        if self.next_capture is not None and not self.paused.is_set():
+            deadlines.append(self.next_capture)
+        if self.awaiting_trigger and self.depth_fallback_interval_secs > 0 and not self.paused.is_set():
+            deadlines.append(self.awaiting_since + self.depth_fallback_interval_secs)
+        if self.time_limit_secs is not None:
+            deadlines.append(self.start_time + self.time_limit_secs)
+        return min(deadlines) if len(deadlines) > 0 else None
+
+    def wait_for_event(self, timeout:float=None, fds:list[int]=[]) -> list[int]:
+        """Sleep until the routine needs to tick: the next capture is due, the time limit is reached, the capture
+        thread finishes a capture, or the routine is stopped. Also wakes when any of the given file descriptors
+        is readable, or after the timeout.
+
+        Sleeping uses select so it takes no CPU time. To keep capture timing accurate the last SCHEDULER_SPIN_SECS
+        before a capture are waited in short sleeps.
+
+        Args:
+            timeout (float, optional): Longest time to wait in seconds. Defaults to None (no limit).
+            fds (list[int], optional): File descriptors to also wait on (e.g. a socket). Defaults to [].
+
+        Returns:
+            list[int]: The file descriptors from fds which are readable
+        """
+        now = time.time()
+        deadline = self.next_deadline()
+        if timeout is not None:
+            deadline = now + timeout if deadline is None else min(deadline, now + timeout)
+        
+        sleep_time = None if deadline is None else max(0, deadline - now - SCHEDULER_SPIN_SECS)
+        readable, _, _ = select.select([self._wake_read_fd, *fds], [], [], sleep_time)
+        
+        if self._wake_read_fd in readable:
+            try:
+                while os.read(self._wake_read_fd, 4096):
+                    pass
+            except BlockingIOError:
+                pass
+        elif deadline is not None and len(readable) == 0:
+            while time.time() < deadline:
+                time.sleep(0.0001)
+        
+        return [fd for fd in readable if fd != self._wake_read_fd]
+
     def start_capture_thread(self):
         capture_thread = threading.Thread(target=self.process_capture_queue)
         capture_thread.daemon=True
@@ -175,21 +473,30 @@ class Routine:
                         logger.info("Capture Queue: Sentinel value received.")
                         self.complete.set()
                         break
+                    if isinstance(image_params, list):
+                        self.capture_progress = self.progress + len(image_params)
+                        self.capture_bracket(image_params)
+                        self.progress = self.capture_progress
+                        continue
                     integration_time = image_params["integration_time"]
                     gain=image_params["gain"]
+                    self.capture_progress = self.progress + 1
                     self.capture_image(integration_time=integration_time, gain=gain)
+                    self.progress = self.capture_progress
                     
                 except Exception as e:
                     logger.exception("Error processing capture queue item")
                     #traceback.print_exception(e, file=sys.stderr)
                 finally:
                     self.capture_queue.task_done()
+                    self.notify()
         except Exception as e:
             logger.exception("Error processing capture queue")
 
         finally:                
             self.capturing_images.clear()
             self.complete.set()
+            self.notify()
             logger.info("Capture Queue: Finished processing capture queue.")
             return
 
@@ -208,25 +515,184 @@ class Routine:
             logger.info(f"Routine Module: {round(time.time()-self.start_time, 2)}s ==> Capturing Img #{self.image_count} ~ I:{int_string} | G: {gain}dB")
 
                     
-            self.capture_function(integration_time_secs=integration_time, gain=gain, auto=auto, capture_n = self.image_count+1)
+            #The capture function can stage the next capture's settings on the camera once this frame has been captured
+            self.capture_function(integration_time_secs=integration_time, gain=gain, auto=auto, capture_n = self.image_count+1, next_settings=self._peek_param_set())
             self.image_count += 1
+            self.stored_count += 1
             if self.interval_mode == CAPTURE_END: 
                 self.set_next_capture_time()
         except Exception as e:
             logger.error(f"Error capturing image {self.image_count}")
             logger.exception(e)
 
+    def capture_bracket(self, bracket:list[dict]):
+        try:
+            self.capture_start_time = time.time()
+            logger.info(f"Routine Module: {round(time.time()-self.start_time, 2)}s ==> Capturing bracket of {len(bracket)} from Img #{self.image_count}")
+            
+            #The bracket function returns the number of images stored
+            stored = self.bracket_function(bracket, capture_n=self.image_count+1)
+            self.image_count += len(bracket)
+            self.stored_count += len(bracket) if stored is None else stored
+            
+            #The bracket is one capture, so the interval is counted from its start or end
+            start = self.capture_start_time if self.interval_mode == CAPTURE_START else time.time()
+            if self.image_count % self.iteration_length == 0:
+                self.next_capture = self._next_iteration_time(start)
+            else:
+                self.next_capture = start + self.interval_secs
+            if self.next_capture is not None:
+                logger.info(f"Set next capture time to: {datetime.fromtimestamp(self.next_capture).strftime('%Y-%m-%d %H:%M:%S')}")
+        except Exception as e:
+            logger.error(f"Error capturing bracket at image {self.image_count}")
+            logger.exception(e)
+
     def set_next_capture_time(self):
 
         #if self.interval_mode == CAPTURE_END:
 
-        self.next_capture = time.time()+self.interval_secs
+        if self.adaptive_cadence and self.single_setting:
+            self.next_capture = self._adaptive_capture_time(time.time())
+        else:
+            self.next_capture = time.time()+self.interval_secs
         #else:
         #    self.next_capture = self.capture_start_time + self.interval_secs
         image_count = self.image_count if self.interval_mode == CAPTURE_END else self.image_count + 1
         if image_count % self.iteration_length == 0:
-            self.next_capture = time.time() + self.repeat_interval_time_secs
-        logger.info(f"Set next capture time to: {datetime.fromtimestamp(self.next_capture).strftime('%Y-%m-%d %H:%M:%S')}")
+            self.next_capture = self._next_iteration_time(time.time())
+        if self.next_capture is not None:
+            logger.info(f"Set next capture time to: {datetime.fromtimestamp(self.next_capture).strftime('%Y-%m-%d %H:%M:%S')}")
+
+    def _next_iteration_time(self, start:float) -> float|None:
+        """Time to start the next iteration once the current one is complete.
+
+        Args:
+            start (float): Time the repeat interval is counted from
+
+        Returns:
+            float|None: Start time of the next iteration, or None if waiting for a depth trigger
+        """
+        if self.trigger_mode != DEPTH_TRIGGER:
+            if self.adaptive_cadence and not self.single_setting:
+                return self._adaptive_capture_time(start)
+            return start + self.repeat_interval_time_secs
+        with self._depth_lock:
+            if self.pending_trigger is not None:
+                #Triggered while the last iteration was being captured
+                logger.info(f"Depth trigger: {self.pending_trigger} (during the last iteration)")
+                self.pending_trigger = None
+                self._start_triggered_iteration()
+                return time.time()
+            self.awaiting_trigger = True
+            self.awaiting_since = time.time()
+        logger.info(f"Waiting for depth trigger (last iteration at {'unknown depth' if self.last_trigger_depth is None else f'{self.last_trigger_depth:.2f}m'})")
+        return None
+
+    def _adaptive_capture_time(self, start:float) -> float:
+        """Time of the next capture (or iteration) from the adaptive cadence interval.
+
+        Args:
+            start (float): Time the interval is counted from
+
+        Returns:
+            float: Start time of the next capture
+        """
+        interval = self.cadence.next_interval()
+        with self._schedule_lock:
+            self._cadence_start = start
+            self._cadence_deadline = start + interval
+        logger.info(f"Adaptive cadence interval: {interval:.1f}s")
+        return self._cadence_deadline
+
+    def observe_scene(self, key, luminance:float, saturation_fraction:float) -> bool:
+        """Report the statistics of a captured frame for adaptive cadence and skipping unchanged frames. If the scene has
+        changed while waiting out a stretched interval, the next capture is brought forward to the minimum interval.
+
+        Args:
+            key: Settings of the frame. Frames are only compared with frames of the same key.
+            luminance (float): Luminance of the active area divided by the integration time and linear gain
+            saturation_fraction (float): Fraction of saturated pixels in the active area
+
+        Returns:
+            bool: Whether the frame should be stored
+        """
+        if self.cadence is None:
+            return True
+        changed, store = self.cadence.observe(key, luminance, saturation_fraction)
+        if changed and self.adaptive_cadence:
+            with self._schedule_lock:
+                deadline = self._cadence_deadline
+                #Only move a capture scheduled from the adaptive interval which has not been queued yet
+                if deadline is not None and self.next_capture == deadline:
+                    earliest = max(self._cadence_start + self.cadence.min_interval_secs, time.time())
+                    if deadline > earliest:
+                        self.next_capture = self._cadence_deadline = earliest
+                        logger.info(f"Scene changed - next capture brought forward to {datetime.fromtimestamp(earliest).strftime('%Y-%m-%d %H:%M:%S')}")
+                        self.notify()
+        if not store:
+            logger.info(f"Skipped unchanged frame ({self.cadence.skipped_count} skipped)")
+        return store
+
+    def _start_triggered_iteration(self):
+        #Must be called with the depth lock held
+        self.awaiting_trigger = False
+        self.last_trigger_depth = self.depth
+        self.trigger_count += 1
+
+    def trigger(self, reason:str):
+        """Start the next iteration of a depth triggered routine. If an iteration is still being captured, the next
+        iteration starts as soon as it is complete.
+
+        Args:
+            reason (str): Reason for the trigger, for the log
+        """
+        with self._depth_lock:
+            if not self.awaiting_trigger:
+                if self.pending_trigger is None:
+                    self.pending_trigger = reason
+                return
+            self._start_triggered_iteration()
+            self.next_capture = time.time()
+        logger.info(f"Depth trigger: {reason}")
+        self.notify()
+
+    def update_depth(self, depth:float, timestamp:float=None):
+        """Add a depth sample from the pressure sensor. In depth trigger mode, triggers the next iteration if the depth
+        has changed by depth_step since the last iteration, or the descent rate has crossed descent_rate_threshold.
+
+        Args:
+            depth (float): Depth in metres
+            timestamp (float, optional): Time of the sample (as time.time()). Defaults to now.
+        """
+        timestamp = time.time() if timestamp is None else timestamp
+        reason = None
+        with self._depth_lock:
+            self.depth = depth
+            self._depth_samples.append((timestamp, depth))
+            while self._depth_samples[0][0] < timestamp - DEPTH_RATE_WINDOW_SECS:
+                self._depth_samples.popleft()
+            
+            #Descent rate from the least squares slope of the recent samples (positive when descending)
+            if len(self._depth_samples) >= 3:
+                times, depths = np.array(self._depth_samples).T
+                times = times - times.mean()
+                spread = np.sum(times**2)
+                self.descent_rate = float(np.sum(times * (depths - depths.mean())) / spread) if spread > 0 else None
+            
+            if self.trigger_mode != DEPTH_TRIGGER or self.start_time is None:
+                return
+            if self.last_trigger_depth is None:
+                self.last_trigger_depth = depth
+            elif self.depth_step > 0 and abs(depth - self.last_trigger_depth) >= self.depth_step:
+                reason = f"depth step ({self.last_trigger_depth:.2f}m to {depth:.2f}m)"
+            
+            if self.descent_rate_threshold > 0 and self.descent_rate is not None:
+                descending = self.descent_rate >= self.descent_rate_threshold
+                if self._descending is not None and descending != self._descending and reason is None:
+                    reason = f"descent rate {'above' if descending else 'below'} {self.descent_rate_threshold}m/s ({self.descent_rate:.2f}m/s)"
+                self._descending = descending
+        if reason is not None:
+            self.trigger(reason)
         
     def tick(self):
         self.now = time.time()
@@ -236,6 +702,7 @@ class Routine:
                 self.start_time = time.time()
 
                 self.next_capture =  self.start_time + self.initial_delay
+                self.last_trigger_depth = self.depth
         try:
             
             self.run_time = self.now-self.start_time
@@ -243,7 +710,6 @@ class Routine:
             def tick_done(complete:bool=False, stop_reason:str=None):
                 if complete:
                     self.complete.set()
-                tick_remaining = self.tick_length-(time.time()-self.now)
 
                 if (complete or self.stop_signal.is_set()) and stop_reason is not None and self.stop_reason is None:
                     self.stop_reason = stop_reason
@@ -255,9 +721,6 @@ class Routine:
                     logger.info(f"Tick Done: Stop Signal:{self.stop_signal.is_set()} Complete:{self.complete.is_set()}")
                     logger.info(f"Stop Reason: {self.stop_reason}")
                     
-                
-                if tick_remaining > 0:
-                    time.sleep(tick_remaining)
                 return self.complete.is_set()
             
             if self.complete.is_set():
@@ -277,7 +740,7 @@ class Routine:
                         self.stop_signal.set()
                     else:
                         self.complete.set()
-                    tick_done(self.complete.is_set(), f"Reached Number Limit of {self.number_limit} (Image count: {self.image_count}, Number of integration_times: {self.int_times_seconds.size}) (First trap)")
+                    tick_done(self.complete.is_set(), f"Reached Number Limit of {self.number_limit} (Image count: {self.image_count}, Number of integration_times: {len(self.plan)}) (First trap)")
                     return self.complete.is_set()
             
             
@@ -288,23 +751,37 @@ class Routine:
                     return self.complete.is_set()
             
             
-            if self.image_count >= self.int_times_seconds.size:
+            if self.image_count >= len(self.plan):
                 if not self.capturing_images.is_set():
                     self.complete.set()
                 else:
                     self.stop_signal.set()
-                tick_done(self.complete.is_set(), f"Reached end of routine ({self.image_count}/{self.int_times_seconds.size} images)")
+                tick_done(self.complete.is_set(), f"Reached end of routine ({self.image_count}/{len(self.plan)} images)")
                 return self.complete.is_set()
             
-            if self.now > self.next_capture and not self.stop_signal.is_set():
-                self.next_capture = self.next_capture + 10000000
-                next_param_set = self.params_queue.get(block=False)
+            if self.awaiting_trigger and self.depth_fallback_interval_secs > 0 and self.now >= self.awaiting_since + self.depth_fallback_interval_secs:
+                self.trigger(f"no trigger for {self.depth_fallback_interval_secs}s")
+            
+            with self._schedule_lock:
+                capture_due = self.next_capture is not None and self.now > self.next_capture and not self.stop_signal.is_set() and not self.paused.is_set()
+                if capture_due:
+                    self.next_capture = self.next_capture + 10000000
+            if capture_due:
+                next_param_set = self._next_param_set()
+                if self.bracket_mode and next_param_set is not None:
+                    #Take the rest of the current iteration as one bracket
+                    bracket = [next_param_set]
+                    while self.plan.position % self.iteration_length != 0:
+                        next_param_set = self._next_param_set()
+                        if next_param_set is None:
+                            break
+                        bracket.append(next_param_set)
+                    next_param_set = bracket
                 if next_param_set is None:
                     self.complete.set()
-                    tick_done(self.complete.is_set(), f"Reached end of routine ({self.image_count}/{self.int_times_seconds.size} images)")
+                    tick_done(self.complete.is_set(), f"Reached end of routine ({self.image_count}/{len(self.plan)} images)")
                 else:
                     self.capture_queue.put(next_param_set)
-                self.params_queue.task_done()
                 return self.complete.is_set()
             
 
@@ -320,6 +797,56 @@ class Routine:
     
 
     
+    def _next_param_set(self) -> dict|None:
+        """Settings of the next capture in the plan, or None at the end of the plan."""
+        settings = self.plan.next()
+        if settings is None:
+            return None
+        integration_time, gain, repeat_index = settings
+        return {'integration_time': integration_time, 'gain': gain, 'repeat': repeat_index}
+
+    def _peek_param_set(self) -> dict|None:
+        """Settings of the next capture in the plan without moving on, or None at the end of the plan or if stopping."""
+        if self.stop_signal.is_set() or self.bracket_mode:
+            return None
+        #A capture already queued (e.g. in capture_start interval mode) is next, otherwise the next one in the plan
+        with self.capture_queue.mutex:
+            queued = list(self.capture_queue.queue)
+        if len(queued) > 0:
+            return queued[0] if isinstance(queued[0], dict) else None
+        if self.plan.position >= len(self.plan):
+            return None
+        integration_time, gain, repeat_index = self.plan[self.plan.position]
+        return {'integration_time': integration_time, 'gain': gain, 'repeat': repeat_index}
+
+    def resume(self, index:int):
+        """Start (or continue) the routine from a capture part way through the plan, e.g. after a restart.
+        Must be called before the routine starts.
+
+        Args:
+            index (int): Index in the plan of the next capture (the number of captures already taken)
+        """
+        if self.start_time is not None:
+            raise RuntimeError("Cannot resume a routine which has already started")
+        index = max(0, min(int(index), len(self.plan)))
+        self.plan.seek(index)
+        self.image_count = index
+        self.progress = index
+        self.capture_progress = index
+        logger.info(f"Resuming routine {self.name} from capture {index}/{len(self.plan)}")
+
+    @property
+    def position(self) -> int:
+        """Index in the plan of the next capture to be queued."""
+        return self.plan.position
+
+    @property
+    def finished(self) -> bool:
+        """Whether the routine ran to its end (its plan, number limit or time limit) rather than being stopped."""
+        return (self.image_count >= len(self.plan)
+                or (self.number_limit is not None and self.image_count >= self.number_limit)
+                or (self.time_limit_secs is not None and self.run_time >= self.time_limit_secs))
+
     def _create_settings_matrix(integration_times, gains, all_combinations, number_limit, loop_integration_time, loop_gain):
         integration_times = np.array(integration_times)
         gains = np.array(gains)
@@ -375,6 +902,190 @@ class Routine:
         return settings
 
 
+    @staticmethod
+    def _optimise_settings_matrix(settings:np.ndarray, long_exposure_threshold_secs:float) -> np.ndarray:
+        """Reorder one iteration of a settings matrix to minimise sensor mode switches and large integration time jumps.
+        Auto-exposure captures (integration time of 0) come first in their original order, followed by the captures which
+        fit in the DEFAULT sensor mode and then the LONG_EXPOSURE captures, each sorted by integration time then gain.
+        Integration time and gain pairs are kept together. The plan runs every other repeat of the captures after the
+        auto-exposure captures in reverse (see CapturePlan), so auto-exposure captures come first in every repeat.
+
+        Args:
+            settings (np.ndarray): Settings matrix as created by _create_settings_matrix
+            long_exposure_threshold_secs (float): Longest integration time available in the DEFAULT sensor mode
+
+        Returns:
+            np.ndarray: Reordered settings matrix
+        """
+        int_times, gains = settings[0,:], settings[1,:]
+        auto = int_times == 0
+        long_exposure = np.logical_and(np.logical_not(auto), int_times > long_exposure_threshold_secs)
+        default = np.logical_not(np.logical_or(auto, long_exposure))
+        
+        order = [np.flatnonzero(auto)]
+        for group in [default, long_exposure]:
+            indices = np.flatnonzero(group)
+            order.append(indices[np.lexsort((gains[indices], int_times[indices]))])
+        
+        return settings[:, np.concatenate(order)]
+
+
+class CapturePlan:
+    """Lazy, seekable sequence of the settings of each capture in a routine.
+
+    Only one iteration of settings is stored, and the settings of a capture are worked out from its index, so memory
+    use is the same however long the routine is. The plan can be started from any index (see seek).
+    Each item is a tuple of (integration time, gain, repeat index).
+    """
+
+    def __init__(self, settings:np.ndarray, iteration_length:int=None, repeat:int=1, length:int=None, serpentine:bool=False) -> None:
+        """
+        Args:
+            settings (np.ndarray): One iteration of settings as created by Routine._create_settings_matrix
+            iteration_length (int, optional): Captures per iteration. The settings are looped if this is longer than
+                                            the settings. Defaults to the number of settings.
+            repeat (int, optional): Number of iterations. 0 repeats until length is reached. Defaults to 1.
+            length (int, optional): Maximum number of captures. Defaults to None (no limit other than repeat).
+            serpentine (bool, optional): Run every other iteration in reverse, apart from any auto-exposure captures
+                at its start, which stay first. Defaults to False.
+        """
+        self.settings:np.ndarray = np.asarray(settings)
+        self.iteration_length:int = int(iteration_length) if iteration_length is not None else self.settings.shape[1]
+        self.repeat:int = max(0, int(repeat))
+        self.serpentine:bool = serpentine
+        #Auto-exposure captures at the start of each iteration, which are not reversed
+        self._leading_auto:int = 0
+        if serpentine and self.iteration_length == self.settings.shape[1]:
+            self._leading_auto = int(np.argmax(self.settings[0] != 0)) if np.any(self.settings[0] != 0) else self.iteration_length
+
+        lengths = [value for value in [length, self.iteration_length*self.repeat if self.repeat > 0 else None] if value is not None]
+        if len(lengths) == 0:
+            raise ValueError("A capture plan needs a repeat or a length")
+        self.length:int = int(min(lengths))
+        self.position:int = 0
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index:int) -> tuple[float, float, int]:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError(f"Capture {index} is outside the plan of {self.length} captures")
+        repeat_index, column = divmod(index, self.iteration_length)
+        column = int(self._columns(repeat_index, column)) % self.settings.shape[1]
+        return float(self.settings[0, column]), float(self.settings[1, column]), repeat_index
+
+    def __iter__(self):
+        while (settings := self.next()) is not None:
+            yield settings
+
+    def next(self) -> tuple[float, float, int]|None:
+        """Settings of the capture at the current position, and move on to the next.
+
+        Returns:
+            tuple[float, float, int]|None: (integration time, gain, repeat index), or None at the end of the plan
+        """
+        if self.position >= self.length:
+            return None
+        settings = self[self.position]
+        self.position += 1
+        return settings
+
+    def seek(self, index:int):
+        """Set the index of the next capture."""
+        self.position = max(0, min(int(index), self.length))
+
+    @property
+    def iterations(self) -> int:
+        """Number of iterations started over the whole plan."""
+        return -(-self.length // self.iteration_length)
+
+    def head(self, n:int) -> tuple[np.ndarray, np.ndarray]:
+        """Integration times and gains of the first n captures."""
+        settings = [self[index] for index in range(min(n, self.length))]
+        return np.array([s[0] for s in settings]), np.array([s[1] for s in settings])
+
+    def _iteration(self, repeat_index:int, length:int=None) -> tuple[np.ndarray, np.ndarray]:
+        """Integration times and gains of one iteration (or its first [length] captures)."""
+        columns = self._columns(repeat_index, np.arange(self.iteration_length if length is None else length))
+        columns %= self.settings.shape[1]
+        return self.settings[0, columns], self.settings[1, columns]
+
+    def _columns(self, repeat_index:int, columns:int|np.ndarray) -> int|np.ndarray:
+        """Columns of the settings captured at positions in an iteration - reversed after the leading auto-exposure
+        captures in every other iteration when serpentine."""
+        if not (self.serpentine and repeat_index % 2 == 1):
+            return columns
+        return np.where(columns < self._leading_auto, columns, self.iteration_length - 1 - (columns - self._leading_auto))
+
+    def total(self, function:callable) -> float:
+        """Sum a function of the integration times and gains of each iteration over the whole plan, without
+        generating the plan. Iterations are all the same (or alternate when serpentine) so each distinct
+        iteration is only evaluated once.
+
+        Args:
+            function (callable): function(integration_times, gains) of one iteration, summed over iterations
+
+        Returns:
+            float: Total over the plan
+        """
+        full, partial = divmod(self.length, self.iteration_length)
+        forward = function(*self._iteration(0))
+        total = (full - full//2) * forward
+        if full // 2 > 0:
+            total += (full//2) * (function(*self._iteration(1)) if self.serpentine else forward)
+        if partial > 0:
+            total += function(*self._iteration(full, partial))
+        return total
+
+    def count_mode_switches(self, long_exposure_threshold_secs:float) -> int:
+        """Count the sensor mode switches needed to capture the plan (see count_mode_switches).
+
+        Args:
+            long_exposure_threshold_secs (float): Longest integration time available in the DEFAULT sensor mode
+
+        Returns:
+            int: Number of sensor mode switches
+        """
+        full, partial = divmod(self.length, self.iteration_length)
+        cache = {}
+        def iteration_switches(repeat_index:int, length:int, last_mode:int|None) -> tuple[int, int|None]:
+            key = (self.serpentine and repeat_index % 2 == 1, length, last_mode)
+            if key not in cache:
+                int_times, _ = self._iteration(repeat_index, length)
+                modes = (int_times[int_times != 0] > long_exposure_threshold_secs).astype(np.int8)
+                if modes.size == 0:
+                    cache[key] = (0, last_mode)
+                else:
+                    switches = int(np.count_nonzero(np.diff(modes))) + int(last_mode is not None and modes[0] != last_mode)
+                    cache[key] = (switches, int(modes[-1]))
+            return cache[key]
+
+        switches, last_mode = 0, None
+        for repeat_index in range(full):
+            iteration, last_mode = iteration_switches(repeat_index, self.iteration_length, last_mode)
+            switches += iteration
+        if partial > 0:
+            switches += iteration_switches(full, partial, last_mode)[0]
+        return switches
+
+
+def count_mode_switches(int_times_seconds:np.ndarray, long_exposure_threshold_secs:float) -> int:
+    """Count the sensor mode switches needed to capture a sequence of integration times.
+    Auto-exposure captures (integration time of 0) are assumed to stay in the current mode.
+
+    Args:
+        int_times_seconds (np.ndarray): Sequence of integration times in seconds
+        long_exposure_threshold_secs (float): Longest integration time available in the DEFAULT sensor mode
+
+    Returns:
+        int: Number of sensor mode switches
+    """
+    int_times_seconds = np.asarray(int_times_seconds)
+    modes = (int_times_seconds[int_times_seconds != 0] > long_exposure_threshold_secs).astype(np.int8)
+    return int(np.count_nonzero(np.diff(modes)))
+
     
 def convert(val:str)-> float|str|bool: #try to convert value to the correct datatype
     val = val.strip()
@@ -460,9 +1171,19 @@ def convert_to_seconds(value:int|float, unit:str)->float:
         result =value*multiplier
     return result
 
-def from_dict(params:dict, capture_function:callable=Routine.placeholder_capture) -> Routine:
-    
+def resolve_params(params:dict) -> tuple[dict, list[str]]:
+    """Check the parameters of a routine definition and convert its times to seconds, without building the routine
+    (and its plan of settings).
+
+    Args:
+        params (dict): Parameters as parsed from a routine file (see parse_file)
+
+    Returns:
+        tuple[dict, list[str]]: Keyword arguments for Routine, and a description of each problem found. Parameters with
+            problems are left out, so the routine can still be built with its defaults.
+    """
     valid_params = {}
+    problems = []
 
     units = {"default_time_unit":"s",
              "time_limit_unit":None, 
@@ -470,33 +1191,49 @@ def from_dict(params:dict, capture_function:callable=Routine.placeholder_capture
              "interval_time_unit":None,
              "repeat_interval_time_unit":None,
              "integration_time_unit":None,
-             "min_tick_length_unit":None}
+             "min_tick_length_unit":None,
+             "long_exposure_threshold_unit":None,
+             "depth_fallback_interval_unit":None,
+             "adaptive_min_interval_unit":None,
+             "adaptive_max_interval_unit":None,
+             "unchanged_store_interval_unit":None}
     
     times = {"time_limit":None,
              "initial_delay_time":None,
              "repeat_interval_time":None,
              "interval_time":None,
              "integration_time":None,
-             "min_tick_length":None}
+             "min_tick_length":None,
+             "long_exposure_threshold":None,
+             "depth_fallback_interval":None,
+             "adaptive_min_interval":None,
+             "adaptive_max_interval":None,
+             "unchanged_store_interval":None}
     for key, value in params.items():
         
-        valid=key in ACCEPTED_PARAMS and isinstance(value, ACCEPTED_PARAMS[key])
-        if valid:
-            if key in valid_params: #If the parameter is already set, notify and update
-                #Create short string representing value to print if value is longer than 10 chars
-                val_string =  (str(value[:7]) + '...') if len(str[value]) > 10 else str[value]
+        if key in ACCEPTED_PARAMS:
+            if isinstance(value, ACCEPTED_PARAMS[key]):
                 valid_params[key] = value
             else:
-                valid_params.update([(key, value)])
+                problems.append(f"{key}: {value!r} is not a valid value")
             continue
         
         #Find parameters for setting times and time units
         match key: 
             case unit_param if unit_param in units:
-                units[key] = value
+                if not isinstance(value, str) or value.lower() not in TIME_UNITS:
+                    problems.append(f"{key}: {value!r} is not a recognised time unit, using seconds")
+                units[key] = value if isinstance(value, str) else "s"
             case time_param if time_param in times:
+                if not isinstance(value, (float, int, list)) or isinstance(value, bool) or (isinstance(value, list) and not all(isinstance(item, (float, int)) for item in value)):
+                    problems.append(f"{key}: {value!r} is not a number or list of numbers")
+                    continue
                 times[key] = value
+            case _:
+                problems.append(f"{key}: not a recognised parameter")
     
+    if "name" not in valid_params:
+        problems.append("name: missing")
 
     for param, value in times.items(): #convert any time parameters to seconds
         if value is not None:          #by getting the unit it is currently in
@@ -507,25 +1244,153 @@ def from_dict(params:dict, capture_function:callable=Routine.placeholder_capture
             time_in_secs = convert_to_seconds(value, unit)
             valid_params.update([(f"{param}_secs", time_in_secs)])
             
-    return Routine(capture_function=capture_function, **valid_params)
+    return valid_params, problems
+
+def from_dict(params:dict, capture_function:callable=Routine.placeholder_capture, bracket_function:callable=Routine.placeholder_bracket) -> Routine:
+    valid_params, problems = resolve_params(params)
+    for problem in problems:
+        logger.warning(f"Routine {valid_params.get('name', '')}: {problem}")
+    return Routine(capture_function=capture_function, bracket_function=bracket_function, **valid_params)
+
+def parse_file(file_path:str|Path) -> dict:
+    """Parse the parameters of a routine file (one 'parameter: value' per line) without checking them."""
+    with open(file_path, mode="r") as file:
+        lines = file.readlines()
     
+    params = {}
+    for line in lines:
+        parsed_line = parse_line(line)
+        if parsed_line is not None:
+            params.update([parsed_line])
+    return params
         
-        
-def from_file(file_path:str|Path, capture_function:callable=Routine.placeholder_capture) -> Routine:
-            lines = []
-            with open(file_path, mode="r") as file:
-                   lines = file.readlines()  
-                   
-            
-            params = {}
-            for line in lines:
-                parsed_line = parse_line(line)
-                if parsed_line is not None:
-                    params.update([parsed_line])
-                
-            return from_dict(params, capture_function=capture_function)
-                
+def from_file(file_path:str|Path, capture_function:callable=Routine.placeholder_capture, bracket_function:callable=Routine.placeholder_bracket) -> Routine:
+    return from_dict(parse_file(file_path), capture_function=capture_function, bracket_function=bracket_function)
 
-        
-        
 
+class RoutineIndex:
+    """Index of the routine files in a directory by routine name, so a routine can be found without building every
+    routine in the directory.
+
+    Each file's parsed and checked parameters are cached in [INDEX_FILENAME] in the directory, with the file's
+    modification time and size. Only files which have changed since the index was last saved are parsed again, and
+    only the selected routine is built.
+    """
+
+    def __init__(self, routine_dir:str|Path, cache_path:str|Path=None) -> None:
+        """
+        Args:
+            routine_dir (str|Path): Directory of routine files
+            cache_path (str|Path, optional): File the index is cached in. Defaults to [INDEX_FILENAME] in routine_dir.
+        """
+        self.routine_dir = Path(routine_dir)
+        self.cache_path = Path(cache_path) if cache_path is not None else self.routine_dir / INDEX_FILENAME
+        #Index entry of each routine file by file name
+        self.entries:dict[str, dict] = {}
+        self._load_cache()
+
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, "r") as file:
+                cache = json.load(file)
+            if cache.get("version") == INDEX_VERSION:
+                self.entries = cache["entries"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Could not read routine index {self.cache_path} - rebuilding it ({e})")
+
+    def _save_cache(self):
+        #Written to a temporary file and renamed, so a failed save leaves the previous index rather than a truncated one.
+        #Values JSON can't hold (e.g. YAML dates in a routine's metadata) are saved as strings.
+        temporary_path = self.cache_path.with_suffix(".tmp")
+        try:
+            cache = json.dumps({"version": INDEX_VERSION, "entries": self.entries}, default=str)
+            with open(temporary_path, "w") as file:
+                file.write(cache)
+            os.replace(temporary_path, self.cache_path)
+        except Exception as e:
+            logger.warning(f"Could not save routine index {self.cache_path} ({e})")
+            temporary_path.unlink(missing_ok=True)
+
+    @staticmethod
+    def index_file(file_path:Path) -> dict:
+        """Parse and check a routine file into an index entry."""
+        stat = file_path.stat()
+        entry = {"mtime_ns": stat.st_mtime_ns, "size": stat.st_size}
+        try:
+            params = parse_file(file_path)
+            valid_params, problems = resolve_params(params)
+            entry.update({"name": None if "name" not in valid_params else str(valid_params["name"]), "params": params, "problems": problems})
+        except Exception as e:
+            entry.update({"name": None, "params": None, "problems": [f"Could not parse file: {e}"]})
+        return entry
+
+    def refresh(self) -> "RoutineIndex":
+        """Update the index with any routine files which have been added, changed or removed."""
+        changed = False
+        filenames = set()
+        if self.routine_dir.is_dir():
+            for file_path in sorted(self.routine_dir.iterdir()):
+                if file_path.suffix.lower().lstrip(".") not in ROUTINE_EXTENSIONS or not file_path.is_file():
+                    continue
+                filenames.add(file_path.name)
+                entry = self.entries.get(file_path.name)
+                stat = file_path.stat()
+                if entry is not None and entry["mtime_ns"] == stat.st_mtime_ns and entry["size"] == stat.st_size:
+                    continue
+                self.entries[file_path.name] = RoutineIndex.index_file(file_path)
+                changed = True
+        for filename in list(self.entries):
+            if filename not in filenames:
+                del self.entries[filename]
+                changed = True
+        if changed:
+            self._save_cache()
+        return self
+
+    @property
+    def names(self) -> list[str]:
+        """Names of the indexed routines."""
+        return [entry["name"] for entry in self.entries.values() if entry["name"] is not None]
+
+    def find(self, name:str) -> tuple[Path, dict]|tuple[None, None]:
+        """Find a routine file by file name, file name without extension or routine name (spaces and underscores match).
+
+        Args:
+            name (str): File or routine name
+
+        Returns:
+            tuple[Path, dict]: Path of the routine file and its index entry, or (None, None) if there is no match
+        """
+        name_no_spaces = name.replace(" ", "_")
+        for filename in sorted(self.entries):
+            entry = self.entries[filename]
+            if filename == name or filename.rsplit(".", 1)[0] == name or \
+               (entry["name"] is not None and entry["name"].replace(" ", "_") == name_no_spaces):
+                return self.routine_dir / filename, entry
+        return None, None
+
+    def load(self, name:str, capture_function:callable=Routine.placeholder_capture, bracket_function:callable=Routine.placeholder_bracket) -> Routine:
+        """Build a routine from a file path, or by file or routine name from the index. Problems found in the routine's
+        parameters are logged as warnings.
+
+        Args:
+            name (str): Path of a routine file, or file or routine name of a routine in the routine directory
+            capture_function (callable, optional): Function called to capture an image. Defaults to Routine.placeholder_capture.
+            bracket_function (callable, optional): Function called to capture a bracket. Defaults to Routine.placeholder_bracket.
+
+        Returns:
+            Routine: The routine, or None if no routine matches or the routine file has no name
+        """
+        if Path(name).is_file():
+            return from_file(name, capture_function=capture_function, bracket_function=bracket_function)
+        file_path, entry = self.refresh().find(name)
+        if file_path is None:
+            return None
+        for problem in entry["problems"]:
+            logger.warning(f"Routine file {file_path}: {problem}")
+        if entry["params"] is None or entry["name"] is None:
+            return None
+        valid_params, _ = resolve_params(entry["params"])
+        return Routine(capture_function=capture_function, bracket_function=bracket_function, **valid_params)
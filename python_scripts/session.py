@@ -3,26 +3,22 @@ from pathlib import Path
 import json
 import cam_image
 import sys, os
-from dotenv import load_dotenv
 import traceback
 import threading, queue
 import logging
 from datetime import datetime
 import yam
+from timing import PhaseTimer
+import config
 
 
 logger = logging.getLogger()
 
-#Load environment variables
-dot_env_path = Path(__file__).parent.parent / ".env"
-load_dotenv(dotenv_path=dot_env_path)
-
-DATA_DIR =  Path(os.environ.get("DATA_DIRECTORY"))
 PRETTY_FORMAT = "%Y-%m-%d %H:%M:%S"
 FILEPATH_FORMAT = "%Y_%m_%d__%H_%M_%S"
 class Session:
     
-    def __init__(self, name:str|None=None, start_time:datetime|None = None, directory:str|None=None, images:dict=None, log_queue:queue.Queue=None) -> None:
+    def __init__(self, name:str|None=None, start_time:datetime|None = None, directory:str|None=None, images:dict=None, log_queue:queue.Queue=None, routine_progress:dict=None) -> None:
         try:
             
             if start_time is None:
@@ -41,13 +37,15 @@ class Session:
 
                 
             if directory is None:
-                self.parent_directory :Path =DATA_DIR / "sessions"
+                self.parent_directory :Path =config.data_directory() / "sessions"
             else:
                 self.parent_directory :Path = Path(directory)
                 
             self.directory = self.parent_directory / self.name_no_spaces
             self.image_directory = self.directory / "images"
             self.csv_file_path = self.directory / "data.csv"
+            self.metering_file_path = self.directory / "metering.csv"
+            self.timings_file_path = self.directory / "timings.json"
             self.json_file_path = self.directory / "session.json"
             self.info_file = self.directory / "info.yml"
             self.output_file_path = self.directory / "output.log"
@@ -58,6 +56,14 @@ class Session:
             self.queue_shutdown = threading.Event()
             self.finished_processing = threading.Event()
             self.images:list[dict]=[]
+            #Compact records of auto exposure metering frames which are not stored as images
+            self.metering_records:list[dict]=[]
+            self.metering_lock = threading.Lock()
+            #Durations of saving each image (replaced by the routine's timer while a routine runs)
+            self.timer = PhaseTimer(self.name)
+            #Number of captures of each routine's plan whose images have been saved in this session, so a routine can
+            #resume after a restart (see add_image_to_queue)
+            self.routine_progress:dict[str, int] = dict(routine_progress) if routine_progress is not None else {}
             
             if images is None:
                 self.last_updated = self.start_time
@@ -129,8 +135,14 @@ class Session:
         if self.images is not None:
             return len(self.images)
     
-    def add_image_to_queue(self, image:cam_image.Cam_Image|None):
-        
+    def add_image_to_queue(self, image:cam_image.Cam_Image|None, routine_progress:tuple[str, int]=None):
+        """Queue an image to be saved by the processing thread, or None to stop the thread once the queue is empty.
+
+        Args:
+            image (cam_image.Cam_Image | None): Image to save
+            routine_progress (tuple[str, int], optional): Routine name and the number of captures of its plan completed
+                by the capture of the image. Recorded in routine_progress once the image is saved. Defaults to None.
+        """
         if image is None:
             logger.info("Adding sentinel value to processing queue")
         else:
@@ -138,9 +150,19 @@ class Session:
         if self.queue_shutdown.is_set():
             logger.error("Processing queue is closed. Item not added.")
         else:
-            self.image_queue.put(image)
+            self.image_queue.put(None if image is None else (image, routine_progress))
         logger.info(f"Processing queue length: {self.queue_length}")
             
+    def add_metering_record(self, record:dict):
+        """Add a compact record of a metering frame. Metering frames are not saved as images,
+        the records are written to metering.csv by the processing thread.
+
+        Args:
+            record (dict): Metering frame details
+        """
+        with self.metering_lock:
+            self.metering_records.append(record)
+            
     def start_processing_queue(self):
         logger.info("Starting processing queue")
         process_thread = threading.Thread(target=self.process_image_queue)
@@ -160,17 +182,29 @@ class Session:
         self.finished_processing.wait()
         logging.info("Finished processing last image")
     
+    def close_log(self):
+        """Write the remaining log records to the output log and stop logging to it, e.g. before the daemon runs the next routine."""
+        self.logging_queue_listener.stop()
+        for handler in self.logging_queue_listener.handlers:
+            handler.close()
+
     def process_image_queue(self) -> bool:
         while True:
-            image = self.image_queue.get()
+            item = self.image_queue.get()
             
-            if image is None:
+            if item is None:
 
                 logging.info("Processing queue: Sentinel value received")
+                try:
+                    self.write_metering_records()
+                except Exception as e:
+                    logger.error("Couldn't write metering records")
+                    logger.exception(e, stack_info=True)
                 self.image_queue.task_done()
                 if not self.image_queue.empty():
                     logging.error("Processing queue: Sentinel value received but queue is not empty")
                 break
+            image, routine_progress = item
             try:
                 image = self.add_image(image)
                 logger.info(f"Processing image {image.number} - Queue size {self.queue_length}")
@@ -191,9 +225,15 @@ class Session:
                                             
             
             try:        
-                image_location = self.image_directory/ f"{self.name_no_spaces}_{str(image.number).rjust(3, '0')}.png"
+                camera_suffix = f"_{image.camera_id}" if image.camera_id is not None else ""
+                image_location = self.image_directory/ f"{self.name_no_spaces}_{str(image.number).rjust(3, '0')}{camera_suffix}.png"
                 
-                image.save(image_location, additional_metadata={"session" : self.name})
+                with self.timer.phase("save_image"):
+                    saved = image.save(image_location, additional_metadata={"session" : self.name})
+                #Saved with the session log below, so a restarted routine resumes after the last saved image
+                if saved and routine_progress is not None:
+                    routine_name, progress = routine_progress
+                    self.routine_progress[routine_name] = progress
             except Exception as e:
                 logger.error(f"Couldn't save image {self.image_count-1}")
                 logger.exception(e, stack_info=True)
@@ -214,6 +254,11 @@ class Session:
                 # self.output(traceback.format_exception(e), error=True)
                 logger.error(f"Couldn't add image details to csv")
                 logger.exception(e, stack_info=True)                
+            try:
+                self.write_metering_records()
+            except Exception as e:
+                logger.error("Couldn't write metering records")
+                logger.exception(e, stack_info=True)
             logging.info(f"Finished processing image {image.number} - Queue size {self.queue_length}")
             self.image_queue.task_done()   
 
@@ -223,6 +268,7 @@ class Session:
 
     def write_to_log(self) -> bool:
             log = self.details
+            log["routine_progress"] = dict(self.routine_progress)
             log["images"] = self.images
             return write_json(log, self.json_file_path)
 
@@ -233,6 +279,18 @@ class Session:
                 csv_file.write(",".join([str(value) for value in list(image.info.values())]) + "\n")
         
 
+    def write_metering_records(self):
+        with self.metering_lock:
+            records = self.metering_records
+            self.metering_records = []
+        if len(records) == 0:
+            return
+        with open(self.metering_file_path, "a") as csv_file:
+            if csv_file.tell() == 0:
+                csv_file.write(",".join(list(records[0].keys())) + "\n")
+            for record in records:
+                csv_file.write(",".join([str(value) for value in list(record.values())]) + "\n")
+
     def update_session_list(self):
         session_list = {}
         if self.session_list_file.exists():
@@ -304,12 +362,13 @@ def write_json(log:dict, filepath:Path) -> bool:
     return True
 
 
-def from_file(path:str|Path) -> Session:
+def from_file(path:str|Path, log_queue:queue.Queue=None) -> Session:
     """Open Session:
         Open a session from a log file
 
     Args:
         log_file (str): path to log session
+        log_queue (queue.Queue, optional): Log queue written to the session's output log
 
     Returns:
         Session: A session object with details matching those in log file
@@ -328,7 +387,7 @@ def from_file(path:str|Path) -> Session:
         start_time = datetime.strptime(session_dict["start_time"], "%Y-%m-%d %H:%M:%S")
 
         path = session_dict["path"]
-        session = Session(name=name, start_time=start_time, directory=path, images=session_dict['images'])
+        session = Session(name=name, start_time=start_time, directory=path, images=session_dict['images'], log_queue=log_queue, routine_progress=session_dict.get('routine_progress'))
         
         
         return session
@@ -0,0 +1,433 @@
+import argparse
+import json
+import logging
+import os
+import sys
+from datetime import timedelta
+from pathlib import Path
+import numpy as np
+
+import config
+import pixel_formats
+import routine
+from timing import fit_from_sums
+
+logger = logging.getLogger()
+
+#Latencies of a simulated camera, used for any phase which has not been recorded in a previous session.
+#Capture phases are (fixed seconds, seconds per second of integration time) - a capture waits for the current frame,
+#then at least one frame at the new integration time. The rest are mean seconds per occurrence.
+SIMULATED_CAMERA = {"capture_total": (0.25, 2.0),
+                    "auto_capture_total": (0.6, 6.0),
+                    "bracket_total": (0.3, 1.1),
+                    "sensor_mode_switch": routine.SENSOR_MODE_SWITCH_SECS,
+                    "hdr_fuse": 1.5,
+                    "save_image": 0.35}
+#Integration time accepted by auto exposure when no previous sessions are available, in seconds
+SIMULATED_AUTO_INTEGRATION_SECS = 0.05
+#Sensor size of the simulated camera, and the size of a saved PNG as a fraction of the raw image data
+SIMULATED_SENSOR_SIZE = (2456, 2054)
+PNG_COMPRESSION_RATIO = 0.6
+#Margin kept around the active area by region of interest capture profiles (device_interface.ROI_MARGIN)
+SIMULATED_ROI_MARGIN = 200
+#Bytes of session metadata (session.json, data.csv) per image
+SIMULATED_METADATA_BYTES = 1500
+
+
+class LatencyModel:
+    """Model of the time taken by each stage of a capture, calibrated from the timings recorded in previous sessions
+    (timings.json) or taken from a simulated camera.
+    """
+
+    def __init__(self, fits:dict=None, means:dict=None, auto_integration_secs:float=None, image_bytes:float=None, metadata_bytes:float=None, sources:list[str]=None) -> None:
+        """
+        Args:
+            fits (dict, optional): {phase: (intercept seconds, seconds per second of integration time)} of the capture phases. Defaults to None.
+            means (dict, optional): {phase: mean seconds} of the other phases. Defaults to None.
+            auto_integration_secs (float, optional): Mean integration time accepted by auto exposure. Defaults to None.
+            image_bytes (float, optional): Mean size of a saved image. Defaults to None (estimated from the routine).
+            metadata_bytes (float, optional): Mean session metadata per image. Defaults to None.
+            sources (list[str], optional): Sessions the model was calibrated from. Defaults to None.
+        """
+        self.fits:dict = fits if fits is not None else {}
+        self.means:dict = means if means is not None else {}
+        self.auto_integration_secs:float = auto_integration_secs
+        self.image_bytes:float = image_bytes
+        self.metadata_bytes:float = metadata_bytes
+        self.sources:list[str] = sources if sources is not None else []
+
+    def calibrated(self, phase:str) -> bool:
+        """Whether a phase was calibrated from recorded timings rather than the simulated camera."""
+        return phase in self.fits or phase in self.means
+
+    def capture_secs(self, phase:str, integration_secs:float) -> float:
+        """Predicted duration of a capture phase (capture_total, auto_capture_total or bracket_total).
+
+        Args:
+            phase (str): Phase name
+            integration_secs (float): Integration time (or total integration time of a bracket) in seconds
+
+        Returns:
+            float: Duration in seconds
+        """
+        intercept, slope = self.fits.get(phase, SIMULATED_CAMERA[phase])
+        return max(0.0, intercept) + max(0.0, slope) * integration_secs
+
+    def mean_secs(self, phase:str) -> float:
+        """Predicted duration of one occurrence of a phase, in seconds."""
+        return self.means.get(phase, SIMULATED_CAMERA.get(phase, 0.0))
+
+    def auto_integration(self) -> float:
+        """Integration time predicted for an auto-adjust capture, in seconds."""
+        return self.auto_integration_secs if self.auto_integration_secs is not None else SIMULATED_AUTO_INTEGRATION_SECS
+
+    def image_size(self, current_routine:routine.Routine, cameras:int=1) -> float:
+        """Predicted bytes stored per routine image, for all cameras, including session metadata.
+
+        Args:
+            current_routine (routine.Routine): Routine being simulated (for its bit depth and capture profile if not calibrated)
+            cameras (int, optional): Number of cameras capturing. Defaults to 1.
+
+        Returns:
+            float: Bytes per image
+        """
+        image_bytes = self.image_bytes
+        if image_bytes is None:
+            width, height = SIMULATED_SENSOR_SIZE
+            reduction = {"full": 1, "roi": 1, "binned": 4, "decimated": 4, "decimated_4": 16}.get(current_routine.capture_profile, 1)
+            pixels = width * height / reduction
+            if current_routine.capture_profile != "full":
+                #Imported here as cam_image imports PIL, which the rest of the simulation doesn't need
+                from cam_image import ACTIVE_AREA_RADIUS
+                #Cropped to the bounding box of the active area plus a margin
+                pixels = min(pixels, (2 * (ACTIVE_AREA_RADIUS + SIMULATED_ROI_MARGIN))**2 / reduction)
+            #Debayered RGB images are saved at half resolution, raw images at 1 or 2 bytes per pixel
+            if current_routine.storage_format == pixel_formats.RGB_STORAGE:
+                bytes_per_pixel = 0.75
+            else:
+                bytes_per_pixel = 2 if current_routine.bit_depth > 8 else 1
+            image_bytes = pixels * bytes_per_pixel * PNG_COMPRESSION_RATIO
+        metadata_bytes = self.metadata_bytes if self.metadata_bytes is not None else SIMULATED_METADATA_BYTES
+        return (image_bytes + metadata_bytes) * cameras
+
+    @classmethod
+    def from_sessions(cls, session_directories:list[str|Path]) -> "LatencyModel":
+        """Calibrate a model from the timings and saved images of previous sessions. Phases recorded in several
+        sessions are combined, weighted by the number of occurrences.
+
+        Args:
+            session_directories (list[str | Path]): Session directories (containing timings.json)
+
+        Returns:
+            LatencyModel: Calibrated model. Phases which were not recorded use the simulated camera.
+        """
+        fit_sums:dict[str, np.ndarray] = {}
+        mean_sums:dict[str, list[float]] = {}
+        image_sizes = []
+        metadata_sizes = []
+        sources = []
+        for directory in session_directories:
+            directory = Path(directory)
+            timings_file = directory / "timings.json"
+            if not timings_file.exists():
+                continue
+            try:
+                with open(timings_file, "r") as file:
+                    records = json.load(file)
+            except Exception as e:
+                logger.warning(f"Could not read timings from {timings_file}")
+                continue
+            sources.append(directory.name)
+            for record in records:
+                for name, phase in record.get("phases", {}).items():
+                    if "fit" in phase:
+                        fit_sums[name] = fit_sums.get(name, np.zeros(5)) + np.array(phase["fit"]["sums"])
+                    totals = mean_sums.setdefault(name, [0, 0.0])
+                    totals[0] += phase["count"]
+                    totals[1] += phase["total_secs"]
+
+            images = list((directory / "images").glob("*.png"))
+            if len(images) > 0:
+                image_sizes.extend([image.stat().st_size for image in images])
+                metadata = sum([(directory / name).stat().st_size for name in ["session.json", "data.csv"] if (directory / name).exists()])
+                metadata_sizes.append(metadata / len(images))
+
+        fits = {name: fit_from_sums(*sums) for name, sums in fit_sums.items() if sums[0] > 0}
+        means = {name: total / count for name, (count, total) in mean_sums.items() if count > 0 and name not in fits}
+        auto = fit_sums.get("auto_capture_total")
+        auto_integration_secs = auto[1] / auto[0] if auto is not None and auto[0] > 0 else None
+        return cls(fits=fits,
+                   means=means,
+                   auto_integration_secs=auto_integration_secs,
+                   image_bytes=float(np.mean(image_sizes)) if len(image_sizes) > 0 else None,
+                   metadata_bytes=float(np.mean(metadata_sizes)) if len(metadata_sizes) > 0 else None,
+                   sources=sources)
+
+
+class Prediction:
+    """Predicted timeline of a routine."""
+
+    def __init__(self, timeline:list[dict], total_secs:float, capture_end_secs:float, save_backlog_secs:float, images:int, storage_bytes:float, stages:dict[str, float], stop_reason:str, warnings:list[str]=None) -> None:
+        self.timeline:list[dict] = timeline
+        self.total_secs:float = total_secs
+        self.capture_end_secs:float = capture_end_secs
+        #Time saving continues after the last capture, beyond saving that capture's own images
+        self.save_backlog_secs:float = save_backlog_secs
+        self.images:int = images
+        self.storage_bytes:float = storage_bytes
+        self.stages:dict[str, float] = stages
+        self.stop_reason:str = stop_reason
+        #Behaviour of the routine the simulation can't model, which makes the prediction unreliable
+        self.warnings:list[str] = warnings if warnings is not None else []
+
+    @property
+    def reliable(self) -> bool:
+        return len(self.warnings) == 0
+
+    @property
+    def bottleneck(self) -> str:
+        """Stage which takes the most time. Saving is the bottleneck if images are saved slower than they are captured."""
+        if self.save_backlog_secs > 1e-6:
+            return "save_image"
+        busy = {stage: secs for stage, secs in self.stages.items() if stage not in ["save_image"]}
+        return max(busy, key=busy.get) if len(busy) > 0 else None
+
+    def as_dict(self) -> dict:
+        return {"total_secs": self.total_secs,
+                "capture_end_secs": self.capture_end_secs,
+                "save_backlog_secs": self.save_backlog_secs,
+                "images": self.images,
+                "storage_bytes": self.storage_bytes,
+                "stages": self.stages,
+                "bottleneck": self.bottleneck,
+                "stop_reason": self.stop_reason,
+                "reliable": self.reliable,
+                "warnings": self.warnings,
+                "timeline": self.timeline}
+
+    def __str__(self):
+        string = ""
+        for warning in self.warnings:
+            string += f"Warning: {warning}\n"
+        string += f"Predicted duration: {str(timedelta(seconds=int(round(self.total_secs))))} ({self.total_secs:.1f}s)"
+        string += f"\nImages: {self.images}"
+        string += f"\nStorage: {self.storage_bytes/1e6:.1f} MB"
+        string += f"\nEnds by: {self.stop_reason}"
+        string += f"\nBottleneck: {self.bottleneck}"
+        string += "\nTime by stage:"
+        for stage, secs in sorted(self.stages.items(), key=lambda item: -item[1]):
+            string += f"\n  {stage.ljust(22)} {secs:10.1f}s"
+        return string
+
+
+def unmodelled_behaviour(current_routine:routine.Routine) -> list[str]:
+    """Behaviour of a routine which depends on the dive or the scene, so can't be replayed by simulate.
+
+    Args:
+        current_routine (routine.Routine): Routine to check
+
+    Returns:
+        list[str]: Description of each behaviour found, empty if the prediction can be relied on
+    """
+    behaviour = []
+    if current_routine.trigger_mode == routine.DEPTH_TRIGGER:
+        behaviour.append("captures are triggered by depth, so the prediction assumes every capture is triggered as soon as it is due")
+    if current_routine.adaptive_cadence:
+        behaviour.append("adaptive cadence stretches the interval while the scene is unchanged, so the prediction uses the configured interval")
+    if current_routine.cadence is not None and current_routine.cadence.skip_unchanged:
+        behaviour.append("unchanged frames are not stored, so the prediction counts every frame as stored")
+    return behaviour
+
+
+def simulate(current_routine:routine.Routine, model:LatencyModel, cameras:int=1) -> Prediction:
+    """Replay a routine's capture plan against a latency model, following the same scheduling rules as
+    Routine.tick (interval modes, repeat intervals, number and time limits, bracket and HDR modes).
+
+    Captures run one after another on the capture thread while images are saved on the session thread, so the
+    routine finishes when both the last capture and the last save are done. Depth triggers, adaptive cadence and
+    skipping unchanged frames can't be replayed, so the prediction is marked unreliable for them (see unmodelled_behaviour).
+
+    Args:
+        current_routine (routine.Routine): Routine to simulate. Its plan is read without being moved on.
+        model (LatencyModel): Latency model
+        cameras (int, optional): Number of cameras capturing concurrently. Defaults to 1.
+
+    Returns:
+        Prediction: Predicted timeline
+    """
+    plan = current_routine.plan
+    threshold = current_routine.long_exposure_threshold_secs
+    stages = {"capture_overhead": 0.0, "exposure": 0.0, "auto_exposure": 0.0, "sensor_mode_switch": 0.0,
+              "hdr_fuse": 0.0, "interval_wait": 0.0, "save_image": 0.0}
+    timeline = []
+    image_size = model.image_size(current_routine, cameras)
+    save_secs = model.mean_secs("save_image") * cameras
+
+    mode = None
+    index = plan.position
+    images = 0
+    next_capture = current_routine.initial_delay
+    stages["interval_wait"] += current_routine.initial_delay
+    now = 0.0
+    save_end = 0.0
+    last_saved_images = 0
+    stop_reason = f"end of routine ({len(plan)} captures)"
+
+    def add_capture(start:float, duration:float, settings:list[tuple], saved_images:int, switches:int):
+        nonlocal save_end, images
+        timeline.append({"index": settings[0][3],
+                         "start_secs": start,
+                         "duration_secs": duration,
+                         "integration_times": [s[0] for s in settings],
+                         "gains": [s[1] for s in settings],
+                         "auto": [s[0] == 0 for s in settings],
+                         "mode_switches": switches})
+        for _ in range(saved_images):
+            save_end = max(save_end, start + duration) + save_secs
+            stages["save_image"] += save_secs
+        images += saved_images
+
+    while index < len(plan):
+        #The plan is already cut to the number limit
+        if current_routine.time_limit_secs is not None and max(now, next_capture) >= current_routine.time_limit_secs:
+            stop_reason = "time limit"
+            break
+
+        #Take one capture, or the rest of the iteration as a bracket
+        settings = [(*plan[index], index)]
+        index += 1
+        if current_routine.bracket_mode:
+            while index % current_routine.iteration_length != 0 and index < len(plan):
+                settings.append((*plan[index], index))
+                index += 1
+
+        start = max(now, next_capture)
+        stages["interval_wait"] += start - now
+        duration = 0.0
+        switches = 0
+        saved_images = 0
+
+        fixed = [s for s in settings if s[0] != 0]
+        auto = [s for s in settings if s[0] == 0]
+        for integration_time, _, _, _ in fixed:
+            this_mode = integration_time > threshold
+            if mode is not None and this_mode != mode:
+                switches += 1
+            mode = this_mode
+        #Recorded capture timings already include the mode switches made during them
+        capture_phase = "bracket_total" if current_routine.bracket_mode and len(fixed) > 0 else "capture_total"
+        if not model.calibrated(capture_phase):
+            switch_secs = switches * model.mean_secs("sensor_mode_switch")
+            stages["sensor_mode_switch"] += switch_secs
+            duration += switch_secs
+
+        if current_routine.bracket_mode and len(fixed) > 0:
+            integration = sum(s[0] for s in fixed)
+            bracket_secs = model.capture_secs("bracket_total", integration)
+            stages["exposure"] += min(bracket_secs, integration)
+            stages["capture_overhead"] += max(0.0, bracket_secs - integration)
+            duration += bracket_secs
+            saved_images += len(fixed)
+            if current_routine.hdr_mode and len(fixed) > 1:
+                fuse_secs = model.mean_secs("hdr_fuse")
+                stages["hdr_fuse"] += fuse_secs
+                duration += fuse_secs
+                saved_images = 1
+        else:
+            for integration_time, _, _, _ in fixed:
+                capture_secs = model.capture_secs("capture_total", integration_time)
+                stages["exposure"] += min(capture_secs, integration_time)
+                stages["capture_overhead"] += max(0.0, capture_secs - integration_time)
+                duration += capture_secs
+                saved_images += 1
+
+        for _ in auto:
+            integration_time = model.auto_integration()
+            capture_secs = model.capture_secs("auto_capture_total", integration_time)
+            if current_routine.hdr_mode and not model.calibrated("auto_capture_total"):
+                #The simulated auto capture does not include the HDR bracket
+                stops = [stop for stop in current_routine.hdr_stops if stop != 0]
+                capture_secs += model.capture_secs("bracket_total", sum(integration_time * 2**stop for stop in stops)) + model.mean_secs("hdr_fuse")
+            stages["exposure"] += min(capture_secs, integration_time)
+            stages["auto_exposure"] += max(0.0, capture_secs - integration_time)
+            duration += capture_secs
+            saved_images += 1
+
+        add_capture(start, duration, settings, saved_images, switches)
+        last_saved_images = saved_images
+        now = start + duration
+
+        #Next capture time, as set by Routine.capture_image / capture_bracket
+        interval = current_routine.repeat_interval_time_secs if index % current_routine.iteration_length == 0 else current_routine.interval_secs
+        next_capture = (start if current_routine.interval_mode == routine.CAPTURE_START else now) + interval
+
+    total_secs = max(now, save_end)
+    return Prediction(timeline=timeline,
+                      total_secs=total_secs,
+                      capture_end_secs=now,
+                      save_backlog_secs=max(0.0, save_end - now - last_saved_images*save_secs),
+                      images=images,
+                      storage_bytes=images * image_size,
+                      stages=stages,
+                      stop_reason=stop_reason,
+                      warnings=unmodelled_behaviour(current_routine))
+
+
+def main():
+    """Predict the timeline, duration, storage and bottleneck of a routine.
+    Call from the command line with:
+    $> simulate.py [routine name or file] [--sessions name,name | --simulated] [--cameras N] [--timeline] [--output file.json]
+
+    By default the latency model is calibrated from the timings of every previous session.
+    """
+    parser = argparse.ArgumentParser(description="Predict the duration and storage of a routine")
+    parser.add_argument("routine", help="Routine name or file")
+    parser.add_argument("--sessions", required=False, help="Comma separated session names to calibrate from (default: all sessions with recorded timings)")
+    parser.add_argument("--simulated", action="store_true", required=False, help="Use the simulated camera instead of recorded timings")
+    parser.add_argument("--cameras", type=int, default=1, help="Number of cameras capturing (default: 1)")
+    parser.add_argument("--timeline", action="store_true", required=False, help="Print the start time of every capture")
+    parser.add_argument("--output", required=False, help="Write the prediction and timeline to a JSON file")
+    args = parser.parse_args()
+
+    config.load()
+    data_dir = Path(os.environ.get(config.DATA_DIRECTORY_VARIABLE, "."))
+    current_routine = routine.RoutineIndex(data_dir / "routines").load(args.routine)
+    if current_routine is None:
+        print(f"Routine {args.routine} does not exist.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.simulated:
+        model = LatencyModel()
+    else:
+        session_dir = data_dir / "sessions"
+        if args.sessions:
+            directories = [session_dir / name.strip().replace(" ", "_") for name in args.sessions.split(",") if name.strip() != ""]
+        else:
+            directories = [path for path in session_dir.iterdir() if path.is_dir()] if session_dir.exists() else []
+        model = LatencyModel.from_sessions(directories)
+
+    prediction = simulate(current_routine, model, cameras=max(1, args.cameras))
+
+    print(f"Routine: {current_routine.name}")
+    if len(model.sources) > 0:
+        print(f"Calibrated from {len(model.sources)} session(s): {', '.join(model.sources[:5])}{'...' if len(model.sources) > 5 else ''}")
+        simulated = [phase for phase in SIMULATED_CAMERA if not model.calibrated(phase)]
+        if len(simulated) > 0:
+            print(f"Simulated camera used for: {', '.join(simulated)}")
+    else:
+        print("Using the simulated camera (no recorded timings)")
+    print(prediction)
+
+    if args.timeline:
+        print("\nTimeline:")
+        for entry in prediction.timeline:
+            settings = ", ".join(["auto" if auto else f"{time}s" for time, auto in zip(entry["integration_times"], entry["auto"])])
+            print(f"  {str(timedelta(seconds=int(entry['start_secs']))).rjust(10)}  #{entry['index']:<6} {entry['duration_secs']:8.2f}s  {settings}{' (mode switch)' if entry['mode_switches'] > 0 else ''}")
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({"routine": current_routine.name, "sources": model.sources, **prediction.as_dict()}, output_file, indent=5)
+
+
+if __name__ == "__main__":
+    main()
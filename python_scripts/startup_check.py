@@ -0,0 +1,83 @@
+#Checks that the commands which don't capture start quickly. Each of their entry modules is imported in a new
+#interpreter with python -X importtime, and its import time is compared against a budget. Any camera, image or other
+#slow module it imports is also reported.
+#Call from the command line (e.g. after changing imports) with:
+#$> startup_check.py [--repeat N] [--scale factor] [--verbose]
+#Exits with error code 1 if any module is over its budget or imports a module it shouldn't.
+import argparse
+import os
+import subprocess
+import sys
+from pathlib import Path
+import config
+
+#Modules which are slow to import, or need the camera libraries
+CAMERA_MODULES = ["harvesters", "genicam", "device_interface", "cam_image", "focus", "preview", "hdr", "PIL"]
+SLOW_MODULES = [*CAMERA_MODULES, "numpy", "dotenv", "ms5837", "pressure_sampler", "session", "daemon"]
+
+#Entry modules of the commands with (import time budget in seconds on a Raspberry Pi, modules they must not import)
+ENTRY_MODULES = {"control": (0.15, SLOW_MODULES),   #status, watch, log, stop, pause, resume and the daemon commands
+                 "aegir": (0.2, SLOW_MODULES),     #--help, and --check before the routine is loaded
+                 "nodes": (0.15, SLOW_MODULES),    #-n --get from the nodemap snapshot, and tab completion of node names
+                 "routine": (0.6, CAMERA_MODULES), #--check, and checking routines submitted to the daemon
+                 "simulate": (0.7, CAMERA_MODULES)}
+
+
+def import_time(module:str) -> tuple[float, dict[str, float]]:
+    """Import a module in a new interpreter, without DATA_DIRECTORY set.
+
+    Args:
+        module (str): Module name in the python_scripts directory
+
+    Returns:
+        tuple[float, dict[str, float]]: Import time of the module including everything it imports, and the time of
+            each module imported not including the modules it imports, in seconds
+    """
+    environment = {name: value for name, value in os.environ.items() if name != config.DATA_DIRECTORY_VARIABLE}
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=Path(__file__).parent,
+                            env=environment, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise ImportError(f"Could not import {module}: {result.stderr.strip().splitlines()[-1]}")
+
+    seconds, imported = None, {}
+    for line in result.stderr.splitlines():
+        #import time: self [us] | cumulative | imported package
+        fields = line.removeprefix("import time:").split("|")
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        imported[name] = int(fields[0]) / 1e6
+        if name == module:
+            seconds = int(fields[1]) / 1e6
+    return seconds, imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the import time of the lightweight commands")
+    parser.add_argument("--repeat", type=int, default=3, help="Imports of each module - the fastest is used, so compiling the bytecode is not counted (default: 3)")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply the budgets, e.g. 0.25 on a computer faster than a Raspberry Pi (default: 1)")
+    parser.add_argument("--verbose", action="store_true", help="List the slowest modules imported by each entry module")
+    args = parser.parse_args()
+
+    failed = False
+    for module, (budget_secs, excluded) in ENTRY_MODULES.items():
+        budget_secs *= args.scale
+        try:
+            seconds, imported = min([import_time(module) for _ in range(max(1, args.repeat))], key=lambda run: run[0])
+        except ImportError as e:
+            print(f"{module:<10} FAIL  {e}")
+            failed = True
+            continue
+        slow = sorted(set([name.split(".")[0] for name in imported]) & set(excluded))
+        passed = seconds <= budget_secs and len(slow) == 0
+        failed = failed or not passed
+        print(f"{module:<10} {'ok  ' if passed else 'FAIL'}  {seconds*1000:7.1f}ms (budget {budget_secs*1000:.0f}ms)"
+              f"{'  imports ' + ', '.join(slow) if len(slow) > 0 else ''}")
+        if args.verbose:
+            for name, module_secs in sorted(imported.items(), key=lambda item: -item[1])[:10]:
+                print(f"{'':<16}{module_secs*1000:7.1f}ms  {name}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import json
+import logging
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+
+logger = logging.getLogger()
+
+#Histogram bin edges in seconds - 4 log-spaced bins per decade from 10us to 1000s
+BIN_EDGES_SECS = np.logspace(-5, 3, 4*8 + 1)
+
+
+class PhaseTimer:
+    """Collects the durations of named phases of the capture path into log-spaced histograms.
+
+    Use as:
+        with timer.phase("fetch"):
+            buffer = device.fetch()
+
+    A phase can also be recorded against a variable it depends on (e.g. the integration time of a capture), in which
+    case a least squares line of duration against the variable is kept, so the fixed and proportional parts of the
+    duration can be separated (see fit).
+
+    Safe to use from several threads.
+    """
+
+    def __init__(self, name:str=None) -> None:
+        self.name = name
+        self._lock = threading.Lock()
+        self._phases:dict[str, dict] = {}
+        self.enabled = True
+
+    @contextmanager
+    def phase(self, name:str):
+        """Time the enclosed block as one occurrence of the named phase.
+
+        Args:
+            name (str): Phase name
+        """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, perf_counter() - start)
+
+    def record(self, name:str, duration_secs:float, x:float=None):
+        """Add one duration to the named phase.
+
+        Args:
+            name (str): Phase name
+            duration_secs (float): Duration in seconds
+            x (float, optional): Value of the variable the duration depends on, to fit the duration against. Defaults to None.
+        """
+        if not self.enabled:
+            return
+        with self._lock:
+            phase = self._phases.get(name)
+            if phase is None:
+                phase = {"count": 0, "total": 0.0, "min": duration_secs, "max": duration_secs,
+                         "histogram": np.zeros(BIN_EDGES_SECS.size + 1, dtype=np.int64)}
+                self._phases[name] = phase
+            phase["count"] += 1
+            phase["total"] += duration_secs
+            phase["min"] = min(phase["min"], duration_secs)
+            phase["max"] = max(phase["max"], duration_secs)
+            phase["histogram"][np.searchsorted(BIN_EDGES_SECS, duration_secs)] += 1
+            if x is not None:
+                #Running sums for the least squares fit of duration against x
+                sums = phase.setdefault("fit_sums", np.zeros(5))
+                sums += (1, x, duration_secs, x*x, x*duration_secs)
+
+    def reset(self):
+        with self._lock:
+            self._phases = {}
+
+    @property
+    def phases(self) -> list[str]:
+        with self._lock:
+            return list(self._phases.keys())
+
+    def percentile(self, name:str, percent:float) -> float:
+        """Estimate a percentile of a phase duration from its histogram (upper edge of the bin it falls in).
+
+        Args:
+            name (str): Phase name
+            percent (float): Percentile from 0 to 100
+
+        Returns:
+            float: Duration in seconds, or None if the phase has not been recorded
+        """
+        with self._lock:
+            phase = self._phases.get(name)
+            if phase is None:
+                return None
+            cumulative = np.cumsum(phase["histogram"])
+            index = int(np.searchsorted(cumulative, cumulative[-1]*percent/100))
+            upper_edges = np.append(BIN_EDGES_SECS, np.inf)
+            return float(min(upper_edges[index], phase["max"]))
+
+    def fit(self, name:str) -> tuple[float, float]:
+        """Least squares line of a phase's duration against the variable it was recorded with.
+
+        Args:
+            name (str): Phase name
+
+        Returns:
+            tuple[float, float]: (intercept in seconds, slope in seconds per unit of x), or None if the phase has not
+                                 been recorded against a variable. The slope is 0 if x has not varied.
+        """
+        with self._lock:
+            phase = self._phases.get(name)
+            if phase is None or "fit_sums" not in phase:
+                return None
+            n, sum_x, sum_y, sum_xx, sum_xy = phase["fit_sums"]
+        return fit_from_sums(n, sum_x, sum_y, sum_xx, sum_xy)
+
+    def summary(self) -> dict:
+        """Summary of each phase including its histogram.
+
+        Returns:
+            dict: {phase name: {count, total_secs, mean_secs, min_secs, max_secs, p50_secs, p95_secs, histogram}}
+        """
+        summary = {}
+        for name in self.phases:
+            with self._lock:
+                phase = self._phases[name]
+                count, total = phase["count"], phase["total"]
+                min_secs, max_secs = phase["min"], phase["max"]
+                histogram = phase["histogram"].tolist()
+                fit_sums = phase["fit_sums"].tolist() if "fit_sums" in phase else None
+            summary[name] = {"count": count,
+                             "total_secs": total,
+                             "mean_secs": total/count,
+                             "min_secs": min_secs,
+                             "max_secs": max_secs,
+                             "p50_secs": self.percentile(name, 50),
+                             "p95_secs": self.percentile(name, 95),
+                             "histogram": histogram}
+            if fit_sums is not None:
+                intercept, slope = fit_from_sums(*fit_sums)
+                summary[name]["fit"] = {"intercept_secs": intercept, "slope": slope, "sums": fit_sums}
+        return summary
+
+    def status_string(self) -> str:
+        """Short multi-line summary of the mean and 95th percentile of each phase, for the status output."""
+        string = ""
+        for name, phase in self.summary().items():
+            string += f"  {name.ljust(22)} n={phase['count']:<6} mean={phase['mean_secs']*1e3:9.2f}ms  p95={phase['p95_secs']*1e3:9.2f}ms\n"
+        return string
+
+    def write(self, file_path:str|Path, details:dict=None) -> bool:
+        """Append the phase summary to a JSON file containing a list of timing records.
+
+        Args:
+            file_path (str | Path): JSON file to write to
+            details (dict, optional): Additional details to add to the record (e.g. routine name and start time). Defaults to None.
+
+        Returns:
+            bool: True if written successfully
+        """
+        try:
+            file_path = Path(file_path)
+            records = []
+            if file_path.exists():
+                try:
+                    with open(file_path, "r") as timing_file:
+                        records = json.load(timing_file)
+                except Exception:
+                    logger.warning(f"Could not read existing timing file {file_path} - overwriting")
+                    records = []
+            record = {"name": self.name}
+            if details is not None:
+                record.update(details)
+            record["bin_edges_secs"] = BIN_EDGES_SECS.tolist()
+            record["phases"] = self.summary()
+            records.append(record)
+            with open(file_path, "w") as timing_file:
+                json.dump(records, timing_file, indent=5)
+            return True
+        except Exception as e:
+            logger.error(f"Could not write timings to {file_path}")
+            logger.exception(e)
+            return False
+
+
+def fit_from_sums(n:float, sum_x:float, sum_y:float, sum_xx:float, sum_xy:float) -> tuple[float, float]:
+    """Intercept and slope of the least squares line through points summarised by their sums."""
+    variance = n*sum_xx - sum_x*sum_x
+    if n == 0:
+        return 0.0, 0.0
+    if variance <= 1e-12 * max(1.0, n*sum_xx):
+        #x has not varied, so only the mean duration is known
+        return float(sum_y/n), 0.0
+    slope = (n*sum_xy - sum_x*sum_y) / variance
+    return float((sum_y - slope*sum_x) / n), float(slope)
@@ -0,0 +1,67 @@
+# Bash completion for aegir - installed to /etc/bash_completion.d by install.sh
+# Node names are listed from the nodemap snapshot (see python_scripts/nodes.py), so no camera connection is needed.
+
+_aegir() {
+    local current="${COMP_WORDS[COMP_CWORD]}"
+    local previous="${COMP_WORDS[COMP_CWORD-1]}"
+
+    case "$previous" in
+        -n|--node)
+            COMPREPLY=($(aegir nodes --list "$current" 2>/dev/null))
+            return 0
+            ;;
+        -r|--routine|--run)
+            COMPREPLY=($(compgen -f -- "$current"))
+            return 0
+            ;;
+        -s|--session|-c|--cameras|-b|--buffer|--set|--host|--port|--serial|--rate|--width)
+            COMPREPLY=()
+            return 0
+            ;;
+        --get)
+            COMPREPLY=($(compgen -W "--live" -- "$current"))
+            return 0
+            ;;
+        --focus-metric)
+            COMPREPLY=($(compgen -W "sobel laplacian" -- "$current"))
+            return 0
+            ;;
+        --profile)
+            COMPREPLY=($(compgen -W "full roi binned decimated decimated_4" -- "$current"))
+            return 0
+            ;;
+        --focus-rate)
+            COMPREPLY=()
+            return 0
+            ;;
+    esac
+
+    case "${COMP_WORDS[1]}" in
+        daemon)
+            COMPREPLY=($(compgen -W "--cameras --jobs --cancel --shutdown" -- "$current"))
+            ;;
+        nodes)
+            COMPREPLY=($(compgen -W "--refresh --list" -- "$current"))
+            ;;
+        autostart)
+            COMPREPLY=($(compgen -W "--enable --disable --query --start --routine --session" -- "$current"))
+            ;;
+        preview)
+            COMPREPLY=($(compgen -W "--host --port --serial --rate --width --profile" -- "$current"))
+            ;;
+        simulate)
+            COMPREPLY=($(compgen -W "--sessions --simulated --cameras --timeline --output" -- "$current"))
+            ;;
+        -f|--focus)
+            COMPREPLY=($(compgen -W "--focus-metric --focus-rate" -- "$current"))
+            ;;
+        *)
+            COMPREPLY=($(compgen -W "-h --help -b --buffer -c --cameras -f --focus -l --log -p --pause -u --unpause
+                                     -n --node --get --set -q --query -r --routine --resume --check -s --session -x --stop
+                                     --run daemon nodes preview simulate autostart" -- "$current"))
+            ;;
+    esac
+    return 0
+}
+
+complete -F _aegir aegir
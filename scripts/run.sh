@@ -36,6 +36,11 @@ export PATH="$IDS_PEAK_DIR/bin:$PATH"
 
 USB_MEMORY_FILE="/sys/module/usbcore/parameters/usbfs_memory_mb"
 
+# Client for the control socket of the daemon
+CONTROL_SCRIPT="$BASE_DIR/python_scripts/control.py"
+# Camera node lookups from the nodemap snapshot
+NODES_SCRIPT="$BASE_DIR/python_scripts/nodes.py"
+
 ROUTINE_FILE=""
 SESSION_NAME=""
 
@@ -82,17 +87,45 @@ while [[ $# -gt 0 ]]; do
             echo "Options:"
             echo "  -h, --help                          Display this help message and exit"
             echo "  -b, --buffer [size]                 Set USB buffer size for this Linux device to [size]mb (default: 1000)"
-            echo "  -f, --focus                         Test camera focus"
+            echo "  -c, --cameras [serials|all]         Comma separated serial numbers of the cameras to capture with (default: first camera found)"
+            echo "  -f, --focus [options]               Show the sharpness of the image centre while focusing the camera"
+            echo "      --focus-metric [sobel|laplacian]  Sharpness metric (default: sobel)"
+            echo "      --focus-rate [per second]     Sharpness measurements per second (default: 10)"
             echo "  -l, --log                           View output log of current active process"
+            echo "  -p, --pause                         Hold the captures of the currently running routine"
+            echo "  -u, --unpause                       Continue the captures of a paused routine"
             echo "  -n, --node [name]                   Get or set value of a device node by name"
             echo "                                      Sub-options:"
-            echo "                                        --get          Get the value of the node"
+            echo "                                        --get          Get the value, type and limits of the node from the nodemap snapshot"
+            echo "                                        --get --live   Read the node from the camera (through the daemon if it is running)"
             echo "                                        --set [value]  Set the value of the node to [value]"
             echo "  -q, --query                         Check for active ${TOOL_LOWER} process"
             echo "  -r, --routine [routine_name]        Specify a routine file (default directory: ./routines in Aegir DATA_DIRECTORY)"
+            echo "      --resume                        Continue the routine from where it stopped if the session has already run it"
+            echo "      --check                         Check the routine for problems and show a summary of it, without running it"
             echo "  -s, --session [session_name]        Specify session name"
             echo "  -x, --stop                          Send stop signal to currently running process"
             echo "      --run FILE                      Run a python script with the environment set up by this tool (advanced users only)"
+            echo "  nodes [OPTIONS]                     Manage the nodemap snapshots used by -n --get"
+            echo "      --refresh [serial]            Save a new snapshot of the camera's nodes"
+            echo "      --list [prefix]               List the node names in the snapshot"
+            echo "  preview [OPTIONS]                   Serve a live MJPEG preview of the camera over HTTP, e.g. to a laptop on the same network"
+            echo "      --port [port]                 Port to serve on (default: 8080)"
+            echo "      --serial [serial]             Camera to preview (default: first camera found)"
+            echo "      --rate [per second]           Most preview frames per second (default: 10)"
+            echo "      --width [pixels]              Widest preview frame (default: 960)"
+            echo "  simulate [routine_name] [OPTIONS]   Predict the duration, storage and bottleneck of a routine"
+            echo "      --sessions [names]            Comma separated sessions to calibrate the timing model from (default: all)"
+            echo "      --simulated                   Use a simulated camera instead of recorded timings"
+            echo "      --cameras [number]            Number of cameras capturing (default: 1)"
+            echo "      --timeline                    Print the predicted start time of every capture"
+            echo "      --output [file]               Write the prediction and timeline to a JSON file"
+            echo "  daemon [OPTIONS]                    Keep the cameras and pressure sensor connected and run routines given with -r one after another"
+            echo "                                      (started by daemon@${TOOL_LOWER}.service). While the daemon is running, -r queues the routine with it."
+            echo "      --cameras [serials|all]       Cameras used by routines which don't set -c (default: first camera found)"
+            echo "      --jobs, -j                    List the daemon's running, queued and recent routines"
+            echo "      --cancel [job number]         Remove a queued routine"
+            echo "      --shutdown                    Stop the running routine and the daemon"
             echo "  autostart [OPTIONS]        Manage autostart settings"
             echo "      --enable, -e                  Enable autostart with routine. Requires -r/--routine to be set."
             echo "      --routine, -r [routine_name]  Specify routine file to run on autostart (default directory: ./routines in Aegir DATA_DIRECTORY)"
@@ -105,6 +138,8 @@ while [[ $# -gt 0 ]]; do
             echo "Examples:"
             echo "  ${TOOL_LOWER} --buffer 500         Set USB buffer size to 500mb"
             echo "  ${TOOL_LOWER} --focus              Test camera focus"
+            echo "  ${TOOL_LOWER} -f --focus-metric laplacian --focus-rate 5"
+            echo "                          Test camera focus with the Laplacian metric, 5 times a second"
             echo "  ${TOOL_LOWER} --node \"ExposureTime\" --get"
             echo "                          Get the value of node \"ExposureTime\""
             echo "  ${TOOL_LOWER} --node \"ExposureTime\" --set 1000"
@@ -138,26 +173,14 @@ while [[ $# -gt 0 ]]; do
             fi
             ;;
         -f|--focus)
+            # The rest of the arguments are passed to the focus script
             RUN_FOCUS=1
+            shift
             break
             ;;
         -l|--log)
-            echo -n "Checking for process..."
-            if [ -p "$PIPE_OUT_FILE" ]; then
-                AEGIR_STATUS=$(timeout 3 cat "$PIPE_OUT_FILE")
-                echo -en "\e[K"
-                if [ -z "${AEGIR_STATUS}" ]; then
-                    echo -e "\rNo Aegir processes detected"
-                else
-                    echo -e "\rStatus: $AEGIR_STATUS"
-                    AEGIR_SESSION_LINE=$(grep "^Session: " <<< "$AEGIR_STATUS")
-                    AEGIR_SESSION="${AEGIR_SESSION_LINE#Session: }" 
-                    echo -e "Session: $AEGIR_SESSION"
-                    tail -f "$DATA_DIRECTORY/sessions/$AEGIR_SESSION/output.log"
-                fi
-            else
-                echo -e "\rNo Aegir processes detected"
-            fi
+            # Prints the status, then the log as it is written until Ctrl+C
+            "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" log
             exit 0
             ;;
         -n|--node)
@@ -171,8 +194,17 @@ while [[ $# -gt 0 ]]; do
             ;;
         --get)
             if [ -n "$NODE" ]; then
-                echo "$(ids_devicecommand -n $NODE --get)"
-                exit 0
+                # Served from the nodemap snapshot without connecting, unless --live is given
+                if [[ "$2" == "--live" ]]; then
+                    LIVE=true
+                fi
+                # A node is read from one camera
+                if [[ "${CAMERAS,,}" == "all" || "$CAMERAS" == *,* ]]; then
+                    echo "Error: Choose one camera with -c [serial] to read a node from" >&2
+                    exit 1
+                fi
+                "$PYTHON_EXECUTABLE" "$NODES_SCRIPT" get "$NODE" ${LIVE:+--live} ${CAMERAS:+--serial "$CAMERAS"}
+                exit $?
             else
                 echo "Error: No Node Name. Use '${TOOL_LOWER} --node [node name] --get | --set [value]"
                 exit 1
@@ -181,7 +213,7 @@ while [[ $# -gt 0 ]]; do
         --set)
             if [ -n "$NODE" ]; then
                 if [ -n "$2" ]; then
-                    NODE="$2"
+                    VALUE="$2"
                     shift 2
                 else
                     echo "Error: Argument for $1 is missing" >&2
@@ -195,20 +227,38 @@ while [[ $# -gt 0 ]]; do
             fi
             ;;                      
         -q|--query)
-            echo -n "Checking for process..."
-            if [ -p "$PIPE_OUT_FILE" ]; then
-                AEGIR_STATUS=$(timeout 3 cat "$PIPE_OUT_FILE")
-                echo -en "\e[K"
-                if [ -z "${AEGIR_STATUS}" ]; then
-                    echo -e "\rNo Aegir processes detected"
-                else
-                    echo -e "\rStatus: $AEGIR_STATUS"
-                fi
-            else
-                echo -e "\rNo Aegir processes detected"
+            "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" status
+            if "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" ping --daemon; then
+                echo "Daemon running. Jobs:"
+                "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" jobs
             fi
             exit 0
             ;;
+        -p|--pause)
+            "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" pause
+            exit $?
+            ;;
+        -u|--unpause)
+            "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" resume
+            exit $?
+            ;;
+        -c|--cameras)
+             if [ -n "$2" ]; then
+                CAMERAS="$2"
+                shift 2
+            else
+                echo "Error: Argument for $1 is missing" >&2
+                exit 1
+            fi
+            ;;
+        --resume)
+            RESUME=true
+            shift
+            ;;
+        --check)
+            CHECK=true
+            shift
+            ;;
         -r|--routine)
              if [ -n "$2" ]; then
                 ROUTINE_FILE="$2"
@@ -244,33 +294,76 @@ while [[ $# -gt 0 ]]; do
             shift
             ;;
         -x|--stop)
-            echo -n "Checking for process..."
-            if ! [ -p "$PIPE_OUT_FILE" ]; then
-                echo -e "\rNo Aegir processes detected"
+            if ! AEGIR_STATUS=$("$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" status); then
                 exit 0
             fi
-            AEGIR_STATUS=$(timeout 3 cat "$PIPE_OUT_FILE")
-            if [ -z "${AEGIR_STATUS}" ]; then
-                echo -e "\rNo Aegir processes detected"
-                exit 0
-            fi
-            echo -e "\rProcess found:\e[K"
+            echo "Process found:"
             echo "$AEGIR_STATUS"
             echo "Stopping Process..."
-            echo -n "STOP" > "$PIPE_IN_FILE" &
-            sleep .5
-            STOP_STATUS=$(timeout 3 cat "$PIPE_OUT_FILE")
-
-            echo "Stopping: $STOP_STATUS"
-            if [ "$STOP_STATUS" = "STOPPING" ]; then
+            if "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" stop; then
                 echo "Process Successfully Stopped"
             else
                 echo "Failed to stop process"
-                exit 0
             fi
             exit 0
             ;;
 
+        daemon)
+            shift
+            case "$1" in
+                --jobs|-j)
+                    "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" jobs
+                    exit $?
+                    ;;
+                --cancel)
+                    if [ -z "$2" ]; then
+                        echo "Error: Argument for $1 is missing" >&2
+                        exit 1
+                    fi
+                    "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" cancel "$2"
+                    exit $?
+                    ;;
+                --shutdown)
+                    "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" shutdown
+                    exit $?
+                    ;;
+                *)
+                    # Runs in the foreground so systemd can supervise it
+                    exec "$PYTHON_EXECUTABLE" "$BASE_DIR/python_scripts/${TOOL_LOWER}.py" --daemon "$@"
+                    ;;
+            esac
+            ;;
+        nodes)
+            case "$2" in
+                --refresh)
+                    # Connects to the camera (or asks the daemon) and saves a new snapshot
+                    "$PYTHON_EXECUTABLE" "$NODES_SCRIPT" refresh ${3:+--serial "$3"}
+                    exit $?
+                    ;;
+                --list)
+                    "$PYTHON_EXECUTABLE" "$NODES_SCRIPT" names "${3:-}"
+                    exit $?
+                    ;;
+                *)
+                    echo "Error: Use '${TOOL_LOWER} nodes --refresh [serial] | --list [prefix]'" >&2
+                    exit 1
+                    ;;
+            esac
+            ;;
+        preview)
+            if "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" ping; then
+                echo "Error: The camera is in use by a running routine or the ${TOOL_NAME} daemon. Stop the routine with '${TOOL_LOWER} -x', or the daemon with 'sudo systemctl stop daemon@${TOOL_LOWER}.service', first." >&2
+                exit 1
+            fi
+            shift
+            "$PYTHON_EXECUTABLE" "$BASE_DIR/python_scripts/preview.py" "$@"
+            exit $?
+            ;;
+        simulate)
+            shift
+            "$PYTHON_EXECUTABLE" "$BASE_DIR/python_scripts/simulate.py" "$@"
+            exit $?
+            ;;
         autostart)
             if [ -n "$2" ]; then
                 case "$2" in
@@ -320,11 +413,15 @@ fi
 
 
 if [ -n "$RUN_FOCUS" ]; then
+    if "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" ping; then
+        echo "Error: The camera is in use by a running routine or the ${TOOL_NAME} daemon. Stop the routine with '${TOOL_LOWER} -x', or the daemon with 'sudo systemctl stop daemon@${TOOL_LOWER}.service', first." >&2
+        exit 1
+    fi
     echo "Running focus test..."
     if [ -n "$RUN_EXEC" ]; then
-        $SCRIPT_DIR/python_scripts/dist/${TOOL_LOWER} --focus
+        "$BASE_DIR/python_scripts/dist/${TOOL_LOWER}" --focus ${CAMERAS:+--cameras "$CAMERAS"} "$@"
     else
-        "$PYTHON_EXECUTABLE" "$SCRIPT_DIR/python_scripts/${TOOL_LOWER}.py" --focus
+        "$PYTHON_EXECUTABLE" "$BASE_DIR/python_scripts/${TOOL_LOWER}.py" --focus ${CAMERAS:+--cameras "$CAMERAS"} "$@"
     fi
 
     exit 0
@@ -383,6 +480,11 @@ if [ -z "$ROUTINE_FILE" ]; then
     exit 1
 fi
 
+if [ -n "$CHECK" ]; then
+    "$PYTHON_EXECUTABLE" "$BASE_DIR/python_scripts/${TOOL_LOWER}.py" --routine "$ROUTINE_FILE" --check
+    exit $?
+fi
+
 
 USB_BUFFER_SIZE="$(cat "$USB_MEMORY_FILE")"
 
@@ -392,19 +494,20 @@ if [ "$USB_BUFFER_SIZE" -lt 1000 ]; then
 fi
 
 
+# The daemon keeps the cameras and pressure sensor open, so queue the routine with it rather than starting a new process
+if "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" ping --daemon; then
+    echo "Submitting routine to the ${TOOL_NAME} daemon..."
+    "$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" submit --routine "$ROUTINE_FILE" ${SESSION_NAME:+--session "$SESSION_NAME"} ${CAMERAS:+--cameras "$CAMERAS"} ${RESUME:+--resume} ${AUTOSTART_RUN:+--autostart}
+    exit $?
+fi
+
 echo -n "Checking for already running process..."
-if [ -p "$PIPE_OUT_FILE" ]; then
-    AEGIR_STATUS=$(timeout 3 cat "$PIPE_OUT_FILE")
-    echo -en "\e[K"
-    if [ -z "${AEGIR_STATUS}" ]; then
-        echo -e "\rNo Aegir processes detected            "
-    else
-        echo -e "\rAegir process already running:         "
-        echo "$AEGIR_STATUS"
-        echo "Use '${TOOL_LOWER} -x' to stop a currently running process"
-        echo "Exiting..."
-        exit 1
-    fi
+if AEGIR_STATUS=$("$PYTHON_EXECUTABLE" "$CONTROL_SCRIPT" status 2>/dev/null); then
+    echo -e "\rAegir process already running:         "
+    echo "$AEGIR_STATUS"
+    echo "Use '${TOOL_LOWER} -x' to stop a currently running process"
+    echo "Exiting..."
+    exit 1
 else
     echo -e "\rNo Aegir processes detected            "
 fi
@@ -426,9 +529,9 @@ PYTHON_SCRIPT="$BASE_DIR/python_scripts/${TOOL_LOWER}.py"
 #     echo "Running the executable..."
 #     $SCRIPT_DIR/python_scripts/dist/auto_capture --routine "$ROUTINE_FILE" --session "$SESSION_NAME" "$AUTOSTART_ARG"  >/dev/null &
 if [ -n "$AUTOSTART_RUN" ]; then
-    "$PYTHON_EXECUTABLE" "$PYTHON_SCRIPT" --routine "$ROUTINE_FILE" --session "$SESSION_NAME" --autostart >/dev/null &
+    "$PYTHON_EXECUTABLE" "$PYTHON_SCRIPT" --routine "$ROUTINE_FILE" --session "$SESSION_NAME" ${CAMERAS:+--cameras "$CAMERAS"} --autostart >/dev/null &
 else
-    "$PYTHON_EXECUTABLE" "$PYTHON_SCRIPT" --routine "$ROUTINE_FILE" --session "$SESSION_NAME" >/dev/null &
+    "$PYTHON_EXECUTABLE" "$PYTHON_SCRIPT" --routine "$ROUTINE_FILE" --session "$SESSION_NAME" ${CAMERAS:+--cameras "$CAMERAS"} ${RESUME:+--resume} >/dev/null &
 fi
 
 